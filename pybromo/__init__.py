@@ -10,6 +10,7 @@ del get_versions
 
 from . import loadutils as lu
 from . import diffusion
+from . import boundary
 from . import timestamps
 from . import plot
 from . import plotter
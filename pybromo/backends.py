@@ -0,0 +1,679 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module provides the storage backends used by :mod:`pybromo.storage`.
+
+Besides HDF5 files (through pytables), the simulation data can be saved
+in a directory, where each group or array is a sub-directory. The
+:class:`DirectoryFile` class implements the subset of the pytables `File`
+API used by the stores, so the parameters, the attributes and the arrays
+have the same semantics with all the backends. The extendable arrays
+(`EArray`) are stored as:
+
+- 'npy': a single `.npy` file, memory-mapped when reading. The
+  extendable axis is the slowest varying in the file, so appending a
+  chunk only writes at the end of the file and updates the header.
+- 'chunked': a `.npy` file for each chunk of rows along the extendable
+  axis (see `chunkshape`). Reading a slice only loads the chunks
+  overlapping it.
+
+Each array has a single writer: its length is kept in the metadata of
+the array object, so an array must be extended through one object.
+Appending to it from several threads is serialized by a lock, while
+different arrays can be written in parallel.
+
+The directory backends do not compress the data (the `filters` of the
+arrays are ignored).
+
+Use :func:`open_file` to open a file with any of the `BACKENDS`.
+"""
+
+import os
+import pickle
+import shutil
+import struct
+import threading
+from pathlib import Path
+
+import numpy as np
+import tables
+
+
+BACKENDS = ('hdf5', 'npy', 'chunked')
+
+# File (or directory) name suffix for each backend
+SUFFIXES = {'hdf5': '.hdf5', 'npy': '.npyd', 'chunked': '.chunked'}
+
+_META = '_node.pickle'
+_DATA = 'data.npy'
+# Fixed size of the header of the extendable `.npy` files
+_HEADER_LEN = 128
+# Default size in bytes of the chunks of an EArray
+_CHUNK_BYTES = 2**20
+
+
+def open_file(filepath, mode='r', backend='hdf5'):
+    """Open the data file `filepath` using the storage `backend`.
+
+    Arguments:
+        filepath (string or Path): file name (a directory for the 'npy'
+            and 'chunked' backends).
+        mode (string): 'r' (read-only), 'w' (create a new file, removing
+            an existing one) or 'a' (open or create a file for writing).
+        backend (string): one of `BACKENDS`.
+
+    Returns:
+        A pytables `File` or a :class:`DirectoryFile`.
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown storage backend "%s". Valid values are: '
+                         '%s.' % (backend, ', '.join(BACKENDS)))
+    if backend == 'hdf5':
+        return tables.open_file(str(filepath), mode=mode)
+    return DirectoryFile(filepath, mode=mode, backend=backend)
+
+
+def backend_from_path(filepath):
+    """Return the backend of the existing file (or directory) `filepath`.
+    """
+    filepath = Path(filepath)
+    if filepath.is_dir():
+        return _load_meta(filepath)['backend']
+    return 'hdf5'
+
+
+def _load_meta(dirpath):
+    with open(str(dirpath / _META), 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_meta(dirpath, meta):
+    # Replace the file atomically, so the metadata is never incomplete
+    tmp_path = dirpath / (_META + '.tmp')
+    with open(str(tmp_path), 'wb') as f:
+        pickle.dump(meta, f)
+    os.replace(str(tmp_path), str(dirpath / _META))
+
+
+def _save_npy(path, data):
+    tmp_path = path.with_suffix('.tmp')
+    with open(str(tmp_path), 'wb') as f:
+        np.save(f, data)
+    os.replace(str(tmp_path), str(path))
+
+
+def _npy_header(dtype, shape, fortran_order):
+    """Return a `.npy` header of `_HEADER_LEN` bytes.
+
+    Raise ValueError if the description of the array does not fit.
+    """
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                   'fortran_order': fortran_order,
+                   'shape': tuple(int(s) for s in shape)})
+    header = header.ljust(_HEADER_LEN - 11) + '\n'
+    if len(header) > _HEADER_LEN - 10:
+        raise ValueError('The `.npy` header of the array (dtype %s, shape '
+                         '%s) is longer than %d bytes.' %
+                         (dtype, tuple(shape), _HEADER_LEN))
+    return (b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) +
+            header.encode('latin1'))
+
+
+def _write_npy_header(f, header):
+    """Write `header` (see :func:`_npy_header`) at the start of `f`."""
+    f.seek(0)
+    f.write(header)
+
+
+class AttributeSet:
+    """Attributes of a node, saved when modified.
+
+    Attributes can be accessed as items or as python attributes, as in
+    `tables.AttributeSet`.
+    """
+
+    def __init__(self, node):
+        object.__setattr__(self, '_v_node', node)
+
+    @property
+    def _attrs(self):
+        return self._v_node._meta['attrs']
+
+    def _f_list(self):
+        return list(self._attrs)
+
+    def __contains__(self, name):
+        return name in self._attrs
+
+    def __getitem__(self, name):
+        return self._attrs[name]
+
+    def __getattr__(self, name):
+        try:
+            return self._attrs[name]
+        except KeyError:
+            raise AttributeError("Attribute '%s' does not exist in node "
+                                 "'%s'." % (name, self._v_node._v_pathname))
+
+    def __setitem__(self, name, value):
+        self._v_node._v_file._check_writable()
+        self._attrs[name] = value
+        self._v_node._save_meta()
+
+    __setattr__ = __setitem__
+
+    def __delitem__(self, name):
+        self._v_node._v_file._check_writable()
+        del self._attrs[name]
+        self._v_node._save_meta()
+
+    __delattr__ = __delitem__
+
+    def __repr__(self):
+        return 'AttributeSet(%s)' % ', '.join(self._attrs)
+
+
+class Node:
+    """Base class of the groups and arrays of a :class:`DirectoryFile`."""
+
+    def __init__(self, file, pathname, meta=None):
+        self._v_file = file
+        self._v_pathname = pathname
+        self._v_name = pathname.rsplit('/', 1)[-1] or '/'
+        self._v_dir = file._dirpath(pathname)
+        self._meta = _load_meta(self._v_dir) if meta is None else meta
+
+    @property
+    def name(self):
+        return self._v_name
+
+    @property
+    def title(self):
+        return self._meta['title']
+
+    @property
+    def attrs(self):
+        return AttributeSet(self)
+
+    _v_attrs = attrs
+
+    def _save_meta(self):
+        _save_meta(self._v_dir, self._meta)
+
+    def get_attr(self, name):
+        return getattr(self.attrs, name)
+
+    def set_attr(self, name, value):
+        self.attrs[name] = value
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, self._v_pathname)
+
+
+class Group(Node):
+    """A group of nodes (a sub-directory)."""
+
+    def __contains__(self, name):
+        return (self._v_dir / name / _META).exists()
+
+    def _f_get_child(self, name):
+        if name not in self:
+            raise tables.NoSuchNodeError('group ``%s`` does not have a child '
+                                         'named ``%s``' %
+                                         (self._v_pathname, name))
+        return self._v_file._load_node(self._v_file._join(self, name))
+
+    def _f_list_nodes(self):
+        names = sorted(path.name for path in self._v_dir.iterdir()
+                       if (path / _META).exists())
+        return [self._f_get_child(name) for name in names]
+
+    def __iter__(self):
+        return iter(self._f_list_nodes())
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._f_get_child(name)
+
+
+class Array(Node):
+    """A non-extendable array (a `.npy` file)."""
+
+    def _load(self, mmap_mode=None):
+        return np.load(str(self._v_dir / _DATA), mmap_mode=mmap_mode)
+
+    @property
+    def shape(self):
+        return self._load(mmap_mode='r').shape
+
+    @property
+    def dtype(self):
+        return self._load(mmap_mode='r').dtype
+
+    @property
+    def nrows(self):
+        shape = self.shape
+        return shape[0] if len(shape) > 0 else 1
+
+    def read(self):
+        data = self._load()
+        return data[()] if data.ndim == 0 else data
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._v_file._check_writable()
+        data = self._load()
+        data[key] = value
+        _save_npy(self._v_dir / _DATA, data)
+
+
+class EArray(Node):
+    """An array extendable along one axis (the axis of size 0 when created).
+
+    Subclasses implement the storage of the data. :meth:`append` and
+    :meth:`truncate` hold the lock of the array object, because they
+    update the number of rows from its current value.
+    """
+
+    def __init__(self, file, pathname, meta=None):
+        super().__init__(file, pathname, meta)
+        self._lock = threading.Lock()
+
+    @property
+    def dtype(self):
+        return np.dtype(self._meta['dtype'])
+
+    @property
+    def maindim(self):
+        return self._meta['maindim']
+
+    @property
+    def nrows(self):
+        return self._meta['nrows']
+
+    @property
+    def shape(self):
+        shape = list(self._meta['shape'])
+        shape[self.maindim] = self.nrows
+        return tuple(shape)
+
+    @property
+    def chunkshape(self):
+        return self._meta['chunkshape']
+
+    @property
+    def _row_shape(self):
+        """Shape of the data with 1 row."""
+        shape = list(self._meta['shape'])
+        shape[self.maindim] = 1
+        return tuple(shape)
+
+    def __len__(self):
+        return self.nrows
+
+    def _rows(self, start, stop):
+        """Return the rows `start:stop` (an array or a memory map)."""
+        raise NotImplementedError
+
+    def _take(self, data, start, stop):
+        """Return the rows `start:stop` of `data` along `maindim`."""
+        index = [slice(None)] * data.ndim
+        index[self.maindim] = slice(start, stop)
+        return data[tuple(index)]
+
+    def read(self, start=None, stop=None, step=None, out=None):
+        """Read the rows `start:stop:step` (along `maindim`) in `out`."""
+        start, stop, step = slice(start, stop, step).indices(self.nrows)
+        if step > 0:
+            data = self._rows(start, max(start, stop))
+        else:
+            # Rows from `stop + 1` to `start` (included), then reversed
+            data = self._rows(stop + 1, max(stop + 1, start + 1))
+        if step != 1:
+            index = [slice(None)] * data.ndim
+            index[self.maindim] = slice(None, None, step)
+            data = data[tuple(index)]
+        if out is None:
+            return np.array(data)
+        out[...] = data
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key or len(key) <= self.maindim:
+            return np.array(self._rows(0, self.nrows)[key])
+        # Read only the rows selected along `maindim`
+        main_key = key[self.maindim]
+        other_key = key[:self.maindim] + key[self.maindim + 1:]
+        if isinstance(main_key, slice):
+            data = self.read(main_key.start, main_key.stop, main_key.step)
+            return data[key[:self.maindim] + (slice(None),) +
+                        key[self.maindim + 1:]]
+        if isinstance(main_key, (int, np.integer)):
+            index = main_key + self.nrows if main_key < 0 else main_key
+            if not 0 <= index < self.nrows:
+                raise IndexError('Index %d out of range.' % main_key)
+            data = np.take(self.read(index, index + 1), 0, self.maindim)
+            return data[other_key]
+        return np.array(self._rows(0, self.nrows)[key])
+
+    def _check_append(self, data):
+        data = np.asarray(data, dtype=self.dtype)
+        if data.ndim != len(self._meta['shape']):
+            raise ValueError('The data to append has %d dimensions, the '
+                             'array has %d.' % (data.ndim, len(self.shape)))
+        expected = list(self._meta['shape'])
+        expected[self.maindim] = data.shape[self.maindim]
+        if data.shape != tuple(expected):
+            raise ValueError('The shape of the data to append %s is not '
+                             'compatible with the array shape %s.' %
+                             (data.shape, self.shape))
+        return data
+
+    def _set_nrows(self, nrows):
+        self._meta['nrows'] = int(nrows)
+        self._save_meta()
+
+
+class NpyEArray(EArray):
+    """EArray stored in a single `.npy` file, memory-mapped when read.
+
+    Arrays extendable along the last axis are saved in Fortran order and
+    arrays extendable along the first axis in C order, so that the rows
+    are appended at the end of the file.
+    """
+
+    @property
+    def _fortran_order(self):
+        return self.maindim > 0
+
+    @property
+    def _path(self):
+        return self._v_dir / _DATA
+
+    def _init_data(self):
+        header = _npy_header(self.dtype, self.shape, self._fortran_order)
+        with open(str(self._path), 'wb') as f:
+            _write_npy_header(f, header)
+
+    def _rows(self, start, stop):
+        if stop <= start:
+            shape = list(self.shape)
+            shape[self.maindim] = 0
+            return np.empty(shape, dtype=self.dtype)
+        # Zero-copy access, the pages are read only when used
+        data = np.memmap(str(self._path), dtype=self.dtype, mode='r',
+                         offset=_HEADER_LEN, shape=self.shape,
+                         order='F' if self._fortran_order else 'C')
+        return self._take(data, start, stop)
+
+    def append(self, data):
+        self._v_file._check_writable()
+        data = self._check_append(data)
+        order = 'F' if self._fortran_order else 'C'
+        with self._lock:
+            nrows = self.nrows + data.shape[self.maindim]
+            shape = list(self.shape)
+            shape[self.maindim] = nrows
+            # Check the header before modifying the file
+            header = _npy_header(self.dtype, shape, self._fortran_order)
+            with open(str(self._path), 'r+b') as f:
+                f.seek(0, os.SEEK_END)
+                f.write(data.tobytes(order=order))
+                _write_npy_header(f, header)
+            self._set_nrows(nrows)
+
+    def truncate(self, size):
+        self._v_file._check_writable()
+        row_bytes = int(np.prod(self._row_shape)) * self.dtype.itemsize
+        with self._lock:
+            shape = list(self.shape)
+            shape[self.maindim] = size
+            header = _npy_header(self.dtype, shape, self._fortran_order)
+            with open(str(self._path), 'r+b') as f:
+                f.truncate(_HEADER_LEN + size * row_bytes)
+                _write_npy_header(f, header)
+            self._set_nrows(size)
+
+
+class ChunkedEArray(EArray):
+    """EArray stored as a `.npy` file for each chunk of rows."""
+
+    @property
+    def _chunk_rows(self):
+        return self.chunkshape[self.maindim]
+
+    def _chunk_path(self, i_chunk):
+        return self._v_dir / ('chunk_%08d.npy' % i_chunk)
+
+    def _init_data(self):
+        pass
+
+    def _rows(self, start, stop):
+        chunk_rows = self._chunk_rows
+        chunks = []
+        for i_chunk in range(start // chunk_rows,
+                             -(-stop // chunk_rows)):
+            chunk_start = i_chunk * chunk_rows
+            chunk = np.load(str(self._chunk_path(i_chunk)), mmap_mode='r')
+            chunks.append(self._take(chunk, max(start - chunk_start, 0),
+                                     stop - chunk_start))
+        if len(chunks) == 1:
+            return chunks[0]
+        if len(chunks) == 0:
+            shape = list(self.shape)
+            shape[self.maindim] = 0
+            return np.empty(shape, dtype=self.dtype)
+        return np.concatenate(chunks, axis=self.maindim)
+
+    def append(self, data):
+        self._v_file._check_writable()
+        data = self._check_append(data)
+        chunk_rows = self._chunk_rows
+        with self._lock:
+            nrows, size = self.nrows, data.shape[self.maindim]
+            pos = 0
+            while pos < size:
+                i_chunk, offset = divmod(nrows, chunk_rows)
+                num_rows = min(chunk_rows - offset, size - pos)
+                chunk = self._take(data, pos, pos + num_rows)
+                if offset > 0:
+                    # Complete the last chunk
+                    last = np.load(str(self._chunk_path(i_chunk)))
+                    chunk = np.concatenate([last, chunk], axis=self.maindim)
+                _save_npy(self._chunk_path(i_chunk), chunk)
+                nrows += num_rows
+                pos += num_rows
+            self._set_nrows(nrows)
+
+    def truncate(self, size):
+        self._v_file._check_writable()
+        chunk_rows = self._chunk_rows
+        with self._lock:
+            num_chunks = -(-self.nrows // chunk_rows)
+            i_last, offset = divmod(size, chunk_rows)
+            for i_chunk in range(i_last + (offset > 0), num_chunks):
+                self._chunk_path(i_chunk).unlink()
+            if offset > 0 and i_last < num_chunks:
+                path = self._chunk_path(i_last)
+                _save_npy(path, self._take(np.load(str(path)), 0, offset))
+            self._set_nrows(size)
+
+
+_NODE_CLASSES = {'group': Group, 'array': Array}
+_EARRAY_CLASSES = {'npy': NpyEArray, 'chunked': ChunkedEArray}
+
+
+class DirectoryFile:
+    """A tree of groups and arrays stored in the directory `filepath`.
+
+    Implements the subset of the pytables `File` API used by the stores.
+    `backend` ('npy' or 'chunked') selects the storage of the extendable
+    arrays of a new file (see the module docstring). When opening an
+    existing directory, the backend used to create it is used.
+    """
+
+    def __init__(self, filepath, mode='r', backend='npy'):
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError('Invalid mode "%s".' % mode)
+        self.filepath = Path(filepath)
+        self.filename = str(filepath)
+        self.mode = mode
+        self.isopen = True
+        if mode == 'w' and self.filepath.exists():
+            shutil.rmtree(str(self.filepath))
+        if not (self.filepath / _META).exists():
+            if mode == 'r':
+                raise OSError('``%s`` does not exist' % self.filename)
+            self.filepath.mkdir(parents=True, exist_ok=True)
+            _save_meta(self.filepath, dict(kind='group', title='', attrs={},
+                                           backend=backend))
+        self.backend = _load_meta(self.filepath)['backend']
+
+    def _check_writable(self):
+        if self.mode == 'r':
+            raise tables.FileModeError('The file ``%s`` is opened in '
+                                       'read-only mode.' % self.filename)
+
+    def _dirpath(self, pathname):
+        return self.filepath.joinpath(*pathname.strip('/').split('/'))
+
+    @staticmethod
+    def _join(where, name):
+        if isinstance(where, Node):
+            where = where._v_pathname
+        if name is None:
+            return where
+        return where.rstrip('/') + '/' + name
+
+    def _load_node(self, pathname):
+        meta = _load_meta(self._dirpath(pathname))
+        if meta['kind'] == 'link':
+            return self.get_node(meta['target'])
+        if meta['kind'] == 'earray':
+            return _EARRAY_CLASSES[self.backend](self, pathname, meta)
+        return _NODE_CLASSES[meta['kind']](self, pathname, meta)
+
+    def _create_node(self, where, name, meta):
+        self._check_writable()
+        parent = self.get_node(where)
+        if not isinstance(parent, Group):
+            raise tables.NodeError('``%s`` is not a group.' %
+                                   parent._v_pathname)
+        if name in parent:
+            raise tables.NodeError('group ``%s`` already has a child node '
+                                   'named ``%s``' %
+                                   (parent._v_pathname, name))
+        pathname = self._join(parent, name)
+        dirpath = self._dirpath(pathname)
+        dirpath.mkdir()
+        meta = dict(meta, attrs={})
+        return pathname, dirpath, meta
+
+    @property
+    def root(self):
+        return self._load_node('/')
+
+    @property
+    def title(self):
+        return self.root.title
+
+    @title.setter
+    def title(self, title):
+        self._check_writable()
+        meta = _load_meta(self.filepath)
+        meta['title'] = title
+        _save_meta(self.filepath, meta)
+
+    def get_node(self, where, name=None):
+        if isinstance(where, Node) and name is None:
+            return where
+        pathname = self._join(where, name)
+        if not (self._dirpath(pathname) / _META).exists():
+            raise tables.NoSuchNodeError('``%s`` does not exist' % pathname)
+        return self._load_node(pathname)
+
+    def get_node_attr(self, where, attrname, name=None):
+        return getattr(self.get_node(where, name).attrs, attrname)
+
+    def set_node_attr(self, where, attrname, attrvalue, name=None):
+        self.get_node(where, name).attrs[attrname] = attrvalue
+
+    def create_group(self, where, name, title='', **kwargs):
+        pathname, dirpath, meta = self._create_node(
+            where, name, dict(kind='group', title=title))
+        _save_meta(dirpath, meta)
+        return Group(self, pathname, meta)
+
+    def create_array(self, where, name, obj=None, title='', **kwargs):
+        pathname, dirpath, meta = self._create_node(
+            where, name, dict(kind='array', title=title))
+        _save_npy(dirpath / _DATA, np.asarray(obj))
+        _save_meta(dirpath, meta)
+        return Array(self, pathname, meta)
+
+    def create_earray(self, where, name, atom=None, shape=None, title='',
+                      filters=None, expectedrows=None, chunkshape=None,
+                      **kwargs):
+        shape = tuple(int(s) for s in shape)
+        maindim = shape.index(0)
+        if maindim not in (0, len(shape) - 1):
+            raise ValueError('Only the first or the last axis can be '
+                             'extendable.')
+        dtype = np.dtype(atom.dtype)
+        if chunkshape is None:
+            row_bytes = max(1, int(np.prod(shape[:maindim] +
+                                           shape[maindim + 1:])))
+            row_bytes *= dtype.itemsize
+            chunkshape = list(shape)
+            chunkshape[maindim] = max(1, _CHUNK_BYTES // row_bytes)
+        chunkshape = tuple(max(1, int(c)) for c in chunkshape)
+        if self.backend == 'npy':
+            # Fail before creating the node
+            _npy_header(dtype, shape, maindim > 0)
+        pathname, dirpath, meta = self._create_node(
+            where, name, dict(kind='earray', title=title, dtype=dtype.str,
+                              shape=shape, maindim=maindim, nrows=0,
+                              chunkshape=chunkshape))
+        _save_meta(dirpath, meta)
+        array = _EARRAY_CLASSES[self.backend](self, pathname, meta)
+        array._init_data()
+        return array
+
+    def create_hard_link(self, where, name, target, **kwargs):
+        target = self._join(target, None)
+        pathname, dirpath, meta = self._create_node(
+            where, name, dict(kind='link', title='', target=target))
+        _save_meta(dirpath, meta)
+        return self.get_node(target)
+
+    def remove_node(self, where, name=None, recursive=False):
+        self._check_writable()
+        node = self.get_node(where, name)
+        if isinstance(node, Group) and node._f_list_nodes() and \
+                not recursive:
+            raise tables.NodeError('Group ``%s`` has child nodes.' %
+                                   node._v_pathname)
+        shutil.rmtree(str(self._dirpath(self._join(where, name))))
+
+    def flush(self):
+        """Data is written when appended, nothing to do."""
+        pass
+
+    def close(self):
+        self.isopen = False
+
+    def __contains__(self, pathname):
+        return (self._dirpath(pathname) / _META).exists()
+
+    def __repr__(self):
+        return 'DirectoryFile(%s, mode=%s, backend=%s)' % (
+            self.filename, self.mode, self.backend)
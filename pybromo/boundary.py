@@ -0,0 +1,174 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module provides boundary conditions for the diffusion simulation.
+
+The functions :func:`periodic` and :func:`mirror` have the same signature
+of :func:`pybromo.diffusion.wrap_periodic` and
+:func:`pybromo.diffusion.wrap_mirror` and can be passed as `wrap_func`
+to the simulation methods. They work in-place and modify only the
+(usually few) samples outside the box. :func:`mirror` also handles
+any number of reflections.
+
+Boundary conditions acting on the full 3D trajectories, such as the
+open reservoir :class:`Reservoir`, are subclasses of :class:`Boundary`.
+Instances can be passed as `wrap_func` as well.
+"""
+
+import numpy as np
+import numexpr as NE
+
+
+def _outside(a, a1, a2):
+    """Return the indexes of the elements of `a` outside [a1..a2]."""
+    mask = NE.evaluate('(a < a1) | (a > a2)',
+                       local_dict=dict(a=a, a1=a1, a2=a2))
+    return np.nonzero(mask)
+
+
+def periodic(a, a1, a2):
+    """Folds in-place the values of `a` outside [a1..a2] inside the interval.
+
+    Periodic boundary conditions. Unlike `wrap_periodic`, the values inside
+    the interval are not modified.
+    """
+    index = _outside(a, a1, a2)
+    if index[0].size > 0:
+        a[index] = np.mod(a[index] - a1, a2 - a1) + a1
+    return a
+
+
+def mirror(a, a1, a2):
+    """Folds in-place the values of `a` outside [a1..a2] inside the interval.
+
+    Mirror-like boundary conditions. Values are reflected on the interval
+    boundaries as many times as needed to fall in the interval.
+    """
+    index = _outside(a, a1, a2)
+    if index[0].size > 0:
+        size = a2 - a1
+        t = np.mod(a[index] - a1, 2 * size)
+        a[index] = a1 + size - np.abs(t - size)
+    return a
+
+
+class Boundary:
+    """Base class for boundary conditions acting on 3D trajectories.
+
+    Subclasses implement :meth:`wrap`. When `reinjects` is True, the
+    position of a particle after leaving the box is not a function of the
+    unwrapped position, so the end position of each chunk is taken from
+    the wrapped trajectory.
+    """
+    reinjects = False
+
+    def wrap(self, pos, bounds):
+        """Apply the boundary conditions in-place to `pos`.
+
+        Arguments:
+            pos (array): trajectories, shape (num_particles, 3, time_size).
+            bounds (array): box boundaries, shape (3, 2)
+                (i.e. `Box.b`).
+        """
+        raise NotImplementedError
+
+
+class Reservoir(Boundary):
+    """Open boundary conditions: the box is in contact with a reservoir.
+
+    A particle leaving the box is reinjected in a random point of the
+    box surface (uniformly distributed on the surface) and continues to
+    diffuse from there. The reinjection point is moved inside the box by
+    `depth` (by default the RMS 1-D step of the particle), so that the
+    next step does not leave the box again in half of the cases.
+    The number of particles is constant and the flux through each face is
+    proportional to its area, so the concentration in the box stays
+    uniform.
+
+    The reinjection points are drawn from `rs` (a `RandomState` or
+    `Generator`), or from a new `RandomState` initialized with `seed`.
+    When using more threads, the order of the draws (and therefore the
+    result) is not reproducible.
+    """
+    reinjects = True
+
+    def __init__(self, rs=None, seed=1, depth=None, segment=1024):
+        if rs is None:
+            rs = np.random.RandomState(seed)
+        self.rs = rs
+        self.depth = depth
+        self.segment = segment
+
+    def _random(self, size):
+        if isinstance(self.rs, np.random.Generator):
+            return self.rs.random(size)
+        return self.rs.random_sample(size)
+
+    def surface_point(self, bounds, depth=0):
+        """Return a random point (shape (3,)) on the surface of the box.
+
+        The point is moved inside the box by `depth` along the normal to
+        the face.
+        """
+        sizes = bounds[:, 1] - bounds[:, 0]
+        # Area of the faces normal to x, y and z
+        areas = np.array([sizes[1] * sizes[2], sizes[0] * sizes[2],
+                          sizes[0] * sizes[1]])
+        u = self._random(5)
+        axis = np.searchsorted(np.cumsum(areas / areas.sum()), u[0])
+        point = bounds[:, 0] + u[1:4] * sizes
+        depth = min(depth, sizes[axis] / 2)
+        side = int(u[4] < 0.5)
+        point[axis] = bounds[axis, side] + (-depth if side else depth)
+        return point
+
+    def wrap(self, pos, bounds):
+        """Apply the boundary conditions in-place to `pos`.
+
+        The trajectories are processed in segments of `segment` samples.
+        The offset of each particle due to the previous reinjections is
+        added to the whole segment at once, and only the rest of the
+        segment is checked again after a reinjection.
+        """
+        low = bounds[:, :1]
+        high = bounds[:, 1:]
+        time_size = pos.shape[-1]
+        depth = self.depth
+        if depth is None:
+            # RMS 1-D step of each particle
+            steps = np.diff(pos[:, :, :self.segment + 1], axis=-1)
+            depth = np.sqrt(np.mean(steps**2, axis=(1, 2))) \
+                if steps.size > 0 else np.zeros(pos.shape[0])
+        depth = np.broadcast_to(depth, pos.shape[:1])
+        offset = np.zeros((pos.shape[0], 3, 1))
+        for start in range(0, time_size, self.segment):
+            block = pos[:, :, start:start + self.segment]
+            block += offset
+            outside = NE.evaluate('(block < low) | (block > high)',
+                                  local_dict=dict(block=block,
+                                                  low=low[np.newaxis],
+                                                  high=high[np.newaxis]))
+            outside = outside.any(axis=1)
+            for ip in np.nonzero(outside.any(axis=-1))[0]:
+                p = block[ip]
+                k = np.argmax(outside[ip])
+                while True:
+                    # Restart the trajectory from the reinjection point
+                    point = self.surface_point(bounds, depth[ip])
+                    shift = point - p[:, k]
+                    p[:, k:] += shift[:, np.newaxis]
+                    p[:, k] = point
+                    offset[ip, :, 0] += shift
+                    out_p = ((p[:, k + 1:] < low) +
+                             (p[:, k + 1:] > high)).any(axis=0)
+                    if not out_p.any():
+                        break
+                    k += 1 + np.argmax(out_p)
+        return pos
+
+    def __repr__(self):
+        return 'Reservoir()'
@@ -15,13 +15,22 @@ import itertools
 from pathlib import Path
 from time import ctime
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from numpy import array, sqrt
+import numexpr as NE
 
-from .storage import TrajectoryStore, TimestampStore, ExistingArrayError
+from .backends import SUFFIXES
+from .storage import (TrajectoryStore, TimestampStore, ExistingArrayError,
+                      load_trajectory, emission_scale, EmissionPyramid,
+                      save_checkpoint, load_checkpoint, SparseArray,
+                      FixedPointArray, quantize as quantize_em)
 from .iter_chunks import iter_chunksize, iter_chunk_index
-from .psflib import NumericPSF
+from .psflib import psf_from_hdf5
+from .workspace import Workspace
+from .writer import ChunkWriter
+from . import boundary
 
 from ._version import get_versions
 __version__ = get_versions()['version']
@@ -29,6 +38,13 @@ __version__ = get_versions()['version']
 # Avogadro constant
 NA = 6.022141e23    # [mol^-1]
 
+# Approximate size (bytes) of the array of displacements simulated at once
+BLOCK_BYTES = 2**26
+
+# Number of steps accumulated in single precision before rebasing
+# (see `cumsum_rebased`)
+REBASE_STEPS = 2**12
+
 
 def get_seed(seed, ID=0, EID=0):
     """Get a random seed that is a combination of `seed`, `ID` and `EID`.
@@ -41,6 +57,221 @@ def hash_(x):
     return hashlib.sha1(repr(x).encode()).hexdigest()
 
 
+# Random number generators that can be selected with the `rng_backend`
+# argument. 'legacy' is `numpy.random.RandomState` (MT19937) which
+# reproduces simulations saved by previous versions. The others are
+# `numpy.random.Generator` objects with the given bit generator.
+RNG_BACKENDS = {'legacy': np.random.MT19937,
+                'pcg64': np.random.PCG64,
+                'philox': np.random.Philox}
+
+
+def new_rng(seed=None, backend='legacy'):
+    """Return a new random number generator initialized with `seed`.
+
+    Arguments:
+        seed (int, SeedSequence or None): seed of the generator. If None,
+            use a random seed.
+        backend (string): one of the keys in `RNG_BACKENDS`. 'legacy'
+            returns a `RandomState`, the others a `Generator`.
+    """
+    if backend not in RNG_BACKENDS:
+        raise ValueError('Unknown random number generator backend "%s". '
+                         'Valid values are: %s.' %
+                         (backend, ', '.join(RNG_BACKENDS)))
+    if backend == 'legacy':
+        return np.random.RandomState(seed=seed)
+    return np.random.Generator(RNG_BACKENDS[backend](seed))
+
+
+def get_rng_state(rs):
+    """Return the state of `rs` (RandomState, Generator or RandomStreams).
+
+    The state of a `RandomState` is the usual tuple, the state of a
+    `Generator` is the dict of its bit generator state.
+    """
+    if isinstance(rs, np.random.Generator):
+        return rs.bit_generator.state
+    return rs.get_state()
+
+
+def set_rng_state(rs, state):
+    """Set the state of `rs` to `state` as returned by :func:`get_rng_state`.
+    """
+    if isinstance(rs, np.random.Generator):
+        rs.bit_generator.state = state
+    else:
+        rs.set_state(state)
+
+
+def rng_from_state(state):
+    """Return a new random number generator with state `state`.
+
+    The type of generator (RandomState, Generator or RandomStreams) is
+    inferred from `state`, as returned by :func:`get_rng_state`.
+    """
+    if isinstance(state, dict) and 'streams' in state:
+        backend = state['backend']
+        if backend == 'legacy':
+            # Name used for 'randomstate-pcg64' in older checkpoints
+            backend = 'randomstate-pcg64'
+        return RandomStreams(state['seed'], backend=backend)
+    if isinstance(state, dict):
+        bit_generator = getattr(np.random, state['bit_generator'])()
+        bit_generator.state = state
+        return np.random.Generator(bit_generator)
+    rs = np.random.RandomState()
+    rs.set_state(state)
+    return rs
+
+
+def jumped_rng(rs):
+    """Return a new generator with the state of `rs` jumped ahead.
+
+    The new generator (of the same type of `rs`, a RandomState or a
+    Generator) draws a stream of random numbers independent from the
+    stream of `rs`. The state of `rs` is not modified.
+    """
+    if isinstance(rs, np.random.Generator):
+        return np.random.Generator(rs.bit_generator.jumped())
+    _, key, pos = rs.get_state()[:3]
+    bit_generator = np.random.MT19937()
+    bit_generator.state = dict(bit_generator='MT19937',
+                               state=dict(key=key, pos=pos))
+    return np.random.RandomState(bit_generator.jumped())
+
+
+def draw_normal(rs, scale, size, dtype='float64', out=None):
+    """Draw normal samples with zero mean and standard deviation `scale`.
+
+    A `Generator` draws single precision samples directly, while a
+    `RandomState` draws double precision samples that are then converted.
+    If `out` is not None, the samples are stored in `out`. A `Generator`
+    fills `out` directly, a `RandomState` needs a temporary array.
+    """
+    if isinstance(rs, np.random.Generator):
+        # Same result as rs.normal(loc=0, scale=scale, size=size)
+        samples = rs.standard_normal(size=size, dtype=dtype, out=out)
+        samples *= scale
+        return samples
+    samples = rs.normal(loc=0, scale=scale, size=size)
+    if out is None:
+        return samples.astype(dtype, copy=False)
+    out[...] = samples
+    return out
+
+
+def cumsum_rebased(a, rebase_steps=None):
+    """In-place cumulative sum along the last axis of the float32 array `a`.
+
+    The sum is computed in single precision in blocks of `rebase_steps`
+    samples (default `REBASE_STEPS`). Each block is then shifted by the
+    double precision sum of the previous blocks. In this way the single
+    precision partial sums stay of the order of the displacement in
+    `rebase_steps` steps and the rounding error does not grow with the
+    position. For typical diffusion parameters the error is about 1e-13 m
+    per block, i.e. about 0.1 nm after 10^9 steps (random walk of the
+    errors) and a few tens of nm in the worst case, still below the PSF
+    grid step (62.5 nm).
+
+    Returns:
+        The total sum along the last axis, as a float64 array (the last
+        dimension has size 1).
+    """
+    if rebase_steps is None:
+        rebase_steps = REBASE_STEPS
+    carry = np.zeros(a.shape[:-1] + (1,))
+    for start in range(0, a.shape[-1], rebase_steps):
+        block = a[..., start:start + rebase_steps]
+        np.cumsum(block, axis=-1, out=block)
+        block_sum = block[..., -1:].astype('float64')
+        block += carry
+        carry += block_sum
+    return carry
+
+
+def repeat_counts(values, counts, dtype):
+    """Return `values` repeated `counts` times (as `np.repeat`) as `dtype`.
+
+    The output is filled in-place: the difference between consecutive
+    values is written at the start of each run, and the cumulative sum
+    (modular for unsigned integers) reconstructs the runs. The temporary
+    arrays have the size of `values`, not of the output.
+    """
+    out = np.zeros(int(counts.sum()), dtype=dtype)
+    if values.size == 0:
+        return out
+    starts = np.empty(values.size, dtype=np.intp)
+    starts[0] = 0
+    np.cumsum(counts[:-1], dtype=np.intp, out=starts[1:])
+    out[starts] = np.diff(values, prepend=0)
+    return np.cumsum(out, dtype=out.dtype, out=out)
+
+
+class RandomStreams:
+    """Independent random streams for each particle and time chunk.
+
+    The stream of particle `i` in chunk `k` is seeded from
+    `SeedSequence(seed, spawn_key=(i, k))`. Therefore, the random numbers
+    of a particle in a chunk do not depend on the other particles or chunks
+    and can be drawn in any order (e.g. in parallel).
+
+    With the 'randomstate-pcg64' backend the streams are `RandomState`
+    objects using a PCG64 bit generator, otherwise `Generator` objects with
+    the bit generator of the selected backend (see `RNG_BACKENDS`).
+    The 'legacy' backend (MT19937) is not supported since it cannot be
+    seeded with a spawned `SeedSequence`.
+    """
+    def __init__(self, seed, backend='randomstate-pcg64'):
+        if backend == 'legacy':
+            raise ValueError('The "legacy" backend is not supported by '
+                             'RandomStreams, use "randomstate-pcg64".')
+        if backend != 'randomstate-pcg64' and backend not in RNG_BACKENDS:
+            raise ValueError('Unknown random number generator backend "%s".'
+                             % backend)
+        self.seed = seed
+        self.backend = backend
+
+    def stream(self, particle, chunk):
+        """Return the random number generator for `particle` in `chunk`."""
+        seed_seq = np.random.SeedSequence(self.seed,
+                                          spawn_key=(particle, chunk))
+        if self.backend == 'randomstate-pcg64':
+            return np.random.RandomState(np.random.PCG64(seed_seq))
+        return new_rng(seed_seq, backend=self.backend)
+
+    def normal(self, scale, size, i_start, chunk, dtype='float64', out=None):
+        """Draw normal samples for particles `i_start` to `i_start + size[0]`.
+
+        `scale` has shape broadcastable to `size`, the first dimension of
+        both is the particle. See :func:`draw_normal` for `dtype` and `out`.
+        """
+        scale = np.broadcast_to(scale, size)
+        samples = np.empty(size, dtype=dtype) if out is None else out
+        for i in range(size[0]):
+            draw_normal(self.stream(i_start + i, chunk), scale[i], size[1:],
+                        dtype=dtype, out=samples[i])
+        return samples
+
+    def get_state(self):
+        return {'seed': self.seed, 'backend': self.backend,
+                'streams': 'particle-chunk'}
+
+    def set_state(self, state):
+        """Check that `state` is the state of this object.
+
+        The streams have no state other than seed and backend, which
+        cannot be changed.
+        """
+        if state != self.get_state():
+            raise ValueError('Random state %r does not match %r.' %
+                             (state, self))
+
+    def __repr__(self):
+        return 'RandomStreams(seed=%r, backend=%r)' % (self.seed,
+                                                       self.backend)
+
+
 class Box:
     """The simulation box. Sizes in meters."""
     def __init__(self, x1, x2, y1, y2, z1, z2):
@@ -97,30 +328,34 @@ class Particles(object):
     @staticmethod
     def _generate(num_particles, D, box, rs):
         """Generate a list of `Particle` objects."""
-        X0 = rs.rand(num_particles) * (box.x2 - box.x1) + box.x1
-        Y0 = rs.rand(num_particles) * (box.y2 - box.y1) + box.y1
-        Z0 = rs.rand(num_particles) * (box.z2 - box.z1) + box.z1
+        X0 = rs.random(num_particles) * (box.x2 - box.x1) + box.x1
+        Y0 = rs.random(num_particles) * (box.y2 - box.y1) + box.y1
+        Z0 = rs.random(num_particles) * (box.z2 - box.z1) + box.z1
         return [Particle(D=D, x0=x0, y0=y0, z0=z0)
                 for x0, y0, z0 in zip(X0, Y0, Z0)]
 
-    def __init__(self, num_particles, D, box, rs=None, seed=1, particles=None):
+    def __init__(self, num_particles, D, box, rs=None, seed=1, particles=None,
+                 rng_backend='legacy'):
         """A set of `N` Particle() objects with random position in `box`.
 
         Arguments:
             num_particles (int): number of particles to be generated
             D (float): diffusion coefficient in S.I. units (m^2/s)
             box (Box object): the simulation box
-            rs (RandomState object): random state object used as random number
-                generator. If None, use a random state initialized from seed.
+            rs (RandomState or Generator object): random state object used
+                as random number generator. If None, use a random state
+                initialized from seed.
             seed (uint): when `rs` is None, `seed` is used to initialize the
                 random state. `seed` is ignored when `rs` is not None.
             particles (list or None): when not None, initialize the object from
                 this list that must containing only `Particle` objects.
+            rng_backend (string): random number generator created when `rs`
+                is None (see :func:`new_rng`).
         """
         if rs is None:
-            rs = np.random.RandomState(seed=seed)
+            rs = new_rng(seed, backend=rng_backend)
         self.rs = rs
-        self.init_random_state = rs.get_state()
+        self.init_random_state = get_rng_state(rs)
         self.box = box
         if particles is None:
             self._plist = self._generate(num_particles, D, box, rs)
@@ -207,6 +442,42 @@ def wrap_mirror(a, a1, a2):
     return a
 
 
+def support_overlap(lo, hi, s, a1, a2, wrap_func=wrap_periodic):
+    """Return True where the wrapped interval [lo..hi] may overlap [-s..s].
+
+    The intervals [`lo`..`hi`] are unwrapped coordinates, which are folded
+    in [`a1`..`a2`] by `wrap_func`. The test is done against all the
+    pre-images of [-s..s] through `wrap_func`.
+    Only :func:`wrap_periodic`, :func:`wrap_mirror`, `boundary.periodic`
+    and `boundary.mirror` are supported.
+    """
+    if wrap_func in (wrap_periodic, boundary.periodic):
+        size = a2 - a1
+        return np.ceil((lo - s) / size) <= np.floor((hi + s) / size)
+    elif wrap_func is wrap_mirror:
+        overlap = (lo <= s) * (hi >= -s)
+        for c in (2 * a1, 2 * a2):
+            overlap += (lo <= c + s) * (hi >= c - s)
+        return overlap
+    elif wrap_func is boundary.mirror:
+        # Pre-images are [-s..s] and its reflection on a1, with period 2L
+        period = 2 * (a2 - a1)
+        overlap = False
+        for c in (0, 2 * a1):
+            overlap = overlap + (np.ceil((lo - c - s) / period) <=
+                                 np.floor((hi - c + s) / period))
+        return overlap
+    raise ValueError('The PSF support test is only supported with '
+                     'periodic or mirror boundary conditions.')
+
+
+def _iter_rows(a, index=None):
+    """Iterate over the rows of `a`, or only over the rows in `index`."""
+    if index is None:
+        return iter(a)
+    return (a[i] for i in index)
+
+
 class NoMatchError(Exception):
     pass
 
@@ -225,8 +496,10 @@ class ParticlesSimulation(object):
     def datafile_from_hash(hash_, prefix, path):
         """Return pathlib.Path for a data-file with given hash and prefix.
         """
-        pattern = '%s_%s*.h*' % (prefix, hash_)
-        datafiles = list(path.glob(pattern))
+        pattern = '%s_%s*' % (prefix, hash_)
+        datafiles = [datafile for datafile in path.glob(pattern)
+                     if datafile.suffix.startswith('.h') or
+                     datafile.suffix in SUFFIXES.values()]
         if len(datafiles) == 0:
             raise NoMatchError('No matches for "%s"' % pattern)
         if len(datafiles) > 1:
@@ -236,6 +509,8 @@ class ParticlesSimulation(object):
     @staticmethod
     def from_datafile(hash_, path='./', ignore_timestamps=False, mode='r'):
         """Load simulation from disk trajectories and (when present) timestamps.
+
+        The storage backend is the one of the files found.
         """
         path = Path(path)
         assert path.exists()
@@ -245,7 +520,7 @@ class ParticlesSimulation(object):
         store = TrajectoryStore(file_traj, mode='r')
 
         psf_pytables = store.h5file.get_node('/psf/default_psf')
-        psf = NumericPSF(psf_pytables=psf_pytables)
+        psf = psf_from_hdf5(psf_pytables)
         box = store.h5file.get_node_attr('/parameters', 'box')
         P = store.h5file.get_node_attr('/parameters', 'particles')
 
@@ -253,17 +528,14 @@ class ParticlesSimulation(object):
         kwargs = {name: store.numeric_params[name] for name in names}
         S = ParticlesSimulation(particles=Particles.from_json(P), box=box,
                                 psf=psf, **kwargs)
+        if 't_max_name' in store.numeric_params:
+            # Extended simulation
+            S.t_max_name = store.numeric_params['t_max_name']
 
         # Emulate S.open_store_traj()
         S.store = store
         S.psf_pytables = psf_pytables
-        S.traj_group = S.store.h5file.root.trajectories
-        S.emission = S.traj_group.emission
-        S.emission_tot = S.traj_group.emission_tot
-        if 'position' in S.traj_group:
-            S.position = S.traj_group.position
-        elif 'position_rz' in S.traj_group:
-            S.position = S.traj_group.position_rz
+        S._load_traj_arrays()
         S.chunksize = S.store.h5file.get_node('/parameters', 'chunksize')
         if not ignore_timestamps:
             try:
@@ -279,24 +551,45 @@ class ParticlesSimulation(object):
                 print(' - Found matching timestamps.')
         return S
 
+    def _load_traj_arrays(self):
+        """Set the attributes of the trajectory arrays in `self.store`."""
+        self.traj_group = self.store.h5file.root.trajectories
+        self.emission = load_trajectory(self.traj_group.emission)
+        self.emission_tot = self.traj_group.emission_tot
+        if 'position' in self.traj_group:
+            self.position = load_trajectory(self.traj_group.position)
+        elif 'position_rz' in self.traj_group:
+            self.position = load_trajectory(self.traj_group.position_rz)
+        self.emission_pyramid = self.emission_tot_pyramid = None
+        if 'emission_pyramid' in self.traj_group:
+            self.emission_pyramid = EmissionPyramid(
+                self.traj_group.emission_pyramid, self.emission)
+        if 'emission_tot_pyramid' in self.traj_group:
+            self.emission_tot_pyramid = EmissionPyramid(
+                self.traj_group.emission_tot_pyramid, self.emission_tot)
+
     @staticmethod
-    def _get_group_randomstate(rs, seed, group):
+    def _get_group_randomstate(rs, seed, group, rng_backend='legacy'):
         """Return a RandomState, equal to the input unless rs is None.
 
         When rs is None, try to get the random state from the
         'last_random_state' attribute in `group`. When not available,
         use `seed` to generate a random state. When seed is None the returned
         random state will have a random seed.
+
+        The saved state determines the type of the returned object
+        (RandomState or Generator). Otherwise, `rng_backend` is used
+        (see :func:`new_rng`).
         """
         if rs is None:
-            rs = np.random.RandomState(seed=seed)
             # Try to set the random state from the last session to preserve
             # a single random stream when simulating timestamps multiple times
             if 'last_random_state' in group._v_attrs:
-                rs.set_state(group._v_attrs['last_random_state'])
+                rs = rng_from_state(group._v_attrs['last_random_state'])
                 print("INFO: Random state set to last saved state in '%s'." %
                       group._v_name)
             else:
+                rs = new_rng(seed, backend=rng_backend)
                 print("INFO: Random state initialized from seed (%d)." % seed)
         return rs
 
@@ -323,9 +616,14 @@ class ParticlesSimulation(object):
         self.psf = psf
         self.t_step = t_step
         self.t_max = t_max
+        # Duration used in the hash and in the file names, which do not
+        # change when the simulation is extended (see `extend`)
+        self.t_max_name = t_max
         self.ID = ID
         self.EID = EID
         self.n_samples = int(t_max / t_step)
+        # Buffers reused across chunks by the simulation loops
+        self.workspace = Workspace()
 
     @property
     def diffusion_coeff(self):
@@ -351,9 +649,11 @@ class ParticlesSimulation(object):
         """Return an hash for the simulation parameters (excluding ID and EID)
         This can be used to generate unique file names for simulations
         that have the same parameters and just different ID or EID.
+        For an extended simulation, the original duration is used.
         """
         hash_numeric = 't_step=%.3e, t_max=%.2f, np=%d, conc=%.2e' % \
-            (self.t_step, self.t_max, self.num_particles, self.concentration())
+            (self.t_step, self.t_max_name, self.num_particles,
+             self.concentration())
         hash_list = [hash_numeric, self.particles.short_repr(), repr(self.box),
                      self.psf.hash()]
         return hashlib.md5(repr(hash_list).encode()).hexdigest()
@@ -367,7 +667,7 @@ class ParticlesSimulation(object):
         if hashsize > 0:
             name = self.hash()[:hashsize] + '_' + name
         if t_max:
-            name += "_t_max%.1fs" % self.t_max
+            name += "_t_max%.1fs" % self.t_max_name
         return name
 
     def compact_name(self, hashsize=6):
@@ -390,6 +690,7 @@ class ParticlesSimulation(object):
             np = (self.num_particles, 'Number of simulated particles'),
             t_step = (self.t_step, 'Simulation time-step (s)'),
             t_max = (self.t_max, 'Simulation total time (s)'),
+            n_samples = (self.n_samples, 'Number of simulated time steps'),
             ID = (self.ID, 'Simulation ID (int)'),
             EID = (self.EID, 'IPython Engine ID (int)'),
             pico_mol = (self.concentration() * 1e12,
@@ -409,6 +710,34 @@ class ParticlesSimulation(object):
         print("  Emission array (float32): %.1f MB" % em_size)
         print("  Position array (float32): %.1f MB " % pos_size)
 
+    def emission_decimated(self, start=0, stop=None, decimate=1,
+                           stat='max', total=False):
+        """Return the emission in [`start`..`stop`) decimated by `decimate`.
+
+        Each output sample is the maximum (`stat='max'`) or the mean
+        (`stat='mean'`) of the emission in a window of `decimate` time
+        steps. The data is read from the emission pyramid, when present
+        (see `simulate_diffusion`), otherwise from the full resolution
+        emission. Quantized emission is decoded.
+
+        Arguments:
+            total (bool): if True, return the total emission (requires
+                the `emission_tot` array), else the emission of each
+                particle (shape (num_particles, num_windows)).
+        """
+        array = self.emission_tot if total else self.emission
+        pyramid = self.emission_tot_pyramid if total else \
+            self.emission_pyramid
+        if stop is None:
+            stop = array.nrows
+        if pyramid is not None:
+            return pyramid.decimate(start, stop, decimate, stat=stat)
+        num_windows = (stop - start) // decimate
+        data = array.read(start, start + num_windows * decimate)
+        data = data.reshape(data.shape[:-1] + (num_windows, decimate))
+        return (EmissionPyramid.stats[stat](data, axis=-1) *
+                emission_scale(array))
+
     def concentration(self, pM=False):
         """Return the concentration (in Moles) of the particles in the box.
         """
@@ -429,10 +758,12 @@ class ParticlesSimulation(object):
                 case 2-D or 3-D arrays have bigger chunks than 1-D arrays.
             overwrite (bool): if True, overwrite the file if already exists.
                 All the previously stored data in that file will be lost.
+            backend (string): storage backend, 'hdf5', 'npy' or 'chunked'
+                (see :mod:`pybromo.backends`).
         """[1:]
 
     def _open_store(self, store, prefix='', path='./', chunksize=2**19,
-                    chunkslice='bytes', mode='w'):
+                    chunkslice='bytes', mode='w', backend='hdf5'):
         """Open and setup the on-disk storage file (pytables HDF5 file).
 
         Low level method used to implement different stores.
@@ -446,17 +777,26 @@ class ParticlesSimulation(object):
         nparams = self.numeric_params
         self.chunksize = chunksize
         nparams.update(chunksize=(chunksize, 'Chunksize for arrays'))
-        store_fname = '%s_%s.hdf5' % (prefix, self.compact_name())
+        store_fname = '%s_%s%s' % (prefix, self.compact_name(),
+                                   SUFFIXES[backend])
         attr_params = dict(particles=self.particles.to_json(), box=self.box)
         kwargs = dict(path=path, nparams=nparams, attr_params=attr_params,
-                      mode=mode)
+                      mode=mode, backend=backend)
         store = store(store_fname, **kwargs)
         return store
 
     def open_store_traj(self, path='./', chunksize=2**19, chunkslice='bytes',
-                        mode='w', radial=False):
+                        mode='w', radial=False, sparse=False, quantize=None,
+                        quantize_max=1., pos_encoding=None, backend='hdf5'):
         """Open and setup the on-disk storage file (pytables HDF5 file).
 
+        If `sparse` is True, the emission and position arrays are stored
+        as `storage.SparseArray`. If `quantize` is not None, the emission
+        is stored as integers of type `quantize` with full-scale
+        `quantize_max` (see `TrajectoryStore.add_emission_tot`).
+        If `pos_encoding` is 'int16', the positions are stored as
+        box-relative fixed-point values (see `storage.FixedPointArray`).
+
         Arguments:
         """ + self.__DOCS_STORE_ARGS___
         if hasattr(self, 'store'):
@@ -466,7 +806,7 @@ class ParticlesSimulation(object):
                                       path=path,
                                       chunksize=chunksize,
                                       chunkslice=chunkslice,
-                                      mode=mode)
+                                      mode=mode, backend=backend)
 
         self.psf_pytables = self.psf.to_hdf5(self.store.h5file, '/psf')
         self.store.h5file.create_hard_link('/psf', 'default_psf',
@@ -476,95 +816,614 @@ class ParticlesSimulation(object):
         self.traj_group._v_attrs['psf_name'] = self.psf.fname
 
         kwargs = dict(chunksize=self.chunksize, chunkslice=chunkslice)
-        self.emission_tot = self.store.add_emission_tot(**kwargs)
-        self.emission = self.store.add_emission(**kwargs)
-        self.position = self.store.add_position(radial=radial, **kwargs)
+        em_kwargs = dict(quantize=quantize, full_scale=quantize_max, **kwargs)
+        self.emission_tot = self.store.add_emission_tot(**em_kwargs)
+        self.emission = self.store.add_emission(sparse=sparse, **em_kwargs)
+        bounds = self.box.b
+        if radial:
+            r_max = np.sqrt((np.abs(self.box.b[:2])**2).max(axis=1).sum())
+            bounds = np.array([[0, r_max], self.box.b[2]])
+        self.position = self.store.add_position(radial=radial, sparse=sparse,
+                                                encoding=pos_encoding,
+                                                bounds=bounds, **kwargs)
+        self.emission_pyramid = self.emission_tot_pyramid = None
 
     def open_store_timestamp(self, path=None, chunksize=2**19,
-                             chunkslice='bytes', mode='w'):
+                             chunkslice='bytes', mode='w', backend=None):
         """Open and setup the on-disk storage file (pytables HDF5 file).
 
+        When `backend` is None, use the backend of the trajectories file.
+
         Arguments:
         """ + self.__DOCS_STORE_ARGS___
         if hasattr(self, 'ts_store'):
             return
         if path is None:
             path = self.store.filepath.parent
+        if backend is None:
+            backend = self.store.backend if hasattr(self, 'store') else 'hdf5'
         self.ts_store = self._open_store(TimestampStore,
                                          prefix=ParticlesSimulation._PREFIX_TS,
                                          path=path,
                                          chunksize=chunksize,
                                          chunkslice=chunkslice,
-                                         mode=mode)
+                                         mode=mode, backend=backend)
         self.ts_group = self.ts_store.h5file.root.timestamps
 
     def _sim_trajectories(self, time_size, start_pos, rs,
                           total_emission=False, save_pos=False, radial=False,
-                          wrap_func=wrap_periodic):
+                          wrap_func=wrap_periodic, block_size=None,
+                          i_chunk=0, num_threads=1, dtype='float64',
+                          coarse_step=None, psf_support=None, n_sigma=5,
+                          psf_cull=False, psf_lut=False, workspace=None):
         """Simulate (in-memory) `time_size` steps of trajectories.
 
         Simulate Brownian motion diffusion and emission of all the particles.
         Uses the attributes: num_particles, sigma_1d, box, psf.
 
+        The particles are simulated in blocks: the trajectories of all the
+        particles in a block are computed at once in an array of shape
+        (block_size, 3, time_size). The random numbers are drawn in the same
+        order as when simulating one particle at a time, therefore the
+        result does not depend on `block_size`.
+
         Arguments:
             time_size (int): number of time steps to be simulated.
-            start_pos (array): shape (num_particles, 3), particles start
+            start_pos (array): shape (num_particles, 3, 1), particles start
                 positions. This array is modified to store the end position
                 after this method is called.
-            rs (RandomState): a `numpy.random.RandomState` object used
-                to generate the random numbers.
+            rs (RandomState or RandomStreams): a `numpy.random.RandomState`
+                object used to generate the random numbers or a
+                :class:`RandomStreams` object providing an independent
+                stream for each particle and chunk.
             total_emission (bool): if True, store only the total emission array
                 containing the sum of emission of all the particles.
             save_pos (bool): if True, save the particles 3D trajectories
-            wrap_func (function): the function used to apply the boundary
-                condition (use :func:`wrap_periodic` or :func:`wrap_mirror`).
+            wrap_func (function or Boundary): the function used to apply the
+                boundary condition (use :func:`wrap_periodic`,
+                :func:`wrap_mirror` or the in-place versions in
+                :mod:`pybromo.boundary`), or a `boundary.Boundary` object
+                (e.g. `boundary.Reservoir()`).
+            block_size (int or None): number of particles simulated at once.
+                If None, use as many particles as fit in a block of about
+                `BLOCK_BYTES` bytes.
+            i_chunk (int): index of the current chunk. Used only to select
+                the random streams when `rs` is a `RandomStreams` object.
+            num_threads (int): number of threads simulating blocks of
+                particles in parallel. Values larger than 1 require `rs` to
+                be a `RandomStreams` object. The result does not depend on
+                the number of threads.
+            dtype (string or numpy dtype): floating point type of the
+                displacements and positions, 'float64' or 'float32'.
+                In single precision, the displacements are accumulated in
+                blocks of `REBASE_STEPS` steps rebased on a double precision
+                offset (see :func:`cumsum_rebased`).
+            coarse_step (int or None): if not None, enable the adaptive
+                mode: the particles are first advanced in steps of
+                `coarse_step` time steps and the fine trajectory is
+                computed (through Brownian bridge sampling) only for the
+                intervals where the particle can enter the PSF support.
+                The emission is zero elsewhere. Not compatible with
+                `save_pos`. See :meth:`_sim_trajectories_block_coarse`.
+            psf_support (tuple or None): (radial, axial) half-size in meters
+                of the PSF support, used when `coarse_step` is not None or
+                `psf_cull` is True. If None, use `self.psf.support_xz()`
+                with `coarse_step` and the extent of the PSF grid
+                (`self.psf.support_xz(0)`) with `psf_cull`.
+            n_sigma (float): margin, in units of the standard deviation
+                of the displacement in `coarse_step` steps, used to test if
+                a particle can enter the PSF support during a coarse step.
+            psf_cull (bool): if True, skip the PSF evaluation for the
+                particles whose trajectory in the current chunk cannot
+                enter the PSF support (tested using the minimum and
+                maximum of each coordinate). The emission of these
+                particles is zero.
+            psf_lut (bool): if True, compute the emission by bilinear
+                interpolation of a lookup table of the squared PSF (see
+                `NumericPSF.emission_xz`), which is faster than evaluating
+                the spline and squaring. The emission is zero outside the
+                PSF grid.
+            workspace (Workspace or None): if not None, the emission array
+                and the temporary arrays are views of the buffers in
+                `workspace` (see :class:`pybromo.workspace.Workspace`),
+                which are reused in the next call. Otherwise, new arrays are
+                allocated.
 
         Returns:
-            POS (list): list of 3D trajectories arrays (3 x time_size)
+            POS (list): list of trajectories arrays, one for each block of
+                particles, with shape (block_size, 3, time_size) or
+                (block_size, 2, time_size) when `radial` is True.
             em (array): array of emission (total or per-particle)
         """
         time_size = int(time_size)
         num_particles = self.num_particles
-        if total_emission:
-            em = np.zeros(time_size, dtype=np.float32)
+        if num_threads > 1 and not isinstance(rs, RandomStreams):
+            raise ValueError('Using more than one thread requires a '
+                             'RandomStreams object as `rs`.')
+        if coarse_step is not None:
+            if save_pos:
+                raise ValueError('`save_pos` is not supported with '
+                                 '`coarse_step`.')
+            if psf_support is None:
+                psf_support = self.psf.support_xz()
+        elif psf_cull:
+            if psf_support is None:
+                psf_support = self.psf.support_xz(0)
+        else:
+            psf_support = None
+        em_shape = time_size if total_emission else (num_particles, time_size)
+        if workspace is None:
+            em = np.zeros(em_shape, dtype=np.float32)
+        else:
+            # Per-particle emission rows are always fully overwritten
+            em = workspace.get('em', em_shape, np.float32,
+                               zero=total_emission)
+        if block_size is None:
+            itemsize = np.dtype(dtype).itemsize
+            block_size = max(1, BLOCK_BYTES // (3 * itemsize * time_size))
+        if num_threads > 1:
+            # Have at least one block per thread
+            block_size = min(block_size, -(-num_particles // num_threads))
+
+        def sim_block(index):
+            i0, i1 = index
+            if coarse_step is not None:
+                return self._sim_trajectories_block_coarse(
+                    i0, i1, time_size, start_pos, rs, coarse_step,
+                    psf_support, i_chunk=i_chunk, n_sigma=n_sigma,
+                    wrap_func=wrap_func, dtype=dtype, psf_lut=psf_lut)
+            # Per-particle emission is written directly in `em`
+            out = None if total_emission else em[i0:i1]
+            if workspace is None:
+                return self._sim_trajectories_block(
+                    i0, i1, time_size, start_pos, rs, i_chunk=i_chunk,
+                    save_pos=save_pos, radial=radial, wrap_func=wrap_func,
+                    dtype=dtype, psf_support=psf_support, psf_lut=psf_lut,
+                    out=out)
+            if out is None:
+                # With more threads, the emission of all the blocks is
+                # summed after all the blocks are simulated.
+                name = ('em_block', i0 if num_threads > 1 else 0)
+                out = workspace.get(name, (i1 - i0, time_size), np.float32)
+            with workspace.slot() as ws:
+                return self._sim_trajectories_block(
+                    i0, i1, time_size, start_pos, rs, i_chunk=i_chunk,
+                    save_pos=save_pos, radial=radial, wrap_func=wrap_func,
+                    dtype=dtype, psf_support=psf_support, psf_lut=psf_lut,
+                    out=out, workspace=ws)
+
+        blocks = iter_chunk_index(num_particles, block_size)
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                results = list(executor.map(sim_block, blocks))
         else:
-            em = np.zeros((num_particles, time_size), dtype=np.float32)
+            results = map(sim_block, blocks)
 
+        # Per-particle emission of the full-resolution blocks is already
+        # written in `em` (see `sim_block`)
+        em_in_place = not total_emission and coarse_step is None
         POS = []
-        # pos_w = np.zeros((3, c_size))
-        for i, sigma_1d in enumerate(self.sigma_1d):
-            delta_pos = rs.normal(loc=0, scale=sigma_1d,
-                                  size=3 * time_size)
-            delta_pos = delta_pos.reshape(3, time_size)
-            pos = np.cumsum(delta_pos, axis=-1, out=delta_pos)
-            pos += start_pos[i]
+        i0 = 0
+        # Blocks are returned in order, so the total emission is always
+        # summed in the same order (one particle at a time).
+        for pos_save, current_em, near in results:
+            i1 = i0 + current_em.shape[0]
+            if total_emission:
+                # The emission of the particles not in `near` is zero
+                for current_em_i in _iter_rows(current_em, near):
+                    em += current_em_i
+            elif not em_in_place:
+                em[i0:i1] = current_em
+            if save_pos:
+                POS.append(pos_save)
+            i0 = i1
+        return POS, em
 
-            # Coordinates wrapping using the specified boundary conditions
-            for coord in (0, 1, 2):
-                pos[coord] = wrap_func(pos[coord], *self.box.b[coord])
+    def _sim_trajectories_block(self, i0, i1, time_size, start_pos, rs,
+                                i_chunk=0, save_pos=False, radial=False,
+                                wrap_func=wrap_periodic, dtype='float64',
+                                psf_support=None, psf_lut=False, out=None,
+                                workspace=None):
+        """Simulate trajectories and emission of particles `i0` to `i1`.
+
+        See :meth:`_sim_trajectories` for the description of the arguments.
+        The rows `i0:i1` of `start_pos` are updated in-place. The emission
+        is stored in `out` (if not None). The temporary arrays are taken
+        from `workspace` (if not None), which must not be shared with
+        other threads.
+        If `psf_support` is not None, the emission is computed only for
+        the particles whose trajectory can enter the PSF support in
+        the current chunk (see :meth:`_near_support`).
 
-            # Sample the PSF along i-th trajectory then square to account
-            # for emission and detection PSF.
-            Ro = sqrt(pos[0]**2 + pos[1]**2)  # radial pos. on x-y plane
-            Z = pos[2]
-            current_em = self.psf.eval_xz(Ro, Z)**2
-            if total_emission:
-                # Add the current particle emission to the total emission
-                em += current_em.astype(np.float32)
+        Returns:
+            A tuple with the trajectories (None if `save_pos` is False),
+            the float32 emission of each particle (shape (i1 - i0, time_size))
+            and the indexes of the particles (relative to `i0`) for which
+            the emission has been computed (None for all the particles).
+        """
+        # The saved trajectories must outlive the block, so they are not
+        # drawn in a workspace buffer (reused by the next block)
+        pos, delta_end = self._sim_displacements(
+            i0, i1, time_size, rs, i_chunk, dtype=dtype,
+            workspace=None if save_pos else workspace)
+        end_pos = delta_end + start_pos[i0:i1]
+        pos += start_pos[i0:i1]
+        if getattr(wrap_func, 'reinjects', False):
+            # The end position depends on the whole trajectory
+            self._wrap_pos(pos, wrap_func)
+            end_pos = pos[:, :, -1:].astype('float64')
+        near = None
+        if psf_support is not None:
+            near = self._near_support(pos, psf_support, wrap_func)
+        pos_save, current_em = self._wrap_emission(pos, save_pos=save_pos,
+                                                   radial=radial,
+                                                   wrap_func=wrap_func,
+                                                   near=near, psf_lut=psf_lut,
+                                                   out=out, workspace=workspace)
+        # Update start_pos in-place for current particles
+        start_pos[i0:i1] = self._wrap_pos(end_pos, wrap_func)
+        return pos_save, current_em, near
+
+    def _sim_trajectories_block_coarse(self, i0, i1, time_size, start_pos,
+                                       rs, coarse_step, psf_support,
+                                       i_chunk=0, n_sigma=5,
+                                       wrap_func=wrap_periodic,
+                                       dtype='float64', psf_lut=False):
+        """Simulate the emission of particles `i0` to `i1` with coarse steps.
+
+        Each particle is advanced by `coarse_step` time steps at once
+        (the last step may be shorter). For each coarse step, the fine
+        trajectory between the two end-points is a Brownian bridge, which
+        deviates from the straight segment joining the end-points by more
+        than `n_sigma` standard deviations (of the coarse displacement)
+        with probability below 2 exp(-2 `n_sigma`**2) per coordinate.
+        When the bounding box of the segment, enlarged by this margin, does
+        not overlap the PSF support (after applying the boundary
+        conditions), the emission in the interval is set to zero.
+        Otherwise, the fine trajectory is sampled from the bridge:
+
+            B_k = a + W_k + (k/K) ((b - a) - W_K),    k = 1..K
+
+        where `a` and `b` are the end-points and W_k is a random walk with
+        the fine step standard deviation. B_k has the same distribution of
+        the fine-step trajectory conditioned on the end-points, so the
+        result is statistically equivalent to :meth:`_sim_trajectories_block`
+        (except for the emission outside the PSF support).
+
+        See :meth:`_sim_trajectories` for the description of the arguments.
+        The rows `i0:i1` of `start_pos` are updated in-place.
+
+        Returns:
+            A tuple with None (trajectories are not saved), the float32
+            emission of each particle (shape (i1 - i0, time_size)) and
+            the list of the particles (relative to `i0`) with non-zero
+            emission.
+        """
+        num_coarse = -(-time_size // coarse_step)
+        steps = np.full(num_coarse, coarse_step)
+        steps[-1] = time_size - (num_coarse - 1) * coarse_step
+        k = np.arange(1, coarse_step + 1)
+        em = np.zeros((i1 - i0, num_coarse * coarse_step), dtype=np.float32)
+        near_particles = []
+        for ip in range(i0, i1):
+            if isinstance(rs, RandomStreams):
+                rs_p = rs.stream(ip, i_chunk)
             else:
-                # Store the individual emission of current particle
-                em[i] = current_em.astype(np.float32)
-            if save_pos:
-                pos_save = np.vstack((Ro, Z)) if radial else pos
-                POS.append(pos_save[np.newaxis, :, :])
+                rs_p = rs
+            sigma = self.sigma_1d[ip]
+            # Coarse end-points a (start) and b (end) of each interval
+            delta = draw_normal(rs_p, sigma * np.sqrt(steps), (3, num_coarse))
+            b = np.cumsum(delta, axis=-1) + start_pos[ip]
+            a = np.hstack([start_pos[ip], b[:, :-1]])
+            # Intervals where the particle may enter the PSF support
+            margin = n_sigma * sigma * np.sqrt(steps)
+            lo = np.minimum(a, b) - margin
+            hi = np.maximum(a, b) + margin
+            near = self._support_overlap(lo, hi, psf_support, wrap_func)
+            idx = np.nonzero(near)[0]
+            if idx.size > 0:
+                # Brownian bridge between the end-points, shape (n, 3, K)
+                W = draw_normal(rs_p, sigma, (idx.size, 3, coarse_step),
+                                dtype=dtype).astype('float64')
+                np.cumsum(W, axis=-1, out=W)
+                K = steps[idx].reshape(-1, 1, 1)
+                W_K = np.take_along_axis(W, K - 1, axis=-1)
+                a_near = a[:, idx].T[:, :, np.newaxis]
+                b_near = b[:, idx].T[:, :, np.newaxis]
+                pos = a_near + W + (k / K) * (b_near - a_near - W_K)
+                _, em_near = self._wrap_emission(pos, wrap_func=wrap_func,
+                                                 psf_lut=psf_lut)
+                em_p = em[ip - i0].reshape(num_coarse, coarse_step)
+                em_p[idx] = em_near
+                near_particles.append(ip - i0)
             # Update start_pos in-place for current particle
-            start_pos[i] = pos[:, -1:]
-        return POS, em
+            start_pos[ip] = self._wrap_pos(b[np.newaxis, :, -1:],
+                                           wrap_func)[0]
+        # Samples past the end of the last (shorter) interval are discarded
+        return None, em[:, :time_size], near_particles
+
+    def _sim_displacements(self, i0, i1, time_size, rs, i_chunk=0,
+                           dtype='float64', workspace=None):
+        """Return the displacements of particles `i0` to `i1` from the start.
+
+        If `workspace` is not None, the displacements are stored in one of
+        its buffers, unless `rs` is a `RandomState` (which cannot draw
+        samples in an existing array).
+
+        Returns:
+            A tuple with the cumulative sum of the random displacements
+            of each particle (array of shape (i1 - i0, 3, time_size) and
+            type `dtype`) and the total displacement in double precision
+            (shape (i1 - i0, 3, 1)).
+        """
+        dtype = np.dtype(dtype)
+        sigma_1d = np.array(self.sigma_1d[i0:i1]).reshape(i1 - i0, 1, 1)
+        size = (i1 - i0, 3, time_size)
+        out = None
+        if workspace is not None and not isinstance(rs, np.random.RandomState):
+            out = workspace.get('delta_pos', size, dtype)
+        if isinstance(rs, RandomStreams):
+            delta_pos = rs.normal(sigma_1d, size, i0, i_chunk, dtype=dtype,
+                                  out=out)
+        else:
+            # The (scaled) normal samples are drawn in C order, i.e.
+            # 3 * time_size samples for each particle in sequence.
+            delta_pos = draw_normal(rs, sigma_1d, size, dtype=dtype, out=out)
+        if dtype == np.float64:
+            pos = np.cumsum(delta_pos, axis=-1, out=delta_pos)
+            return pos, pos[:, :, -1:]
+        delta_end = cumsum_rebased(delta_pos)
+        return delta_pos, delta_end
+
+    def _wrap_pos(self, pos, wrap_func=wrap_periodic):
+        """Apply the boundary conditions to `pos` (in-place) and return it.
+
+        `wrap_func` is a function applied to each coordinate or a
+        `boundary.Boundary` object, applied to the 3D positions.
+        """
+        if isinstance(wrap_func, boundary.Boundary):
+            return wrap_func.wrap(pos, self.box.b)
+        for coord in (0, 1, 2):
+            pos_coord = pos[:, coord]
+            wrapped = wrap_func(pos_coord, *self.box.b[coord])
+            if wrapped is not pos_coord:
+                pos_coord[:] = wrapped
+        return pos
+
+    def _support_overlap(self, lo, hi, psf_support, wrap_func=wrap_periodic):
+        """Return True where the box [`lo`..`hi`] may overlap the PSF support.
+
+        `lo` and `hi` are unwrapped coordinates with x, y, z along axis 0.
+        `psf_support` is the (radial, axial) half-size of the PSF support.
+        """
+        support = (psf_support[0], psf_support[0], psf_support[1])
+        overlap = True
+        for coord in (0, 1, 2):
+            overlap = overlap * support_overlap(lo[coord], hi[coord],
+                                                support[coord],
+                                                *self.box.b[coord],
+                                                wrap_func=wrap_func)
+        return overlap
+
+    def _near_support(self, pos, psf_support, wrap_func=wrap_periodic):
+        """Return the indexes of the particles that can enter the PSF support.
+
+        The test uses the minimum and maximum (unwrapped) coordinates of
+        each trajectory in `pos` (shape (num_particles, 3, time_size)).
+        """
+        lo, hi = pos.min(axis=-1).T, pos.max(axis=-1).T
+        return np.nonzero(self._support_overlap(lo, hi, psf_support,
+                                                wrap_func))[0]
+
+    def _wrap_emission(self, pos, save_pos=False, radial=False,
+                       wrap_func=wrap_periodic, near=None, psf_lut=False,
+                       out=None, workspace=None):
+        """Apply the boundary conditions to `pos` (in-place) and compute
+        the emission.
+
+        If `near` is not None, compute the emission only for the
+        particles with these indexes. The emission of the other particles
+        is zero and their position is wrapped only when `save_pos` is True.
+        The emission is stored in the float32 array `out` (shape
+        (num_particles, time_size)), allocated if None. The temporary
+        arrays are taken from `workspace` (if not None).
+
+        Returns:
+            A tuple with the trajectories (None if `save_pos` is False) and
+            the float32 emission of each particle.
+        """
+        # Coordinates wrapping using the specified boundary conditions
+        if near is None or save_pos:
+            self._wrap_pos(pos, wrap_func)
+        if near is None:
+            current_em = self._emission(pos, psf_lut, out=out,
+                                        workspace=workspace)
+        else:
+            if out is None:
+                current_em = np.zeros(pos.shape[::2], dtype=np.float32)
+            else:
+                current_em = out
+                current_em[:] = 0
+            if near.size > 0:
+                pos_near = pos[near]
+                if not save_pos:
+                    self._wrap_pos(pos_near, wrap_func)
+                current_em[near] = self._emission(pos_near, psf_lut,
+                                                  workspace=workspace)
+        pos_save = None
+        if save_pos:
+            pos_save = self._radial_pos(pos) if radial else pos
+        return pos_save, current_em
+
+    def _emission(self, pos, psf_lut=False, out=None, workspace=None):
+        """Return the float32 emission for the (wrapped) positions `pos`.
+
+        The emission is written in `out` (allocated if None) with no other
+        temporary arrays except for the radial coordinate and, for
+        the spline evaluation, the PSF values. For the Gaussian PSF the
+        emission is computed from (x, y, z) in a single numexpr pass.
+        If `psf_lut` is True, use the lookup table of the squared PSF.
+        The radial coordinate (and the temporary arrays of the lookup table
+        interpolation) are stored in `workspace` (if not None).
+        """
+        x, y, z = pos[:, 0], pos[:, 1], pos[:, 2]
+        if out is None:
+            out = np.empty(z.shape, dtype=np.float32)
+        if self.psf.kind == 'gauss':
+            return self.psf.emission_xyz(x, y, z, out=out)
+        # Sample the PSF along the trajectories then square to account
+        # for emission and detection PSF.
+        Ro = None
+        if workspace is not None:
+            Ro = workspace.get('Ro', z.shape, pos.dtype)
+        # radial pos. on x-y plane
+        Ro = NE.evaluate('sqrt(x * x + y * y)', out=Ro)
+        if psf_lut:
+            return self.psf.emission_xz(Ro, z, out=out, workspace=workspace)
+        psf = self.psf.eval_xz(Ro, z)
+        return NE.evaluate('psf * psf', out=out, casting='same_kind')
+
+    @staticmethod
+    def _radial_pos(pos):
+        """Return the (radial, z) coordinates from the (x, y, z) `pos`."""
+        Ro = sqrt(pos[:, 0]**2 + pos[:, 1]**2)
+        return np.stack((Ro, pos[:, 2]), axis=1)
+
+    def _sim_trajectories_chunks(self, time_sizes, i_chunk, start_pos, rs,
+                                 total_emission=False, save_pos=False,
+                                 radial=False, wrap_func=wrap_periodic,
+                                 num_threads=1, dtype='float64',
+                                 psf_cull=False, psf_support=None,
+                                 psf_lut=False):
+        """Simulate (in-memory) consecutive chunks of trajectories in parallel.
+
+        The displacements of each chunk are drawn in parallel from the
+        independent streams of `rs` (a :class:`RandomStreams` object).
+        Then, a sequential pass computes the start position of each chunk
+        by adding the final displacement of the previous chunk and applying
+        the boundary conditions. Finally, the trajectories and emission of
+        each chunk are computed in parallel. The result is identical to
+        calling :meth:`_sim_trajectories` for each chunk in sequence.
+
+        Arguments:
+            time_sizes (list): number of time steps of each chunk.
+            i_chunk (int): index of the first chunk.
+            num_threads (int): number of threads simulating chunks in
+                parallel.
+
+        See :meth:`_sim_trajectories` for the other arguments.
+
+        Returns:
+            A list of (POS, em) tuples, one for each chunk, as returned by
+            :meth:`_sim_trajectories`.
+        """
+        if not isinstance(rs, RandomStreams):
+            raise ValueError('Time-parallel simulation requires a '
+                             'RandomStreams object as `rs`.')
+        if getattr(wrap_func, 'reinjects', False):
+            raise ValueError('Time-parallel simulation does not support '
+                             'boundary conditions with reinjection.')
+        num_particles = self.num_particles
+        if psf_cull and psf_support is None:
+            psf_support = self.psf.support_xz(0)
+
+        def sim_displacements(args):
+            k, time_size = args
+            return self._sim_displacements(0, num_particles, int(time_size),
+                                           rs, i_chunk=i_chunk + k,
+                                           dtype=dtype)
+
+        def wrap_emission(args):
+            (pos, _), chunk_start_pos = args
+            pos += chunk_start_pos
+            near = None
+            if psf_cull:
+                near = self._near_support(pos, psf_support, wrap_func)
+            pos_save, current_em = self._wrap_emission(
+                pos, save_pos=save_pos, radial=radial, wrap_func=wrap_func,
+                near=near, psf_lut=psf_lut)
+            if total_emission:
+                em = np.zeros(pos.shape[-1], dtype=np.float32)
+                for current_em_i in _iter_rows(current_em, near):
+                    em += current_em_i
+                current_em = em
+            POS = [pos_save] if save_pos else []
+            return POS, current_em
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            delta_pos = list(executor.map(sim_displacements,
+                                          enumerate(time_sizes)))
+            # Carry propagation: the (wrapped) end position of each chunk
+            # is the start position of the next one.
+            chunks_start_pos = []
+            for _, delta_end in delta_pos:
+                chunks_start_pos.append(start_pos.copy())
+                end_pos = delta_end + start_pos
+                start_pos[:] = self._wrap_pos(end_pos, wrap_func)
+            return list(executor.map(wrap_emission,
+                                     zip(delta_pos, chunks_start_pos)))
+
+    def _iter_sim_trajectories(self, time_sizes, start_pos, rs,
+                               time_parallel=False, num_threads=1,
+                               i_chunk=0, **kwargs):
+        """Iterate over consecutive chunks of simulated trajectories.
+
+        Arguments:
+            time_sizes (iterable): number of time steps of each chunk.
+            i_chunk (int): index of the first chunk.
+            time_parallel (bool): if True, simulate groups of `num_threads`
+                consecutive chunks in parallel (see
+                :meth:`_sim_trajectories_chunks`). Otherwise, simulate
+                one chunk at a time using `num_threads` threads for blocks of
+                particles.
+            workspace (Workspace, list or None): passed to
+                :meth:`_sim_trajectories`. If a list, its workspaces are used
+                in turn by consecutive chunks (e.g. two workspaces for
+                writing a chunk while simulating the next one).
+
+        Other arguments are passed to :meth:`_sim_trajectories`.
+
+        Yields:
+            A tuple (POS, em) for each chunk.
+        """
+        if time_parallel:
+            if kwargs.pop('coarse_step', None) is not None:
+                raise ValueError('`coarse_step` is not supported with '
+                                 '`time_parallel`.')
+            # Chunks simulated in parallel cannot share the buffers
+            kwargs.pop('workspace', None)
+        if not time_parallel:
+            workspaces = kwargs.pop('workspace', None)
+            if not isinstance(workspaces, list):
+                workspaces = [workspaces]
+            chunks = zip(enumerate(time_sizes, i_chunk),
+                         itertools.cycle(workspaces))
+            for (i_chunk, time_size), workspace in chunks:
+                yield self._sim_trajectories(time_size, start_pos, rs,
+                                             i_chunk=i_chunk,
+                                             num_threads=num_threads,
+                                             workspace=workspace, **kwargs)
+        else:
+            time_sizes = list(time_sizes)
+            for i in range(0, len(time_sizes), num_threads):
+                group = time_sizes[i:i + num_threads]
+                yield from self._sim_trajectories_chunks(
+                    group, i_chunk + i, start_pos, rs,
+                    num_threads=num_threads, **kwargs)
 
     def simulate_diffusion(self, save_pos=False, total_emission=True,
                            radial=False, rs=None, seed=1, path='./',
                            wrap_func=wrap_periodic,
-                           chunksize=2**19, chunkslice='times', verbose=True):
+                           chunksize=2**19, chunkslice='times', verbose=True,
+                           random_streams=False, num_threads=1,
+                           time_parallel=False, rng_backend=None,
+                           dtype='float64', coarse_step=None,
+                           psf_support=None, psf_cull=False, psf_lut=False,
+                           sparse=False, sparse_threshold=0, quantize=None,
+                           quantize_max=1., pos_encoding=None,
+                           pyramid_levels=None, checkpoint_every=None,
+                           resume=False, async_write=False, flush_every=1,
+                           backend='hdf5'):
         """Simulate Brownian motion trajectories and emission rates.
 
         This method performs the Brownian motion simulation using the current
@@ -579,23 +1438,155 @@ class ParticlesSimulation(object):
             save_pos (bool): if True, save the particles 3D trajectories
             total_emission (bool): if True, store only the total emission array
                 containing the sum of emission of all the particles.
-            rs (RandomState object): random state object used as random number
-                generator. If None, use a random state initialized from seed.
+            rs (RandomState or Generator object): random state object used
+                as random number generator. If None, use a random state
+                initialized from seed.
             seed (uint): when `rs` is None, `seed` is used to initialize the
                 random state, otherwise is ignored.
-            wrap_func (function): the function used to apply the boundary
-                condition (use :func:`wrap_periodic` or :func:`wrap_mirror`).
+            rng_backend (string): random number generator created when `rs`
+                is None (see :func:`new_rng`). If None, 'legacy' is used,
+                or 'randomstate-pcg64' with `random_streams=True`
+                (see :class:`RandomStreams`).
+            wrap_func (function or Boundary): the function used to apply the
+                boundary condition (use :func:`wrap_periodic`,
+                :func:`wrap_mirror` or the in-place versions in
+                :mod:`pybromo.boundary`), or a `boundary.Boundary` object
+                (e.g. `boundary.Reservoir()`).
             path (string): a folder where simulation data is saved.
             verbose (bool): if False, prints no output.
+            random_streams (bool): if True, use an independent random stream
+                for each particle and chunk, spawned from `seed`
+                (see :class:`RandomStreams`). In this case `rs` must be None.
+            num_threads (int): number of threads used to simulate blocks of
+                particles in parallel. Values larger than 1 require
+                `random_streams=True`. The result is the same for any
+                number of threads.
+            time_parallel (bool): if True, simulate groups of `num_threads`
+                consecutive time chunks in parallel, instead of blocks of
+                particles. Useful when simulating few particles. Requires
+                `random_streams=True` and gives the same result as the
+                simulation parallel on particles.
+            dtype (string): floating point type used to simulate the
+                trajectories, 'float64' (default) or 'float32'. Single
+                precision halves the memory traffic. The particle positions
+                at the chunk boundaries are always kept in double precision
+                so the error does not grow with the simulation duration.
+            coarse_step (int or None): if not None, advance the particles
+                far from the PSF in steps of `coarse_step` time steps
+                (see :meth:`_sim_trajectories`). Requires `save_pos=False`.
+            psf_support (tuple or None): (radial, axial) size in meters of
+                the region where the fine trajectory is computed when
+                `coarse_step` is not None, or where the PSF is evaluated
+                when `psf_cull` is True (see :meth:`_sim_trajectories`).
+            psf_cull (bool): if True, skip the PSF evaluation for the
+                particles that cannot reach the PSF support (by default
+                the PSF grid) during a chunk.
+            psf_lut (bool): if True, compute the emission using a lookup
+                table of the squared PSF (see `NumericPSF.emission_xz`).
+            sparse (bool): if True, store the emission of each particle
+                (and the positions) only in the PSF neighbourhood, i.e. for
+                the samples with emission above `sparse_threshold`
+                (see `storage.SparseArray`). The emission outside the
+                neighbourhood reads as 0 and the positions as NaN.
+                Requires `total_emission=False`.
+            sparse_threshold (float): emission threshold defining the PSF
+                neighbourhood with `sparse=True`. With the default (0)
+                only the zero emission is discarded, which is lossless
+                when the emission is exactly zero far from the PSF
+                (`psf_lut`, `psf_cull` or `coarse_step`, or a PSF with
+                finite support). Larger values cut the storage further.
+            quantize (string or None): if 'uint16' or 'uint8', store the
+                emission as fixed-point integers in units of
+                `scale = quantize_max / (2**bits - 1)`, saved in the 'scale'
+                attribute of the array (see `storage.quantize`). Reading
+                the array returns the integer codes, which are decoded
+                when generating the timestamps. The rounding error on the
+                emission is at most `scale / 2`, so the error on the
+                photon rate of a particle is at most `max_rate * scale / 2`
+                (about 3 cps with 'uint16' and 800 cps with 'uint8' for
+                `max_rate` = 400 kcps and `quantize_max` = 1). Emission
+                below `scale / 2` is stored as 0.
+            quantize_max (float): full-scale of the quantized emission.
+                Larger values are saturated. The emission of a particle is
+                at most 1 (the PSF peak), while the total emission can be
+                larger when particles overlap in the PSF.
+            pos_encoding (string or None): if 'int16', store the positions
+                (when `save_pos` is True) as int16 fixed-point values
+                relative to the box, with a resolution of the box size
+                divided by 65535 (see `storage.FixedPointArray`). Halves
+                the size of the positions. Not compatible with `sparse`.
+            pyramid_levels (list or None): if not None, also store the
+                maximum and mean of the emission in windows of 2**k time
+                steps for each `k` in `pyramid_levels` (e.g. range(4, 16)),
+                see `storage.EmissionPyramid`. Used to read decimated
+                emission (see :meth:`emission_decimated`) without reading
+                the full resolution data. Levels from 4 upwards add less
+                than 1/8 to the emission size.
+            checkpoint_every (int or None): if not None, save a checkpoint
+                every `checkpoint_every` chunks (see
+                `storage.save_checkpoint`). The checkpoint contains the
+                random state, the particles positions (in double precision)
+                and the length of the arrays. A checkpoint is always saved
+                at the end of the simulation (see :meth:`extend`). With
+                `time_parallel`, must be a multiple of `num_threads`.
+            resume (bool): if True and the trajectory file of this
+                simulation (in `path`) has a checkpoint, continue the
+                simulation from the checkpoint, discarding the data
+                written after it. The other arguments must be the same of
+                the interrupted simulation (pass the initial `rs`, or the
+                same `seed`). The result is identical to an uninterrupted
+                simulation. If there is no checkpoint, start a new
+                simulation. Not supported with `pyramid_levels`.
+            async_write (bool): if True, compress and write each chunk in
+                a background thread while the next chunk is simulated
+                (see :class:`pybromo.writer.ChunkWriter`). Errors in the
+                writer thread are raised in the calling thread. The result
+                is the same.
+            flush_every (int or None): flush the file every `flush_every`
+                chunks. If None, flush only at the checkpoints and at the
+                end of the simulation.
+            backend (string): storage backend of the trajectories file,
+                'hdf5', 'npy' or 'chunked' (see :mod:`pybromo.backends`).
         """
-        if rs is None:
-            rs = np.random.RandomState(seed=seed)
-        self.open_store_traj(chunksize=chunksize, chunkslice=chunkslice,
-                             radial=radial, path=path)
-        # Save current random state for reproducibility
-        self.traj_group._v_attrs['init_random_state'] = rs.get_state()
+        if resume and pyramid_levels is not None:
+            raise ValueError('`resume` is not supported with '
+                             '`pyramid_levels`.')
+        if (time_parallel and checkpoint_every is not None and
+                checkpoint_every % num_threads != 0):
+            raise ValueError('`checkpoint_every` must be a multiple of '
+                             '`num_threads` with `time_parallel`.')
+        if sparse and pos_encoding is not None:
+            raise ValueError('`pos_encoding` is not supported with `sparse`.')
+        if sparse and total_emission:
+            raise ValueError('`sparse` requires `total_emission=False`.')
+        if random_streams:
+            if rs is not None:
+                raise ValueError('`rs` must be None when using '
+                                 '`random_streams`, use `seed` instead.')
+            rs = RandomStreams(seed, backend=rng_backend or
+                               'randomstate-pcg64')
+        elif rs is None:
+            rs = new_rng(seed, backend=rng_backend or 'legacy')
+        checkpoint = None
+        if resume:
+            checkpoint = self._resume_store_traj(path, backend)
+        if checkpoint is None:
+            self.open_store_traj(chunksize=chunksize, chunkslice=chunkslice,
+                                 radial=radial, path=path, sparse=sparse,
+                                 quantize=quantize, quantize_max=quantize_max,
+                                 pos_encoding=pos_encoding, backend=backend)
+            # Save current random state for reproducibility
+            self.traj_group._v_attrs['init_random_state'] = get_rng_state(rs)
 
         em_store = self.emission_tot if total_emission else self.emission
+        pyramid = None
+        if pyramid_levels is not None:
+            pyramid = self.store.add_emission_pyramid(
+                em_store, pyramid_levels, chunksize=self.chunksize)
+            if total_emission:
+                self.emission_tot_pyramid = pyramid
+            else:
+                self.emission_pyramid = pyramid
 
         print('- Start trajectories simulation - %s' % ctime(), flush=True)
         if verbose:
@@ -605,35 +1596,222 @@ class ParticlesSimulation(object):
         chunk_duration = t_chunk_size * self.t_step
 
         par_start_pos = self.particles.positions
+        if checkpoint is not None:
+            i_chunk = self._restore_traj_checkpoint(checkpoint, rs, wrap_func,
+                                                    total_emission, save_pos)
+            par_start_pos = checkpoint['positions']
         prev_time = 0
-        for time_size in iter_chunksize(self.n_samples, t_chunk_size):
-            if verbose:
-                curr_time = int(chunk_duration * (i_chunk + 1))
-                if curr_time > prev_time:
-                    print(' %ds' % curr_time, end='', flush=True)
-                    prev_time = curr_time
-
-            POS, em = self._sim_trajectories(time_size, par_start_pos, rs,
-                                             total_emission=total_emission,
-                                             save_pos=save_pos, radial=radial,
-                                             wrap_func=wrap_func)
-
+        # The arrays are shorter than `i_chunk * t_chunk_size` when the
+        # simulation has been extended (see `extend`)
+        time_sizes = iter_chunksize(self.n_samples - em_store.nrows,
+                                    t_chunk_size)
+        workspace = self.workspace
+        if async_write:
+            # The emission of a chunk is written while the next one is
+            # simulated in a second buffer
+            workspace = [self.workspace, Workspace()]
+        trajectories = self._iter_sim_trajectories(
+            time_sizes, par_start_pos, rs, i_chunk=i_chunk,
+            total_emission=total_emission,
+            save_pos=save_pos, radial=radial, wrap_func=wrap_func,
+            num_threads=num_threads, time_parallel=time_parallel,
+            dtype=dtype, coarse_step=coarse_step, psf_support=psf_support,
+            psf_cull=psf_cull, psf_lut=psf_lut, workspace=workspace)
+
+        def write_chunk(POS, em):
             ## Append em to the permanent storage
             # if total_emission, data is just a linear array
             # otherwise is a 2-D array (self.num_particles, c_size)
-            em_store.append(em)
-            if save_pos:
-                self.position.append(np.vstack(POS).astype('float32'))
-            i_chunk += 1
-            self.store.h5file.flush()
-
+            em_data = em
+            if quantize is not None:
+                em_data = quantize_em(em, emission_scale(em_store), quantize)
+            if sparse:
+                # Samples in the PSF neighbourhood
+                mask = em > sparse_threshold
+            if pyramid is not None:
+                # The levels are built from the emission as it is stored
+                em_stored = em
+                if quantize is not None:
+                    em_stored = em_data * np.float32(emission_scale(em_store))
+                if sparse:
+                    em_stored = np.where(mask, em_stored, 0)
+                pyramid.append(em_stored)
+            if sparse:
+                em_store.append(em_data, mask=mask)
+                if save_pos:
+                    self.position.append(np.vstack(POS), mask=mask)
+            else:
+                em_store.append(em_data)
+                if save_pos:
+                    pos = np.vstack(POS)
+                    if pos_encoding is None:
+                        pos = pos.astype('float32')
+                    # Encoded positions are quantized in double precision
+                    self.position.append(pos)
+
+        with ChunkWriter(self.store.h5file, flush_every=flush_every,
+                         background=async_write) as writer:
+            for POS, em in trajectories:
+                if verbose:
+                    curr_time = int(chunk_duration * (i_chunk + 1))
+                    if curr_time > prev_time:
+                        print(' %ds' % curr_time, end='', flush=True)
+                        prev_time = curr_time
+
+                writer.submit(write_chunk, POS, em)
+                i_chunk += 1
+                if checkpoint_every is not None and \
+                        i_chunk % checkpoint_every == 0:
+                    writer.wait()
+                    self._save_traj_checkpoint(i_chunk, par_start_pos, rs,
+                                               wrap_func, total_emission,
+                                               save_pos)
+
+        self._save_traj_checkpoint(i_chunk, par_start_pos, rs, wrap_func,
+                                   total_emission, save_pos)
         # Save current random state
-        self.traj_group._v_attrs['last_random_state'] = rs.get_state()
+        self.traj_group._v_attrs['last_random_state'] = get_rng_state(rs)
         self.store.h5file.flush()
         print('\n- End trajectories simulation - %s' % ctime(), flush=True)
 
+    def extend(self, t_extra, wrap_func=wrap_periodic, verbose=True,
+               **kwargs):
+        """Extend the simulation duration by `t_extra` seconds.
+
+        The simulation continues from the final particles positions and
+        random state saved at the end of :meth:`simulate_diffusion` (the
+        last checkpoint), and the new emission and positions are appended
+        to the existing arrays. The storage options (`total_emission`,
+        `save_pos`, `radial`, `sparse`, `quantize` and `pos_encoding`)
+        are the ones of the stored arrays. `t_max` and `n_samples` are
+        updated in '/parameters'. The hash and the file names (also of the
+        timestamps files created later) use the original duration, saved
+        as 't_max_name' in '/parameters'.
+        The computation time is proportional to `t_extra`.
+
+        Since the last chunk of the original simulation is usually shorter
+        than the others, the result is statistically equivalent, but not
+        identical, to a single simulation of the total duration.
+
+        Arguments:
+            t_extra (float): additional simulation time (seconds).
+            wrap_func (function or Boundary): the boundary conditions,
+                which must be the same of the original simulation.
+            verbose (bool): if False, prints no output.
+            kwargs: other arguments passed to :meth:`simulate_diffusion`
+                (e.g. `num_threads` or `dtype`).
+        """
+        checkpoint = load_checkpoint(self.store.h5file, 'trajectories')
+        if checkpoint is None:
+            raise ValueError('The trajectory file has no checkpoint. Only '
+                             'simulations saved with a checkpoint at the end '
+                             'can be extended.')
+        if self.emission_pyramid is not None or \
+                self.emission_tot_pyramid is not None:
+            raise ValueError('Cannot extend a simulation with an emission '
+                             'pyramid.')
+        if self.store.h5file.mode == 'r':
+            filepath = self.store.filepath
+            self.store.close()
+            self.store = TrajectoryStore(filepath, mode='a')
+            self.psf_pytables = self.store.h5file.get_node('/psf/default_psf')
+            self._load_traj_arrays()
+
+        self.t_max += t_extra
+        self.n_samples = int(self.t_max / self.t_step)
+        nparams = self.numeric_params
+        nparams['t_max_name'] = (self.t_max_name,
+                                 'Simulation time used in the file names (s)')
+        self.store.update_sim_params({name: nparams[name] for name in
+                                      ('t_max', 'n_samples', 't_max_name')})
+
+        em_store = self.emission_tot if checkpoint['total_emission'] else \
+            self.emission
+        quantize = None
+        if em_store.dtype.kind == 'u':
+            quantize = em_store.dtype.name
+        pos_encoding = None
+        if isinstance(getattr(self, 'position', None), FixedPointArray):
+            pos_encoding = 'int16'
+        self.simulate_diffusion(
+            save_pos=checkpoint['save_pos'],
+            total_emission=checkpoint['total_emission'],
+            rs=rng_from_state(checkpoint['rng_state']), wrap_func=wrap_func,
+            verbose=verbose, radial='position_rz' in self.traj_group,
+            sparse=isinstance(self.emission, SparseArray), quantize=quantize,
+            pos_encoding=pos_encoding, resume=True, **kwargs)
+
+    def _resume_store_traj(self, path='./', backend='hdf5'):
+        """Open the trajectory file to resume the simulation.
+
+        Returns:
+            The last checkpoint in the trajectory file (see
+            `storage.load_checkpoint`), or None if the file or the
+            checkpoint do not exist. In this case the file is not opened.
+        """
+        if hasattr(self, 'store'):
+            return load_checkpoint(self.store.h5file, 'trajectories')
+        filepath = Path(path, '%s_%s%s' % (ParticlesSimulation._PREFIX_TRAJ,
+                                           self.compact_name(),
+                                           SUFFIXES[backend]))
+        if not filepath.exists():
+            return None
+        store = TrajectoryStore(filepath, mode='a')
+        checkpoint = load_checkpoint(store.h5file, 'trajectories')
+        if checkpoint is None:
+            store.close()
+            return None
+        self.store = store
+        self.chunksize = int(store.numeric_params['chunksize'])
+        self.psf_pytables = store.h5file.get_node('/psf/default_psf')
+        self._load_traj_arrays()
+        return checkpoint
+
+    def _traj_arrays(self):
+        """Return the emission and position arrays."""
+        arrays = [self.emission, self.emission_tot]
+        if hasattr(self, 'position'):
+            arrays.append(self.position)
+        return arrays
+
+    def _save_traj_checkpoint(self, i_chunk, start_pos, rs, wrap_func,
+                              total_emission, save_pos):
+        """Save a checkpoint after `i_chunk` chunks of trajectories."""
+        nrows = {array.name: array.nrows for array in self._traj_arrays()}
+        attrs = dict(i_chunk=i_chunk, total_emission=total_emission,
+                     save_pos=save_pos)
+        if hasattr(wrap_func, 'rs'):
+            # Boundary conditions drawing random numbers (e.g. Reservoir)
+            attrs['wrap_rng_state'] = get_rng_state(wrap_func.rs)
+        save_checkpoint(self.store.h5file, 'trajectories', start_pos,
+                        get_rng_state(rs), nrows, **attrs)
+
+    def _restore_traj_checkpoint(self, checkpoint, rs, wrap_func,
+                                 total_emission, save_pos):
+        """Restore the state saved in `checkpoint` and return the number
+        of chunks already simulated.
+
+        The random states of `rs` (and of `wrap_func`, if any) are set and
+        the data written after the checkpoint is removed.
+        """
+        if (checkpoint['total_emission'] != total_emission or
+                checkpoint['save_pos'] != save_pos):
+            raise ValueError('The checkpoint was saved by a simulation with '
+                             'different `total_emission` or `save_pos`.')
+        if self.emission_pyramid is not None or \
+                self.emission_tot_pyramid is not None:
+            raise ValueError('Cannot resume a simulation with an emission '
+                             'pyramid.')
+        set_rng_state(rs, checkpoint['rng_state'])
+        if 'wrap_rng_state' in checkpoint:
+            set_rng_state(wrap_func.rs, checkpoint['wrap_rng_state'])
+        for array in self._traj_arrays():
+            array.truncate(checkpoint['nrows'][array.name])
+        return checkpoint['i_chunk']
+
     def _get_ts_name_mix_core(self, max_rates, populations, bg_rate,
-                              timeslice=None):
+                              timeslice=None, method='poisson',
+                              split_channels=False, single_pass=False):
         if timeslice is None:
             timeslice = self.t_max
         s = []
@@ -644,19 +1822,34 @@ class ParticlesSimulation(object):
                      'max_rate{max_rate:.0f}cps_BG{bg_rate:.0f}cps'
                      .format(**kw))
         s.append('t_{}s'.format(timeslice))
+        if method != 'poisson':
+            # Names of 'poisson' timestamps are the same of older versions
+            s.append(method)
+        if split_channels:
+            s.append('split')
+        if single_pass:
+            s.append('single_pass')
         return '_'.join(s)
 
     def _get_ts_name_mix(self, max_rates, populations, bg_rate, rs,
-                         hashsize=6):
-        s = self._get_ts_name_mix_core(max_rates, populations, bg_rate)
-        return '%s_rs_%s' % (s, hash_(rs.get_state())[:hashsize])
+                         hashsize=6, method='poisson', split_channels=False,
+                         single_pass=False):
+        s = self._get_ts_name_mix_core(max_rates, populations, bg_rate,
+                                       method=method,
+                                       split_channels=split_channels,
+                                       single_pass=single_pass)
+        return '%s_rs_%s' % (s, hash_(get_rng_state(rs))[:hashsize])
 
     def timestamps_match_pattern(self, pattern):
         return [t for t in self.timestamp_names if pattern in t]
 
     def timestamps_match_mix(self, max_rates, populations, bg_rate,
-                             hash_=None):
-        pattern = self._get_ts_name_mix_core(max_rates, populations, bg_rate)
+                             hash_=None, method='poisson',
+                             split_channels=False, single_pass=False):
+        pattern = self._get_ts_name_mix_core(max_rates, populations, bg_rate,
+                                             method=method,
+                                             split_channels=split_channels,
+                                             single_pass=single_pass)
         if hash_ is not None:
             pattern = '_'.join([pattern, 'rs', hash_])
         return self.timestamps_match_pattern(pattern)
@@ -679,57 +1872,75 @@ class ParticlesSimulation(object):
         return names
 
     def _sim_timestamps(self, max_rate, bg_rate, emission, i_start, rs,
-                        ip_start=0, scale=10, sort=True):
+                        ip_start=0, scale=10, sort=True, em_scale=1,
+                        method='poisson'):
         """Simulate timestamps from emission trajectories.
 
-        Uses attributes: `.t_step`.
+        Uses attributes: `.t_step`, `.workspace`.
+        The emission is `emission * em_scale`, where `em_scale` is the
+        unit of a quantized `emission` (see `storage.quantize`).
+        The photons are drawn with :func:`sim_timetrace_bg` when `method`
+        is 'poisson' or with :func:`sim_photons_thinning` when `method` is
+        'thinning'.
+        If `sort` is True, the timestamps are sorted (equal timestamps are
+        ordered by particle), otherwise they are ordered by particle.
 
         Returns:
             A tuple of two arrays: timestamps and particles.
         """
-        counts_chunk = sim_timetrace_bg(emission, max_rate, bg_rate,
-                                        self.t_step, rs=rs)
-        nrows = emission.shape[0]
-        if bg_rate is not None:
-            nrows += 1
-        assert counts_chunk.shape == (nrows, emission.shape[1])
-        max_counts = counts_chunk.max()
-        if max_counts == 0:
+        # Quantized emission is decoded in the conversion to rates
+        if method == 'poisson':
+            counts_chunk = sim_timetrace_bg(emission, max_rate * em_scale,
+                                            bg_rate, self.t_step, rs=rs,
+                                            workspace=self.workspace)
+            nrows = emission.shape[0]
+            if bg_rate is not None:
+                nrows += 1
+            assert counts_chunk.shape == (nrows, emission.shape[1])
+            if sort:
+                # Bins with counts, ordered by time and then by particle.
+                # Only the columns with counts are transposed.
+                nonzero_bins = np.flatnonzero(counts_chunk.any(axis=0))
+                counts_chunk = counts_chunk[:, nonzero_bins]
+                bins, particles = np.nonzero(counts_chunk.T)
+                counts = counts_chunk[particles, bins]
+                bins = nonzero_bins[bins]
+            else:
+                # Bins with counts, ordered by particle and then by time
+                particles, bins = np.nonzero(counts_chunk)
+                counts = counts_chunk[particles, bins]
+            if counts.sum() > counts.size:
+                # A timestamp for each count: a bin with n counts is
+                # repeated, written directly in the output arrays
+                particles = repeat_counts(particles, counts, 'u1')
+                bins = repeat_counts(bins, counts, 'int64')
+        elif method == 'thinning':
+            particles, bins = sim_photons_thinning(
+                emission, max_rate * em_scale, bg_rate, self.t_step, rs=rs,
+                time_order=sort)
+        else:
+            raise ValueError('Unknown timestamps method "%s", valid values '
+                             "are 'poisson' and 'thinning'." % method)
+        if bins.size == 0:
             return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
 
-        time_start = i_start * scale
-        time_stop = time_start + counts_chunk.shape[1] * scale
-        ts_range = np.arange(time_start, time_stop, scale, dtype='int64')
-
-        # Loop for each particle to compute timestamps
-        times_chunk_p = []
-        par_index_chunk_p = []
-        for ip, counts_chunk_ip in enumerate(counts_chunk):
-            # Compute timestamps for particle ip for all bins with counts
-            times_c_ip = []
-            for v in range(1, max_counts + 1):
-                times_c_ip.append(ts_range[counts_chunk_ip >= v])
-
-            # Stack the timestamps from different "counts"
-            t = np.hstack(times_c_ip)
-            # Append current particle
-            times_chunk_p.append(t)
-            par_index_chunk_p.append(np.full(t.size, ip + ip_start, dtype='u1'))
-
-        # Merge the arrays of different particles
-        times_chunk = np.hstack(times_chunk_p)
-        par_index_chunk = np.hstack(par_index_chunk_p)
-
-        if sort:
-            # Sort timestamps inside the merged chunk
-            index_sort = times_chunk.argsort(kind='mergesort')
-            times_chunk = times_chunk[index_sort]
-            par_index_chunk = par_index_chunk[index_sort]
-
+        bins *= scale
+        bins += int(i_start * scale)
+        times_chunk = bins.astype('int64', copy=False)
+        particles += ip_start
+        par_index_chunk = particles.astype('u1', copy=False)
         return times_chunk, par_index_chunk
 
+    def _read_emission(self, i_start, i_end):
+        """Read the emission chunk `i_start:i_end` in a workspace buffer."""
+        em_chunk = self.workspace.get(
+            'em_chunk', (self.num_particles, i_end - i_start),
+            self.emission.dtype)
+        return self.emission.read(i_start, i_end, out=em_chunk)
+
     def _sim_timestamps_populations(self, emission, max_rates, populations,
-                                    bg_rates, i_start, rs, scale=10):
+                                    bg_rates, i_start, rs, scale=10,
+                                    em_scale=1, method='poisson'):
             # Loop for each population
             ts_chunk_pop_list, par_index_chunk_pop_list = [], []
             for rate, pop, bg in zip(max_rates, populations, bg_rates):
@@ -737,26 +1948,65 @@ class ParticlesSimulation(object):
                 ts_chunk_pop, par_index_chunk_pop = \
                     self._sim_timestamps(
                         rate, bg, emission_pop, i_start, ip_start=pop.start,
-                        rs=rs, scale=scale, sort=False)
+                        rs=rs, scale=scale, sort=True, em_scale=em_scale,
+                        method=method)
 
                 ts_chunk_pop_list.append(ts_chunk_pop)
                 par_index_chunk_pop_list.append(par_index_chunk_pop)
 
-            # Merge populations
-            times_chunk_s = np.hstack(ts_chunk_pop_list)
-            par_index_chunk_s = np.hstack(par_index_chunk_pop_list)
+            # Merge the sorted timestamps of the populations
+            return merge_timestamps(ts_chunk_pop_list,
+                                    par_index_chunk_pop_list)
 
-            # Sort timestamps inside the merged chunk
-            index_sort = times_chunk_s.argsort(kind='mergesort')
-            times_chunk_s = times_chunk_s[index_sort]
-            par_index_chunk_s = par_index_chunk_s[index_sort]
-            return times_chunk_s, par_index_chunk_s
+    def _sim_timestamps_channels(self, emission, max_rates, populations,
+                                 bg_rates, i_start, rs, scale=10,
+                                 em_scale=1, method='poisson'):
+        """Simulate the timestamps of N channels drawing the photons once.
+
+        `max_rates` and `bg_rates` have one item per channel, each item is a
+        list of rates per population as in
+        :meth:`_sim_timestamps_populations`. The photons of each population
+        are drawn from the sum of the rates of all the channels and then
+        split in the channels by :func:`split_photons`. The same is done
+        for the background.
+
+        Returns:
+            A list of tuples (timestamps, particles), one for each channel.
+        """
+        max_rates = np.asarray(max_rates, dtype='float64')
+        bg_rates = np.array([[0 if bg is None else bg for bg in bg_rates_ch]
+                             for bg_rates_ch in bg_rates], dtype='float64')
+        num_channels = max_rates.shape[0]
+        ts_chunk_list = [[] for _ in range(num_channels)]
+        par_index_chunk_list = [[] for _ in range(num_channels)]
+        for i_pop, pop in enumerate(populations):
+            emission_pop = emission[pop]
+            bg = bg_rates[:, i_pop].sum()
+            ts_chunk_pop, par_index_chunk_pop = self._sim_timestamps(
+                max_rates[:, i_pop].sum(), bg if bg > 0 else None,
+                emission_pop, i_start, ip_start=pop.start, rs=rs,
+                scale=scale, em_scale=em_scale, method=method)
+
+            # Row 0: particles fractions, row 1: background fractions
+            fractions = np.vstack([_channel_fractions(max_rates[:, i_pop]),
+                                   _channel_fractions(bg_rates[:, i_pop])])
+            is_bg = par_index_chunk_pop == pop.start + emission_pop.shape[0]
+            channels = split_photons(is_bg.astype('u1'), fractions, rs)
+            for i_ch in range(num_channels):
+                mask = channels == i_ch
+                ts_chunk_list[i_ch].append(ts_chunk_pop[mask])
+                par_index_chunk_list[i_ch].append(par_index_chunk_pop[mask])
+
+        return [merge_timestamps(ts_chunk_ch, par_index_chunk_ch)
+                for ts_chunk_ch, par_index_chunk_ch in
+                zip(ts_chunk_list, par_index_chunk_list)]
 
     def simulate_timestamps_mix(self, max_rates, populations, bg_rate,
                                 rs=None, seed=1, chunksize=2**16,
                                 comp_filter=None, overwrite=False,
                                 skip_existing=False, scale=10,
-                                path=None, t_chunksize=None, timeslice=None):
+                                path=None, t_chunksize=None, timeslice=None,
+                                rng_backend='legacy', method='poisson'):
         """Compute one timestamps array for a mixture of N populations.
 
         Timestamp data are saved to disk and accessible as pytables arrays in
@@ -770,10 +2020,13 @@ class ParticlesSimulation(object):
             populations (list of slices): slices to `self.particles`
                 defining each population.
             bg_rate (float, cps): rate for a Poisson background process
-            rs (RandomState object): random state object used as random number
-                generator. If None, use a random state initialized from seed.
+            rs (RandomState or Generator object): random state object used
+                as random number generator. If None, use a random state
+                initialized from seed.
             seed (uint): when `rs` is None, `seed` is used to initialize the
                 random state, otherwise is ignored.
+            rng_backend (string): random number generator created when `rs`
+                is None (see :func:`new_rng`).
             chunksize (int): chunk size used for the on-disk timestamp array
             comp_filter (tables.Filter or None): compression filter to use
                 for the on-disk `timestamps` and `tparticles` arrays.
@@ -788,16 +2041,26 @@ class ParticlesSimulation(object):
             path (string): folder where to save the data.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            method (string): method used to draw the photons, 'poisson'
+                (a Poisson number for each time bin, see
+                :func:`sim_timetrace_bg`) or 'thinning' (cost proportional
+                to the number of photons, see :func:`sim_photons_thinning`).
+                The two methods give different (statistically equivalent)
+                timestamps for the same random state, so a method other
+                than 'poisson' is added to the timestamps array name. The
+                method is also saved in the 'method' attribute of the array.
         """
         self.open_store_timestamp(chunksize=chunksize, path=path)
-        rs = self._get_group_randomstate(rs, seed, self.ts_group)
+        rs = self._get_group_randomstate(rs, seed, self.ts_group,
+                                         rng_backend)
         if t_chunksize is None:
             t_chunksize = self.emission.chunkshape[1]
         timeslice_size = self.n_samples
         if timeslice is not None:
             timeslice_size = timeslice // self.t_step
 
-        name = self._get_ts_name_mix(max_rates, populations, bg_rate, rs=rs)
+        name = self._get_ts_name_mix(max_rates, populations, bg_rate, rs=rs,
+                                     method=method)
         kw = dict(name=name, clk_p=self.t_step / scale,
                   max_rates=max_rates, bg_rate=bg_rate, populations=populations,
                   num_particles=self.num_particles,
@@ -815,14 +2078,16 @@ class ParticlesSimulation(object):
             else:
                 raise e
 
-        self.ts_group._v_attrs['init_random_state'] = rs.get_state()
-        self._timestamps.attrs['init_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['init_random_state'] = get_rng_state(rs)
+        self._timestamps.attrs['init_random_state'] = get_rng_state(rs)
         self._timestamps.attrs['PyBroMo'] = __version__
+        self._timestamps.attrs['method'] = method
 
         ts_list, part_list = [], []
         # Load emission in chunks, and save only the final timestamps
         bg_rates = [None] * (len(max_rates) - 1) + [bg_rate]
         prev_time = 0
+        em_scale = emission_scale(self.emission)
         for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
 
             curr_time = np.around(i_start * self.t_step, decimals=0)
@@ -830,12 +2095,12 @@ class ParticlesSimulation(object):
                 print(' %.1fs' % curr_time, end='', flush=True)
                 prev_time = curr_time
 
-            em_chunk = self.emission[:, i_start:i_end]
+            em_chunk = self._read_emission(i_start, i_end)
 
             times_chunk_s, par_index_chunk_s = \
                 self._sim_timestamps_populations(
                     em_chunk, max_rates, populations, bg_rates, i_start,
-                    rs, scale)
+                    rs, scale, em_scale=em_scale, method=method)
 
             # Save sorted timestamps (suffix '_s') and corresponding particles
             ts_list.append(times_chunk_s)
@@ -846,8 +2111,8 @@ class ParticlesSimulation(object):
             self._tparticles.append(part)
 
         # Save current random state so it can be resumed in the next session
-        self.ts_group._v_attrs['last_random_state'] = rs.get_state()
-        self._timestamps.attrs['last_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['last_random_state'] = get_rng_state(rs)
+        self._timestamps.attrs['last_random_state'] = get_rng_state(rs)
         self.ts_store.h5file.flush()
 
     def simulate_timestamps_mix_da(self, max_rates_d, max_rates_a,
@@ -856,7 +2121,9 @@ class ParticlesSimulation(object):
                                    comp_filter=None, overwrite=False,
                                    skip_existing=False, scale=10,
                                    path=None, t_chunksize=2**19,
-                                   timeslice=None):
+                                   timeslice=None,
+                                   rng_backend='legacy', method='poisson',
+                                   split_channels=False, rs_a=None):
 
         """Compute D and A timestamps arrays for a mixture of N populations.
 
@@ -879,10 +2146,13 @@ class ParticlesSimulation(object):
                 in the donor channel.
             bg_rate_a (float, cps): rate for a Poisson background process
                 in the acceptor channel.
-            rs (RandomState object): random state object used as random number
-                generator. If None, use a random state initialized from seed.
+            rs (RandomState or Generator object): random state object used
+                as random number generator. If None, use a random state
+                initialized from seed.
             seed (uint): when `rs` is None, `seed` is used to initialize the
                 random state, otherwise is ignored.
+            rng_backend (string): random number generator created when `rs`
+                is None (see :func:`new_rng`).
             chunksize (int): chunk size used for the on-disk timestamp array
             comp_filter (tables.Filter or None): compression filter to use
                 for the on-disk `timestamps` and `tparticles` arrays.
@@ -897,17 +2167,55 @@ class ParticlesSimulation(object):
             path (string): folder where to save the data.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            method (string): method used to draw the photons, 'poisson'
+                (a Poisson number for each time bin, see
+                :func:`sim_timetrace_bg`) or 'thinning' (cost proportional
+                to the number of photons, see :func:`sim_photons_thinning`).
+                The two methods give different (statistically equivalent)
+                timestamps for the same random state, so a method other
+                than 'poisson' is added to the timestamps array name. The
+                method is also saved in the 'method' attribute of the array.
+            split_channels (bool): if True, the photons are drawn once from
+                the sum of D and A rates and then each photon is randomly
+                assigned to D or A (see :meth:`_sim_timestamps_channels`).
+                If False, D and A photons are drawn separately. The two
+                options give different (statistically equivalent) timestamps,
+                so 'split' is added to the timestamps array names when True.
+                The option is also saved in the 'split_channels' attribute
+                of the arrays.
+            rs_a (RandomState or Generator object or None): if not None,
+                random state object used for the acceptor timestamps, while
+                `rs` is used only for the donor timestamps. In this case,
+                the donor timestamps are the same as computed by
+                :meth:`simulate_timestamps_mix` with the same `rs` and
+                `t_chunksize`. The acceptor timestamps are a different
+                family from the ones starting from the last random state
+                of the donor: 'single_pass' is added to their name and
+                their 'single_pass' attribute is True.
+                Not supported with `split_channels`.
         """
         self.open_store_timestamp(chunksize=chunksize, path=path)
-        rs = self._get_group_randomstate(rs, seed, self.ts_group)
+        rs = self._get_group_randomstate(rs, seed, self.ts_group,
+                                         rng_backend)
+        if rs_a is not None and split_channels:
+            raise ValueError('Arguments `rs_a` and `split_channels` cannot '
+                             'be used together.')
+        rs_d = rs
+        single_pass = rs_a is not None
+        if rs_a is None:
+            rs_a = rs
         if t_chunksize is None:
             t_chunksize = self.emission.chunkshape[1]
         timeslice_size = self.n_samples
         if timeslice is not None:
             timeslice_size = timeslice // self.t_step
 
-        name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs)
-        name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a, rs)
+        name_kw = dict(method=method, split_channels=split_channels)
+        name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs,
+                                       **name_kw)
+        name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a,
+                                       rs_a, single_pass=single_pass,
+                                       **name_kw)
 
         kw = dict(clk_p=self.t_step / scale,
                   populations=populations,
@@ -939,16 +2247,21 @@ class ParticlesSimulation(object):
             else:
                 raise e
 
-        self.ts_group._v_attrs['init_random_state'] = rs.get_state()
-        self._timestamps_d.attrs['init_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['init_random_state'] = get_rng_state(rs)
+        self._timestamps_d.attrs['init_random_state'] = get_rng_state(rs)
         self._timestamps_d.attrs['PyBroMo'] = __version__
-        self._timestamps_a.attrs['init_random_state'] = rs.get_state()
+        self._timestamps_a.attrs['init_random_state'] = get_rng_state(rs_a)
         self._timestamps_a.attrs['PyBroMo'] = __version__
+        for ts in (self._timestamps_d, self._timestamps_a):
+            ts.attrs['method'] = method
+            ts.attrs['split_channels'] = split_channels
+        self._timestamps_a.attrs['single_pass'] = single_pass
 
         # Load emission in chunks, and save only the final timestamps
         bg_rates_d = [None] * (len(max_rates_d) - 1) + [bg_rate_d]
         bg_rates_a = [None] * (len(max_rates_a) - 1) + [bg_rate_a]
         prev_time = 0
+        em_scale = emission_scale(self.emission)
         for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
 
             curr_time = np.around(i_start * self.t_step, decimals=1)
@@ -956,17 +2269,25 @@ class ParticlesSimulation(object):
                 print(' %.1fs' % curr_time, end='', flush=True)
                 prev_time = curr_time
 
-            em_chunk = self.emission[:, i_start:i_end]
+            em_chunk = self._read_emission(i_start, i_end)
 
-            times_chunk_s_d, par_index_chunk_s_d = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_d, populations, bg_rates_d, i_start,
-                    rs, scale)
+            if split_channels:
+                ((times_chunk_s_d, par_index_chunk_s_d),
+                 (times_chunk_s_a, par_index_chunk_s_a)) = \
+                    self._sim_timestamps_channels(
+                        em_chunk, (max_rates_d, max_rates_a), populations,
+                        (bg_rates_d, bg_rates_a), i_start, rs, scale,
+                        em_scale=em_scale, method=method)
+            else:
+                times_chunk_s_d, par_index_chunk_s_d = \
+                    self._sim_timestamps_populations(
+                        em_chunk, max_rates_d, populations, bg_rates_d,
+                        i_start, rs_d, scale, em_scale=em_scale, method=method)
 
-            times_chunk_s_a, par_index_chunk_s_a = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_a, populations, bg_rates_a, i_start,
-                    rs, scale)
+                times_chunk_s_a, par_index_chunk_s_a = \
+                    self._sim_timestamps_populations(
+                        em_chunk, max_rates_a, populations, bg_rates_a,
+                        i_start, rs_a, scale, em_scale=em_scale, method=method)
 
             # Save sorted timestamps (suffix '_s') and corresponding particles
             self._timestamps_d.append(times_chunk_s_d)
@@ -975,8 +2296,11 @@ class ParticlesSimulation(object):
             self._tparticles_a.append(par_index_chunk_s_a)
 
         # Save current random state so it can be resumed in the next session
-        self.ts_group._v_attrs['last_random_state'] = rs.get_state()
-        self._timestamps_d._v_attrs['last_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['last_random_state'] = get_rng_state(rs)
+        self._timestamps_d._v_attrs['last_random_state'] = get_rng_state(rs)
+        if rs_a is not rs:
+            self._timestamps_a._v_attrs['last_random_state'] = \
+                get_rng_state(rs_a)
         self.ts_store.h5file.flush()
 
     def simulate_timestamps_mix_da_online(self, max_rates_d, max_rates_a,
@@ -985,7 +2309,11 @@ class ParticlesSimulation(object):
                                  comp_filter=None, overwrite=False,
                                  skip_existing=False, scale=10,
                                  path=None, t_chunksize=2**19,
-                                 timeslice=None):
+                                 timeslice=None,
+                                 rng_backend='legacy', checkpoint_every=None,
+                                 resume=False, async_write=False,
+                                 flush_every=None, method='poisson',
+                                 split_channels=False):
         """Compute D and A timestamps arrays for a mixture of N populations.
 
         This method simulates the diffusion, emission and generates a pair
@@ -1003,10 +2331,13 @@ class ParticlesSimulation(object):
             populations (list of slices): slices to `self.particles`
                 defining each population.
             bg_rate (float, cps): rate for a Poisson background process
-            rs (RandomState object): random state object used as random number
-                generator. If None, use a random state initialized from seed.
+            rs (RandomState or Generator object): random state object used
+                as random number generator. If None, use a random state
+                initialized from seed.
             seed (uint): when `rs` is None, `seed` is used to initialize the
                 random state, otherwise is ignored.
+            rng_backend (string): random number generator created when `rs`
+                is None (see :func:`new_rng`).
             chunksize (int): chunk size used for the on-disk timestamp array
             comp_filter (tables.Filter or None): compression filter to use
                 for the on-disk `timestamps` and `tparticles` arrays.
@@ -1021,17 +2352,157 @@ class ParticlesSimulation(object):
             path (string): folder where to save the data.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            method (string): method used to draw the photons, 'poisson'
+                (a Poisson number for each time bin, see
+                :func:`sim_timetrace_bg`) or 'thinning' (cost proportional
+                to the number of photons, see :func:`sim_photons_thinning`).
+                The two methods give different (statistically equivalent)
+                timestamps for the same random state, so a method other
+                than 'poisson' is added to the timestamps array name. The
+                method is also saved in the 'method' attribute of the array.
+            split_channels (bool): if True, the photons are drawn once from
+                the sum of D and A rates and then each photon is randomly
+                assigned to D or A (see :meth:`_sim_timestamps_channels`).
+                If False, D and A photons are drawn separately. The two
+                options give different (statistically equivalent) timestamps,
+                so 'split' is added to the timestamps array names when True.
+                The option is also saved in the 'split_channels' attribute
+                of the arrays.
+            checkpoint_every (int or None): if not None, save a checkpoint
+                (random state, particles positions and arrays length)
+                every `checkpoint_every` chunks in the timestamps file.
+            resume (bool): if True and the timestamps file has a checkpoint
+                for the same timestamps arrays, continue from the
+                checkpoint (see `simulate_diffusion`). Pass the initial
+                `rs`, which determines the arrays names.
+            async_write (bool): if True, write the timestamps of each chunk
+                in a background thread while the next chunk is simulated
+                (see :class:`pybromo.writer.ChunkWriter`).
+            flush_every (int or None): if not None, flush the file every
+                `flush_every` chunks.
         """
-        self.open_store_timestamp(chunksize=chunksize, path=path)
-        rs = self._get_group_randomstate(rs, seed, self.ts_group)
+        self.open_store_timestamp(chunksize=chunksize, path=path,
+                                  mode='a' if resume else 'w')
+        rs = self._get_group_randomstate(rs, seed, self.ts_group,
+                                         rng_backend)
         if t_chunksize is None:
             t_chunksize = 2**19
         timeslice_size = self.n_samples
         if timeslice is not None:
             timeslice_size = timeslice // self.t_step
 
-        name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs)
-        name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a, rs)
+        name_kw = dict(method=method, split_channels=split_channels)
+        name_d = self._get_ts_name_mix(max_rates_d, populations, bg_rate_d, rs,
+                                       **name_kw)
+        name_a = self._get_ts_name_mix(max_rates_a, populations, bg_rate_a, rs,
+                                       **name_kw)
+        checkpoint = None
+        if resume and name_d in self.ts_group:
+            checkpoint = load_checkpoint(self.ts_store.h5file, name_d)
+        if checkpoint is not None:
+            self._timestamps_d, self._tparticles_d = \
+                self.get_timestamps_part(name_d)
+            self._timestamps_a, self._tparticles_a = \
+                self.get_timestamps_part(name_a)
+            ts_arrays = (self._timestamps_d, self._tparticles_d,
+                         self._timestamps_a, self._tparticles_a)
+            for array in ts_arrays:
+                array.truncate(checkpoint['nrows'][array.name])
+            set_rng_state(rs, checkpoint['rng_state'])
+        else:
+            created = self._sim_timestamps_mix_da_online_arrays(
+                name_d, name_a, max_rates_d, max_rates_a, populations,
+                bg_rate_d, bg_rate_a, rs, chunksize, comp_filter, overwrite,
+                scale, skip_existing, method=method,
+                split_channels=split_channels)
+            if not created:
+                print(' - Skipping, timestamps array already present.')
+                return
+            ts_arrays = (self._timestamps_d, self._tparticles_d,
+                         self._timestamps_a, self._tparticles_a)
+
+        print('- Start trajectories simulation - %s' % ctime(), flush=True)
+        par_start_pos = self.particles.positions
+        i_chunk = 0
+        if checkpoint is not None:
+            par_start_pos = checkpoint['positions']
+            i_chunk = checkpoint['i_chunk']
+
+        # Load emission in chunks, and save only the final timestamps
+        bg_rates_d = [None] * (len(max_rates_d) - 1) + [bg_rate_d]
+        bg_rates_a = [None] * (len(max_rates_a) - 1) + [bg_rate_a]
+        prev_time = 0
+        chunks = itertools.islice(
+            iter_chunk_index(timeslice_size, t_chunksize), i_chunk, None)
+
+        def write_chunk(*chunk_arrays):
+            # Save sorted timestamps and corresponding particles
+            for array, data in zip(ts_arrays, chunk_arrays):
+                array.append(data)
+
+        writer = ChunkWriter(self.ts_store.h5file, flush_every=flush_every,
+                             background=async_write)
+        with writer:
+            for i_start, i_end in chunks:
+
+                curr_time = np.around(i_start * self.t_step, decimals=1)
+                if curr_time > prev_time:
+                    print(' %.1fs' % curr_time, end='', flush=True)
+                    prev_time = curr_time
+
+                _, em_chunk = self._sim_trajectories(
+                    t_chunksize, par_start_pos, rs, total_emission=False,
+                    save_pos=False, radial=False, wrap_func=wrap_periodic,
+                    workspace=self.workspace)
+
+                if split_channels:
+                    ((times_chunk_s_d, par_index_chunk_s_d),
+                     (times_chunk_s_a, par_index_chunk_s_a)) = \
+                        self._sim_timestamps_channels(
+                            em_chunk, (max_rates_d, max_rates_a),
+                            populations, (bg_rates_d, bg_rates_a), i_start,
+                            rs, scale, method=method)
+                else:
+                    times_chunk_s_d, par_index_chunk_s_d = \
+                        self._sim_timestamps_populations(
+                            em_chunk, max_rates_d, populations, bg_rates_d,
+                            i_start, rs, scale, method=method)
+
+                    times_chunk_s_a, par_index_chunk_s_a = \
+                        self._sim_timestamps_populations(
+                            em_chunk, max_rates_a, populations, bg_rates_a,
+                            i_start, rs, scale, method=method)
+
+                # Sorted timestamps (suffix '_s') and particles
+                writer.submit(write_chunk, times_chunk_s_d,
+                              par_index_chunk_s_d, times_chunk_s_a,
+                              par_index_chunk_s_a)
+                i_chunk += 1
+                if checkpoint_every is not None and \
+                        i_chunk % checkpoint_every == 0:
+                    writer.wait()
+                    nrows = {array.name: array.nrows for array in ts_arrays}
+                    save_checkpoint(self.ts_store.h5file, name_d,
+                                    par_start_pos, get_rng_state(rs), nrows,
+                                    i_chunk=i_chunk)
+
+        # Save current random state so it can be resumed in the next session
+        self.ts_group._v_attrs['last_random_state'] = get_rng_state(rs)
+        self._timestamps_d._v_attrs['last_random_state'] = get_rng_state(rs)
+        self.ts_store.h5file.flush()
+        print('\n- End trajectories simulation - %s' % ctime(), flush=True)
+
+    def _sim_timestamps_mix_da_online_arrays(
+            self, name_d, name_a, max_rates_d, max_rates_a, populations,
+            bg_rate_d, bg_rate_a, rs, chunksize, comp_filter, overwrite,
+            scale, skip_existing=False, method='poisson',
+            split_channels=False):
+        """Create the D and A timestamps arrays for
+        :meth:`simulate_timestamps_mix_da_online`.
+
+        Returns False if the arrays are already present and `skip_existing`
+        is True.
+        """
 
         kw = dict(clk_p=self.t_step / scale,
                   populations=populations,
@@ -1047,8 +2518,7 @@ class ParticlesSimulation(object):
                                                       .add_timestamps(**kw))
         except ExistingArrayError as e:
             if skip_existing:
-                print(' - Skipping, timestamps array already present.')
-                return
+                return False
             else:
                 raise e
 
@@ -1058,58 +2528,20 @@ class ParticlesSimulation(object):
                                                       .add_timestamps(**kw))
         except ExistingArrayError as e:
             if skip_existing:
-                print(' - Skipping, timestamps array already present.')
-                return
+                return False
             else:
                 raise e
 
-        self.ts_group._v_attrs['init_random_state'] = rs.get_state()
-        self.ts_group.attrs['Diffusion'] = 1
-        self._timestamps_d.attrs['init_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['init_random_state'] = get_rng_state(rs)
+        self.ts_group._v_attrs['Diffusion'] = 1
+        self._timestamps_d.attrs['init_random_state'] = get_rng_state(rs)
         self._timestamps_d.attrs['PyBroMo'] = __version__
         self._timestamps_a.attrs['PyBroMo'] = __version__
+        for ts in (self._timestamps_d, self._timestamps_a):
+            ts.attrs['method'] = method
+            ts.attrs['split_channels'] = split_channels
 
-        print('- Start trajectories simulation - %s' % ctime(), flush=True)
-        par_start_pos = self.particles.positions
-
-        # Load emission in chunks, and save only the final timestamps
-        bg_rates_d = [None] * (len(max_rates_d) - 1) + [bg_rate_d]
-        bg_rates_a = [None] * (len(max_rates_a) - 1) + [bg_rate_a]
-        prev_time = 0
-        for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
-
-            curr_time = np.around(i_start * self.t_step, decimals=1)
-            if curr_time > prev_time:
-                print(' %.1fs' % curr_time, end='', flush=True)
-                prev_time = curr_time
-
-            _, em_chunk = self._sim_trajectories(t_chunksize, par_start_pos,
-                                                 rs,
-                                                 total_emission=False,
-                                                 save_pos=False, radial=False,
-                                                 wrap_func=wrap_periodic)
-
-            times_chunk_s_d, par_index_chunk_s_d = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_d, populations, bg_rates_d, i_start,
-                    rs, scale)
-
-            times_chunk_s_a, par_index_chunk_s_a = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates_a, populations, bg_rates_a, i_start,
-                    rs, scale)
-
-            # Save sorted timestamps (suffix '_s') and corresponding particles
-            self._timestamps_d.append(times_chunk_s_d)
-            self._tparticles_d.append(par_index_chunk_s_d)
-            self._timestamps_a.append(times_chunk_s_a)
-            self._tparticles_a.append(par_index_chunk_s_a)
-
-        # Save current random state so it can be resumed in the next session
-        self.ts_group._v_attrs['last_random_state'] = rs.get_state()
-        self._timestamps_d._v_attrs['last_random_state'] = rs.get_state()
-        self.ts_store.h5file.flush()
-        print('\n- End trajectories simulation - %s' % ctime(), flush=True)
+        return True
 
     def simulate_timestamps_mix_online(self, max_rates,
                                  populations, bg_rate,
@@ -1117,7 +2549,9 @@ class ParticlesSimulation(object):
                                  comp_filter=None, overwrite=False,
                                  skip_existing=False, scale=10,
                                  path=None, t_chunksize=2**19,
-                                 timeslice=None):
+                                 timeslice=None,
+                                 rng_backend='legacy', async_write=False,
+                                 flush_every=None, method='poisson'):
         """Compute timestamps arrays for a mixture of N populations.
 
         This method simulates the diffusion, emission and generates a single
@@ -1135,10 +2569,13 @@ class ParticlesSimulation(object):
             populations (list of slices): slices to `self.particles`
                 defining each population.
             bg_rate (float, cps): rate for a Poisson background process
-            rs (RandomState object): random state object used as random number
-                generator. If None, use a random state initialized from seed.
+            rs (RandomState or Generator object): random state object used
+                as random number generator. If None, use a random state
+                initialized from seed.
             seed (uint): when `rs` is None, `seed` is used to initialize the
                 random state, otherwise is ignored.
+            rng_backend (string): random number generator created when `rs`
+                is None (see :func:`new_rng`).
             chunksize (int): chunk size used for the on-disk timestamp array
             comp_filter (tables.Filter or None): compression filter to use
                 for the on-disk `timestamps` and `tparticles` arrays.
@@ -1153,16 +2590,31 @@ class ParticlesSimulation(object):
             path (string): folder where to save the data.
             timeslice (float or None): timestamps are simulated until
                 `timeslice` seconds. If None, simulate until `self.t_max`.
+            method (string): method used to draw the photons, 'poisson'
+                (a Poisson number for each time bin, see
+                :func:`sim_timetrace_bg`) or 'thinning' (cost proportional
+                to the number of photons, see :func:`sim_photons_thinning`).
+                The two methods give different (statistically equivalent)
+                timestamps for the same random state, so a method other
+                than 'poisson' is added to the timestamps array name. The
+                method is also saved in the 'method' attribute of the array.
+            async_write (bool): if True, write the timestamps of each chunk
+                in a background thread while the next chunk is simulated
+                (see :class:`pybromo.writer.ChunkWriter`).
+            flush_every (int or None): if not None, flush the file every
+                `flush_every` chunks.
         """
         self.open_store_timestamp(chunksize=chunksize, path=path)
-        rs = self._get_group_randomstate(rs, seed, self.ts_group)
+        rs = self._get_group_randomstate(rs, seed, self.ts_group,
+                                         rng_backend)
         if t_chunksize is None:
             t_chunksize = 2**19
         timeslice_size = self.n_samples
         if timeslice is not None:
             timeslice_size = timeslice // self.t_step
 
-        name = self._get_ts_name_mix(max_rates, populations, bg_rate, rs)
+        name = self._get_ts_name_mix(max_rates, populations, bg_rate, rs,
+                                     method=method)
 
         kw = dict(clk_p=self.t_step / scale,
                   populations=populations,
@@ -1183,10 +2635,11 @@ class ParticlesSimulation(object):
             else:
                 raise e
 
-        self.ts_group._v_attrs['init_random_state'] = rs.get_state()
-        self.ts_group.attrs['Diffusion'] = 1
-        self._timestamps.attrs['init_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['init_random_state'] = get_rng_state(rs)
+        self.ts_group._v_attrs['Diffusion'] = 1
+        self._timestamps.attrs['init_random_state'] = get_rng_state(rs)
         self._timestamps.attrs['PyBroMo'] = __version__
+        self._timestamps.attrs['method'] = method
 
         print('- Start trajectories simulation - %s' % ctime(), flush=True)
         par_start_pos = self.particles.positions
@@ -1194,32 +2647,37 @@ class ParticlesSimulation(object):
         # Load emission in chunks, and save only the final timestamps
         bg_rates = [None] * (len(max_rates) - 1) + [bg_rate]
         prev_time = 0
-        for i_start, i_end in iter_chunk_index(timeslice_size, t_chunksize):
 
-            curr_time = np.around(i_start * self.t_step, decimals=1)
-            if curr_time > prev_time:
-                print(' %.1fs' % curr_time, end='', flush=True)
-                prev_time = curr_time
+        def write_chunk(times_chunk_s, par_index_chunk_s):
+            # Save sorted timestamps (suffix '_s') and corresponding particles
+            self._timestamps.append(times_chunk_s)
+            self._tparticles.append(par_index_chunk_s)
 
-            _, em_chunk = self._sim_trajectories(t_chunksize, par_start_pos,
-                                                 rs,
-                                                 total_emission=False,
-                                                 save_pos=False, radial=False,
-                                                 wrap_func=wrap_periodic)
+        writer = ChunkWriter(self.ts_store.h5file, flush_every=flush_every,
+                             background=async_write)
+        with writer:
+            for i_start, i_end in iter_chunk_index(timeslice_size,
+                                                   t_chunksize):
 
-            times_chunk_s, par_index_chunk_s = \
-                self._sim_timestamps_populations(
-                    em_chunk, max_rates, populations, bg_rates, i_start,
-                    rs, scale)
+                curr_time = np.around(i_start * self.t_step, decimals=1)
+                if curr_time > prev_time:
+                    print(' %.1fs' % curr_time, end='', flush=True)
+                    prev_time = curr_time
 
+                _, em_chunk = self._sim_trajectories(
+                    t_chunksize, par_start_pos, rs, total_emission=False,
+                    save_pos=False, radial=False, wrap_func=wrap_periodic,
+                    workspace=self.workspace)
 
-            # Save sorted timestamps (suffix '_s') and corresponding particles
-            self._timestamps.append(times_chunk_s)
-            self._tparticles.append(par_index_chunk_s)
+                times_chunk_s, par_index_chunk_s = \
+                    self._sim_timestamps_populations(
+                        em_chunk, max_rates, populations, bg_rates, i_start,
+                        rs, scale, method=method)
+                writer.submit(write_chunk, times_chunk_s, par_index_chunk_s)
 
         # Save current random state so it can be resumed in the next session
-        self.ts_group._v_attrs['last_random_state'] = rs.get_state()
-        self._timestamps._v_attrs['last_random_state'] = rs.get_state()
+        self.ts_group._v_attrs['last_random_state'] = get_rng_state(rs)
+        self._timestamps._v_attrs['last_random_state'] = get_rng_state(rs)
         self.ts_store.h5file.flush()
         print('\n- End trajectories simulation - %s' % ctime(), flush=True)
 
@@ -1229,7 +2687,8 @@ def sim_timetrace(emission, max_rate, t_step):
     emission_rates = emission * max_rate * t_step
     return np.random.poisson(lam=emission_rates).astype(np.uint8)
 
-def sim_timetrace_bg(emission, max_rate, bg_rate, t_step, rs=None):
+def sim_timetrace_bg(emission, max_rate, bg_rate, t_step, rs=None,
+                     workspace=None):
     """Draw random emitted photons from r.v. ~ Poisson(emission_rates).
 
     Arguments:
@@ -1240,8 +2699,11 @@ def sim_timetrace_bg(emission, max_rate, bg_rate, t_step, rs=None):
             Background is added as an additional row in the returned array
             of counts. If None, no background simulated.
         t_step (float): duration of a time step in seconds.
-        rs (RandomState or None): object used to draw the random numbers.
-            If None, a new RandomState is created using a random seed.
+        rs (RandomState, Generator or None): object used to draw the random
+            numbers. If None, a new RandomState is created using a random seed.
+        workspace (Workspace or None): if not None, the rates and the
+            returned counts are stored in buffers of `workspace` (reused at
+            the next call) and `emission` is not modified.
 
     Returns:
         `counts` an 2D uint8 array of counts in each time bin, for each
@@ -1251,11 +2713,19 @@ def sim_timetrace_bg(emission, max_rate, bg_rate, t_step, rs=None):
     """
     if rs is None:
         rs = np.random.RandomState()
-    em = np.atleast_2d(emission).astype('float64', copy=False)
-    counts_nrows = em.shape[0]
+    emission = np.atleast_2d(emission)
+    counts_nrows = emission.shape[0]
     if bg_rate is not None:
         counts_nrows += 1   # add a row for poisson background
-    counts = np.zeros((counts_nrows, em.shape[1]), dtype='u1')
+    counts_shape = (counts_nrows, emission.shape[1])
+    if workspace is None:
+        em = emission.astype('float64', copy=False)
+        counts = np.zeros(counts_shape, dtype='u1')
+    else:
+        em = workspace.get('em_rates', emission.shape, 'float64')
+        em[:] = emission
+        # All the rows are overwritten below
+        counts = workspace.get('counts', counts_shape, 'u1')
     # In-place computation
     # NOTE: the caller will see the modification
     em *= (max_rate * t_step)
@@ -1268,6 +2738,139 @@ def sim_timetrace_bg(emission, max_rate, bg_rate, t_step, rs=None):
         counts[-1] = rs.poisson(lam=bg_rate * t_step, size=em.shape[1])
     return counts
 
+def _merge_two_timestamps(times1, particles1, times2, particles2):
+    """Merge two sorted timestamps arrays (ties from the first array first).
+    """
+    # Position of each timestamp in the merged array
+    pos1 = np.searchsorted(times2, times1, side='left')
+    pos1 += np.arange(times1.size)
+    pos2 = np.searchsorted(times1, times2, side='right')
+    pos2 += np.arange(times2.size)
+    size = times1.size + times2.size
+    times = np.empty(size, dtype=np.result_type(times1, times2))
+    particles = np.empty(size, dtype=np.result_type(particles1, particles2))
+    times[pos1], times[pos2] = times1, times2
+    particles[pos1], particles[pos2] = particles1, particles2
+    return times, particles
+
+def merge_timestamps(times_list, particles_list):
+    """Merge sorted timestamps arrays and the corresponding particles arrays.
+
+    The arrays are merged in pairs, without sorting the concatenated arrays.
+    Equal timestamps are ordered as the input arrays in the list, so the
+    result is the same as a stable sort of the concatenated arrays.
+
+    Arguments:
+        times_list (list of arrays): sorted timestamps arrays.
+        particles_list (list of arrays): particles arrays, one for each
+            timestamps array.
+
+    Returns:
+        A tuple of two arrays: sorted timestamps and particles.
+    """
+    streams = list(zip(times_list, particles_list))
+    while len(streams) > 1:
+        merged = [_merge_two_timestamps(*streams[i], *streams[i + 1])
+                  for i in range(0, len(streams) - 1, 2)]
+        if len(streams) % 2 == 1:
+            merged.append(streams[-1])
+        streams = merged
+    return streams[0]
+
+def _channel_fractions(rates):
+    """Fraction of each rate in `rates` (equal fractions if all zero)."""
+    total = rates.sum()
+    if total > 0:
+        return rates / total
+    return np.full(rates.size, 1 / rates.size)
+
+def split_photons(particles, fractions, rs):
+    """Randomly assign each photon to a channel.
+
+    Each photon of particle `i` is assigned to channel `j` with probability
+    `fractions[i, j]`. Splitting a Poisson process in this way (multinomial
+    thinning, binomial for two channels) gives independent Poisson
+    processes, one per channel, with rates proportional to `fractions`.
+
+    Arguments:
+        particles (array): for each photon, the row of `fractions` to use.
+        fractions (2D array): fraction of photons in each channel (columns)
+            for each particle (rows). Each row sums to 1.
+        rs (RandomState or Generator): object used to draw the random
+            numbers.
+
+    Returns:
+        An array with the channel (column of `fractions`) of each photon.
+    """
+    if isinstance(rs, np.random.Generator):
+        u = rs.random(particles.size)
+    else:
+        u = rs.random_sample(particles.size)
+    thresholds = np.cumsum(fractions, axis=1)[:, :-1]
+    return (u[:, np.newaxis] >= thresholds[particles]).sum(axis=1)
+
+def sim_photons_thinning(emission, max_rate, bg_rate, t_step, rs=None,
+                         time_order=False):
+    """Draw random emitted photons by thinning a Poisson process.
+
+    The photons have the same distribution of :func:`sim_timetrace_bg`,
+    but the cost is proportional to the number of photons instead of the
+    number of time bins. For each particle, candidate photons are drawn in
+    random time bins at the peak rate of its emission in the chunk. Each
+    candidate in bin `i` is kept with probability `emission[i] / peak`,
+    so the kept photons have rate `emission * max_rate`.
+
+    Arguments:
+        emission (2D array): array of normalized emission rates. One row per
+            particle (axis = 0). Columns are the different time steps.
+        max_rate (float): the peak emission rate in Hz.
+        bg_rate (float or None): rate of a constant Poisson background (Hz).
+            If None, no background simulated.
+        t_step (float): duration of a time step in seconds.
+        rs (RandomState, Generator or None): object used to draw the random
+            numbers. If None, a new RandomState is created using a random seed.
+        time_order (bool): if True, the photons are ordered by bin and then
+            by particle, instead of by particle and then by bin.
+
+    Returns:
+        A tuple of two arrays (particles, bins) with the particle (row of
+        `emission`) and the time bin of each photon, ordered by particle and
+        then by bin. The background photons have particle index
+        `emission.shape[0]`. A bin with n photons is repeated n times.
+    """
+    if rs is None:
+        rs = np.random.RandomState()
+    emission = np.atleast_2d(emission)
+    num_particles, time_size = emission.shape
+    peaks = emission.max(axis=1).astype('float64')
+    rates = peaks * (max_rate * t_step * time_size)
+    if bg_rate is not None:
+        rates = np.append(rates, bg_rate * t_step * time_size)
+    num_photons = rs.poisson(lam=rates)
+    particles = np.repeat(np.arange(rates.size), num_photons)
+    num_em = num_photons[:num_particles].sum()
+    if isinstance(rs, np.random.Generator):
+        bins = rs.integers(time_size, size=particles.size)
+        u = rs.random(num_em)
+    else:
+        bins = rs.randint(time_size, size=particles.size)
+        u = rs.random_sample(num_em)
+    # The background photons (after the particles photons) are all kept
+    keep = np.ones(particles.size, dtype=bool)
+    em_particles = particles[:num_em]
+    keep[:num_em] = (u * peaks[em_particles] <
+                     emission[em_particles, bins[:num_em]])
+    if time_order:
+        # Sort by bin and then by particle
+        key = bins[keep].astype('int64') * rates.size + particles[keep]
+        key.sort()
+        bins, particles = np.divmod(key, rates.size)
+        return particles, bins
+    # Sort by particle and then by bin
+    key = particles[keep].astype('int64') * time_size + bins[keep]
+    key.sort()
+    return np.divmod(key, time_size)
+
 def sim_timetrace_bg2(emission, max_rate, bg_rate, t_step, rs=None):
     """Draw random emitted photons from r.v. ~ Poisson(emission_rates).
 
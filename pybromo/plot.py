@@ -11,6 +11,7 @@ File part of PyBroMo: a single molecule diffusion simulator.
 Copyright (C) 2013-2014 Antonino Ingargiola tritemio@gmail.com
 """
 
+import numpy as np
 import matplotlib.pyplot as plt
 #from scroll_gui import ScrollingToolQT
 
@@ -47,17 +48,22 @@ def plot_tracks(S):
 
 def plot_emission(S, dec=1, scroll_gui=False, multi=False, ms=False):
     fig = plt.figure()
-    plt.title("%d Particles, %.1f s diffusion, %d pM" % (S.np,
+    plt.title("%d Particles, %.1f s diffusion, %d pM" % (S.num_particles,
             S.t_step*S.n_samples, S.concentration()*1e12))
     plt.xlabel("Time (s)"); plt.ylabel("Emission rate [A.U.]"); plt.grid(1)
     if ms: plt.xlabel("Time (ms)")
+    # Emission decimated by `dec` (read from the pyramid, when present):
+    # max for each particle, mean for the total emission.
     if multi:
-        for em in S.em:
-            time = S.time(dec=dec) if not ms else S.time(dec=dec)*1e3
-            plt.plot(time, em[::dec], alpha=0.5)
+        em = S.emission_decimated(decimate=dec)
+    elif S.emission_tot.nrows > 0:
+        em = S.emission_decimated(decimate=dec, stat='mean', total=True)
     else:
-        time = S.time(dec=dec) if not ms else S.time(dec=dec)*1e3
-        plt.plot(time, S.em.sum(axis=0)[::dec], alpha=0.5)
+        em = S.emission_decimated(decimate=dec, stat='mean').sum(axis=0)
+    time = np.arange(em.shape[-1]) * S.t_step * dec
+    if ms: time *= 1e3
+    for em_i in np.atleast_2d(em):
+        plt.plot(time, em_i, alpha=0.5)
     s = None
     if scroll_gui: s = ScrollingToolQT(fig)
     return s
@@ -118,10 +118,8 @@ class EmissionPlotter(ScrollPlotter):
             slice_ = (0, self.duration_steps, self.decimate)
         slice_ = slice(*slice_[:2])
         assert (slice_.stop - slice_.start) // self.decimate == self.num_points
-        emission = self.S.emission[:, slice_]
-        dec_shape = (emission.shape[0], emission.shape[1] // self.decimate,
-                     self.decimate)
-        emission = emission.reshape(*dec_shape).max(axis=-1)
+        emission = self.S.emission_decimated(slice_.start, slice_.stop,
+                                             self.decimate)
 
         self.fig.canvas.restore_region(self.background)
         for ip, l_em in zip(self.particles, self.lines_em):
@@ -207,7 +205,8 @@ class TrackEmPlotterR(ScrollPlotter):
         slice_ = slice(*slice_)
         assert (slice_.stop - slice_.start) // self.decimate == self.num_points
         pos = self.position[:, :, slice_]
-        emission = self.S.emission[:, slice_]
+        emission = self.S.emission_decimated(slice_.start, slice_.stop,
+                                             self.decimate)
 
         self.fig.canvas.restore_region(self.background)
         for ip, l_rz, l_em in zip(self.particles,
@@ -312,7 +311,8 @@ class TrackEmPlotter(ScrollPlotter):
         slice_ = slice(*slice_)
         assert (slice_.stop - slice_.start) // self.decimate == self.num_points
         pos = self.position[:, :, slice_]
-        emission = self.S.emission[:, slice_]
+        emission = self.S.emission_decimated(slice_.start, slice_.stop,
+                                             self.decimate)
 
         self.fig.canvas.restore_region(self.background)
         for ip, l_xy, l_zy, l_em in zip(self.particles,
@@ -20,20 +20,38 @@ import numexpr as NE
 import numpy as np
 import hashlib
 
+from .workspace import Workspace
+
 
 class GaussianPSF:
     """This class implements a Gaussian-shaped PSF function."""
 
-    def __init__(self, xc=0, yc=0, zc=0, sx=1, sy=1, sz=1):
+    # Squared PSF (i.e. emission PSF) as a function of the radial distance
+    # `x` from the z axis and of `z`. The expression is compiled by numexpr
+    # on the first call and then reused from the numexpr cache.
+    _EMISSION_EXPR = 'exp(-(x * x * ax + (z - zc) * (z - zc) * az))'
+    _EMISSION_XYZ_EXPR = ('exp(-((x * x + y * y) * ax + '
+                          '(z - zc) * (z - zc) * az))')
+
+    def __init__(self, xc=0, yc=0, zc=0, sx=1, sy=1, sz=1,
+                 psf_pytables=None):
         """Create a Gaussian PSF object with given center and sigmas.
         `xc`, `yc`, `zc`: position of hte center of the gaussian
         `sx`, `sy`, `sz`: sigmas of the gaussian function.
+
+        If `psf_pytables` is not None, the parameters are loaded from
+        this pytables array (as saved by :meth:`to_hdf5`).
         """
+        if psf_pytables is not None:
+            xc, yc, zc, sx, sy, sz = psf_pytables[:]
+        # Use python floats so that the hash does not depend on the types
+        xc, yc, zc, sx, sy, sz = (float(v) for v in (xc, yc, zc, sx, sy, sz))
         self.xc, self.yc, self.zc = xc, yc, zc
         self.rc = np.array([xc, yc, zc])
         self.sx, self.sy, self.sz = sx, sy, sz
         self.s = np.array([sx, sy, sz])
         self.kind = "gauss"
+        self.fname = 'gaussian_psf'
 
     def eval(self, x, y, z):
         """Evaluate the function in (x, y, z)."""
@@ -54,6 +72,73 @@ class GaussianPSF:
         #g_arg = lambda t, mu, sig: -((t-mu)**2)/(2*sig**2)
         #return exp(g_arg(x, xc, sx) + g_arg(y, yc, sy) + g_arg(z, zc, sz))
 
+    def eval_xz(self, x, z):
+        """Evaluate the function in (x, z).
+
+        Here `x` is the radial distance from the z axis: the PSF is
+        assumed rotationally symmetric around z with radial sigma `sx`
+        (`xc`, `yc` and `sy` are ignored).
+        """
+        return np.sqrt(self.emission_xz(x, z, out=np.empty(np.shape(x))))
+
+    def emission_xz(self, x, z, out=None):
+        """Evaluate the emission PSF (i.e. PSF**2) in (x, z).
+
+        See :meth:`eval_xz` for the meaning of `x`. The result is stored
+        in the array `out` (float32 array allocated if None) which is
+        returned.
+        """
+        if out is None:
+            out = np.empty(np.shape(x), dtype=np.float32)
+        params = dict(x=x, z=z, zc=float(self.zc),
+                      ax=1. / self.sx**2, az=1. / self.sz**2)
+        return NE.evaluate(self._EMISSION_EXPR, local_dict=params, out=out,
+                           casting='same_kind')
+
+    def support_xz(self, threshold=1e-2):
+        """Return the (radial, axial) extent of the PSF support.
+
+        Outside the cylinder of radius `ro` and half-height `z` (centered
+        in (0, zc)) the PSF is below `threshold` (relative to the peak).
+        The support is infinite when `threshold` is 0.
+        """
+        if threshold <= 0:
+            return np.inf, np.inf
+        n_sigma = np.sqrt(-2 * np.log(threshold))
+        return n_sigma * self.sx, n_sigma * self.sz + abs(self.zc)
+
+    def emission_xyz(self, x, y, z, out=None):
+        """Evaluate the emission PSF (i.e. PSF**2) in (x, y, z).
+
+        Same as `emission_xz(sqrt(x**2 + y**2), z)` but computed in a
+        single numexpr pass, without temporary arrays.
+        """
+        if out is None:
+            out = np.empty(np.shape(x), dtype=np.float32)
+        params = dict(x=x, y=y, z=z, zc=float(self.zc),
+                      ax=1. / self.sx**2, az=1. / self.sz**2)
+        return NE.evaluate(self._EMISSION_XYZ_EXPR, local_dict=params,
+                           out=out, casting='same_kind')
+
+    def to_hdf5(self, file_handle, parent_node='/'):
+        """Store the PSF parameters in `file_handle` (pytables) in
+        `parent_node`.
+
+        The parameters (xc, yc, zc, sx, sy, sz) are stored in an array named
+        as `fname`. The attribute `kind` is also set.
+        """
+        params = np.array([self.xc, self.yc, self.zc,
+                           self.sx, self.sy, self.sz], dtype=float)
+        tarray = file_handle.create_array(parent_node, name=self.fname,
+                                          obj=params,
+                                          title='Gaussian PSF parameters')
+        file_handle.set_node_attr(tarray, 'kind', self.kind)
+        return tarray
+
+    def hash(self):
+        """Return an hash string computed on the PSF parameters."""
+        return _hash_attributes(self)
+
 
 class NumericPSF:
     def __init__(self, fname='xz_realistic_z50_150_160_580nm_n1335_HR2',
@@ -95,6 +180,78 @@ class NumericPSF:
         """
         return self._fun_um.ev(x * 1e6, z * 1e6)
 
+    def emission_lut(self, oversample=4):
+        """Return the lookup table of the emission PSF (i.e. PSF**2).
+
+        The table is a float32 array of shape (z_len, x_len) sampling the
+        square of the interpolated PSF on a grid `oversample` times finer
+        than the PSF data. The table is computed on the first call and
+        cached. With the default `oversample`, bilinear interpolation of the
+        table (see :meth:`emission_xz`) differs from `eval_xz(x, z)**2` by
+        less than 2e-3 (the peak is 1).
+        """
+        if getattr(self, '_lut_oversample', None) != oversample:
+            nx = (self.xi.size - 1) * oversample + 1
+            nz = (self.zi.size - 1) * oversample + 1
+            xf = np.linspace(self.xi[0], self.xi[-1], nx)
+            zf = np.linspace(self.zi[0], self.zi[-1], nz)
+            lut = self._fun_um(xf, zf).T**2
+            self._lut = np.ascontiguousarray(lut, dtype=np.float32)
+            self._lut_oversample = oversample
+        return self._lut
+
+    def emission_xz(self, x, z, out=None, oversample=4, workspace=None):
+        """Evaluate the emission PSF (i.e. PSF**2) in (x, z) (meters).
+
+        The emission is computed by bilinear interpolation of the lookup
+        table returned by :meth:`emission_lut` and it is zero outside the
+        PSF grid. The result is stored in the float32 array `out`
+        (allocated if None), which is returned. The temporary arrays
+        (table indexes and weights) are taken from `workspace`
+        (a :class:`pybromo.workspace.Workspace`) if not None.
+        """
+        lut = self.emission_lut(oversample)
+        nz, nx = lut.shape
+        shape = np.shape(x)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        if workspace is None:
+            workspace = Workspace()
+        u = workspace.get('psf_u', shape)
+        v = workspace.get('psf_v', shape)
+        k = workspace.get('psf_k', shape, np.intp)
+        ik = workspace.get('psf_ik', shape, np.intp)
+        outside = workspace.get('psf_outside', shape, bool)
+        lo = workspace.get('psf_lo', shape, np.float32)
+        w0 = workspace.get('psf_w0', shape, np.float32)
+        w1 = workspace.get('psf_w1', shape, np.float32)
+        # Continuous table indexes
+        params = dict(x=x, z=z, x0=self.xi[0], z0=self.zi[0],
+                      sx=oversample / self.x_step, sz=oversample / self.z_step)
+        NE.evaluate('(x * 1e6 - x0) * sx', local_dict=params, out=u)
+        NE.evaluate('(z * 1e6 - z0) * sz', local_dict=params, out=v)
+        NE.evaluate('(u < 0) | (u > umax) | (v < 0) | (v > vmax)',
+                    local_dict=dict(u=u, v=v, umax=nx - 1, vmax=nz - 1),
+                    out=outside)
+        # Integer indexes (clipped to the grid) and fractional parts
+        np.clip(v, 0, nz - 2, out=k, casting='unsafe')
+        np.clip(u, 0, nx - 2, out=ik, casting='unsafe')
+        v -= k
+        u -= ik
+        k *= nx
+        k += ik
+        flat, flat1 = lut.ravel(), lut.ravel()[1:]
+        np.take(flat, k, out=w0, mode='clip')
+        np.take(flat1, k, out=w1, mode='clip')
+        NE.evaluate('w0 * (1 - u) + w1 * u', out=lo, casting='same_kind')
+        k += nx
+        np.take(flat, k, out=w0, mode='clip')
+        np.take(flat1, k, out=w1, mode='clip')
+        NE.evaluate('lo * (1 - v) + (w0 * (1 - u) + w1 * u) * v', out=out,
+                    casting='same_kind')
+        np.copyto(out, 0, where=outside)
+        return out
+
     def eval(self, x, y, z):
         """Evaluate the function in (x, y, z).
         The function is rotationally symmetric around z.
@@ -104,6 +261,19 @@ class NumericPSF:
         v = self.eval_xz(ro.ravel(), z.ravel())
         return v.reshape(zs, xs)
 
+    def support_xz(self, threshold=1e-2):
+        """Return the (radial, axial) extent of the PSF support (meters).
+
+        Outside the cylinder of radius `ro` and half-height `z` (centered
+        in the origin) the PSF is below `threshold` (relative to the peak).
+        """
+        above = self.hdata >= threshold
+        ix = np.nonzero(above.any(axis=0))[0].max()
+        iz = np.nonzero(above.any(axis=1))[0]
+        ro = self.xi[ix] + self.x_step
+        z = np.abs(self.zi[iz]).max() + self.z_step
+        return ro * 1e-6, z * 1e-6
+
     def to_hdf5(self, file_handle, parent_node='/'):
         """Store the PSF data in `file_handle` (pytables) in `parent_node`.
 
@@ -119,14 +289,27 @@ class NumericPSF:
 
     def hash(self):
         """Return an hash string computed on the PSF data."""
-        hash_list = []
-        for key, value in sorted(self.__dict__.items()):
-            if not callable(value):
-                if isinstance(value, np.ndarray):
-                    hash_list.append(value.tostring())
-                else:
-                    hash_list.append(str(value))
-        return hashlib.md5(repr(hash_list).encode()).hexdigest()
+        return _hash_attributes(self)
+
+
+def _hash_attributes(psf):
+    """Return an hash string computed on the public attributes of `psf`."""
+    hash_list = []
+    for key, value in sorted(psf.__dict__.items()):
+        # Skip private (cached) attributes
+        if not callable(value) and not key.startswith('_'):
+            if isinstance(value, np.ndarray):
+                hash_list.append(value.tostring())
+            else:
+                hash_list.append(str(value))
+    return hashlib.md5(repr(hash_list).encode()).hexdigest()
+
+
+def psf_from_hdf5(psf_pytables):
+    """Create a PSF object from the pytables array saved by `to_hdf5()`."""
+    if 'kind' in psf_pytables.attrs and psf_pytables.attrs.kind == 'gauss':
+        return GaussianPSF(psf_pytables=psf_pytables)
+    return NumericPSF(psf_pytables=psf_pytables)
 
 
 def load_PSFLab_file(fname):
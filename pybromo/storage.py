@@ -6,7 +6,8 @@
 
 """
 This module implements functions to store simulation results to a file.
-The module uses the HDF5 file format through the PyTables library.
+The module uses the HDF5 file format through the PyTables library, or
+the directory backends in :mod:`pybromo.backends`.
 
 File part of PyBroMo: a single molecule diffusion simulator.
 Copyright (C) 2013-2014 Antonino Ingargiola tritemio@gmail.com
@@ -14,8 +15,10 @@ Copyright (C) 2013-2014 Antonino Ingargiola tritemio@gmail.com
 
 from pathlib import Path
 import time
+import numpy as np
 import tables
 
+from .backends import open_file, backend_from_path, Group
 from ._version import get_versions
 __version__ = get_versions()['version']
 
@@ -32,6 +35,37 @@ class ExistingArrayError(Exception):
     pass
 
 
+def quantize(data, scale, dtype='uint16'):
+    """Return `data` encoded as integers of type `dtype` in units of `scale`.
+
+    Values are rounded to the nearest integer and clipped to the range of
+    `dtype` (values above the full-scale are saturated).
+    """
+    dtype = np.dtype(dtype)
+    codes = np.rint(np.multiply(data, 1 / scale, dtype='float32'))
+    np.clip(codes, 0, np.iinfo(dtype).max, out=codes)
+    return codes.astype(dtype)
+
+
+def emission_scale(array):
+    """Return the value of one unit of a quantized emission `array`.
+
+    For arrays not quantized, return 1.
+    """
+    return getattr(array.attrs, 'scale', 1.0)
+
+
+def _quantized_atom(quantize, full_scale, params):
+    """Return atom and array attributes for the emission quantization."""
+    if quantize is None:
+        return tables.Float32Atom(), params
+    dtype = np.dtype(quantize)
+    if dtype not in (np.uint8, np.uint16):
+        raise ValueError("`quantize` must be None, 'uint8' or 'uint16'.")
+    params = dict(params, scale=full_scale / np.iinfo(dtype).max)
+    return tables.Atom.from_dtype(dtype), params
+
+
 class BaseStore(object):
 
     @staticmethod
@@ -54,7 +88,7 @@ class BaseStore(object):
         return chunkshape
 
     def __init__(self, datafile, path='./', nparams=dict(), attr_params=dict(),
-                 mode='r'):
+                 mode='r', backend=None):
         """Return a new HDF5 file to store simulation results.
 
         The HDF5 file has two groups:
@@ -62,6 +96,9 @@ class BaseStore(object):
             containing all the simulation numeric-parameters
 
         If `mode='w'`, `datafile` will be overwritten (if exists).
+        If `mode='a'`, an existing `datafile` is opened for writing.
+        `backend` is one of `backends.BACKENDS`. If None, use the backend
+        of the existing `datafile`, or 'hdf5' for a new file.
         """
         if isinstance(datafile, Path):
             self.filepath = datafile
@@ -69,9 +106,12 @@ class BaseStore(object):
             if not Path(path).exists():
                 raise ValueError('Path "%s" does not exists.' % path)
             self.filepath = Path(path, datafile)
-        self.h5file = tables.open_file(str(self.filepath), mode=mode)
+        if backend is None or (mode != 'w' and self.filepath.exists()):
+            backend = backend_from_path(self.filepath)
+        self.backend = backend
+        self.h5file = open_file(self.filepath, mode=mode, backend=backend)
         self.filename = str(self.filepath)
-        if mode == 'w':
+        if mode != 'r' and 'parameters' not in self.h5file.root:
             self.h5file.title = "PyBroMo simulation file"
 
             # Create the groups
@@ -107,6 +147,17 @@ class BaseStore(object):
         for name, value in attr_params.items():
             self.h5file.set_node_attr('/parameters', name, value)
 
+    def update_sim_params(self, nparams):
+        """Replace the parameters in `nparams` in `h5file.root.parameters`.
+
+        `nparams` has the same format of :meth:`set_sim_params`. Parameters
+        not already present are added.
+        """
+        for name in nparams:
+            if name in self.h5file.root.parameters:
+                self.h5file.remove_node('/parameters', name)
+        self.set_sim_params(nparams, {})
+
     @property
     def numeric_params(self):
         """Return a dict containing all (key, values) stored in '/parameters'
@@ -129,9 +180,396 @@ class BaseStore(object):
         return nparams
 
 
+class TrajectoryReader(object):
+    """Base class of the on-disk trajectories stored in a custom format.
+
+    Subclasses implement `read(start, stop, step, out)` along the last
+    (time) axis and the `shape` and `nrows` attributes. This class adds
+    the numpy-like slicing of the dense arrays.
+    """
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+        t_key = key[-1]
+        if isinstance(t_key, slice):
+            start, stop, step = t_key.indices(self.nrows)
+            if step > 0:
+                data = self.read(start, stop, step)
+            else:
+                data = self.read()[..., t_key]
+        else:
+            t_key = t_key + self.nrows if t_key < 0 else t_key
+            data = self.read(t_key, t_key + 1)[..., 0]
+            return data[key[:-1]]
+        return data[key[:-1] + (slice(None),)]
+
+
+class SparseArray(TrajectoryReader):
+    """Sparse trajectory array stored as per-particle run-length segments.
+
+    Only the samples inside a neighbourhood of the PSF are stored. Each
+    appended chunk is split in segments of consecutive stored samples of
+    one particle. The data is stored in a group containing the arrays:
+
+    - `segments`: one row (particle, start, length) per segment, where
+      `start` is the absolute time index of the first sample.
+    - `values`: the stored samples of all the segments in sequence
+      (for each sample, a scalar or a vector of coordinates).
+    - `chunks`: one row (start, first segment, first value) per chunk.
+
+    The object emulates the reading interface of the dense EArrays:
+    slicing (time is the last axis), `read()`, `shape`, `dtype`,
+    `chunkshape` and `nrows`. The samples not stored are equal to
+    `fill_value` (0 for the emission, NaN for the positions).
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.attrs = group._v_attrs
+        self.segments = group.segments
+        self.values = group.values
+        self._chunks = group.chunks.read()
+
+    @property
+    def name(self):
+        return self.group._v_name
+
+    @property
+    def nrows(self):
+        return int(self.attrs.nrows)
+
+    @property
+    def shape(self):
+        return tuple(self.attrs.base_shape) + (self.nrows,)
+
+    @property
+    def chunkshape(self):
+        return tuple(self.attrs.chunkshape)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def fill_value(self):
+        return self.attrs.fill_value
+
+    def set_attr(self, name, value):
+        self.attrs[name] = value
+
+    def append(self, data, mask=None):
+        """Append a dense chunk `data`, storing only the samples in `mask`.
+
+        `data` has shape (num_particles, time_size) or (num_particles,
+        num_coords, time_size). `mask` (shape (num_particles, time_size))
+        selects the samples to store. If None, store the non-zero samples
+        (for 2-D `data` only).
+        """
+        if mask is None:
+            mask = data != 0
+        num_particles, time_size = mask.shape
+        # Segments boundaries: +1 at the start and -1 after the end
+        padded = np.zeros((num_particles, time_size + 2), dtype='int8')
+        padded[:, 1:-1] = mask
+        delta = np.diff(padded, axis=1)
+        particles, starts = np.nonzero(delta == 1)
+        _, stops = np.nonzero(delta == -1)
+        if data.ndim == 2:
+            values = data[mask]
+        else:
+            values = data.transpose(0, 2, 1)[mask]
+        segments = np.column_stack(
+            [particles, starts + self.nrows, stops - starts]).astype('int64')
+        chunk = np.array([[self.nrows, self.segments.nrows,
+                           self.values.nrows]], dtype='int64')
+        self.group.chunks.append(chunk)
+        self._chunks = np.vstack([self._chunks, chunk])
+        if segments.shape[0] > 0:
+            self.segments.append(segments)
+            self.values.append(values.astype(self.dtype, copy=False))
+        self.attrs.nrows = self.nrows + time_size
+
+    def truncate(self, nrows):
+        """Remove the chunks after the first `nrows` time steps.
+
+        `nrows` must be the start of a chunk (or the current length).
+        """
+        if nrows == self.nrows:
+            return
+        c = np.searchsorted(self._chunks[:, 0], nrows)
+        if c == self._chunks.shape[0] or self._chunks[c, 0] != nrows:
+            raise ValueError('Can only truncate at the start of a chunk.')
+        self.segments.truncate(self._chunks[c, 1])
+        self.values.truncate(self._chunks[c, 2])
+        self.group.chunks.truncate(c)
+        self._chunks = self._chunks[:c]
+        self.attrs.nrows = nrows
+
+    def read(self, start=None, stop=None, step=None, out=None):
+        """Read the dense array between time indexes `start` and `stop`."""
+        start, stop, step = slice(start, stop, step).indices(self.nrows)
+        stop = max(start, stop)
+        shape = tuple(self.attrs.base_shape) + (stop - start,)
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        else:
+            out = out.reshape(shape)
+        out[:] = self.fill_value
+        chunks = self._chunks
+        if stop > start and chunks.shape[0] > 0:
+            c0 = np.searchsorted(chunks[:, 0], start, side='right') - 1
+            c1 = np.searchsorted(chunks[:, 0], stop, side='left')
+            s0, v0 = chunks[c0, 1:]
+            s1, v1 = self.segments.nrows, self.values.nrows
+            if c1 < chunks.shape[0]:
+                s1, v1 = chunks[c1, 1:]
+            if s1 > s0:
+                self._fill(out, start, stop, self.segments.read(s0, s1),
+                           self.values.read(v0, v1))
+        return out[..., ::step] if step != 1 else out
+
+    @staticmethod
+    def _fill(out, start, stop, segments, values):
+        """Copy in `out` the samples of `segments` in [start..stop)."""
+        particles, starts, lengths = segments.T
+        offsets = np.cumsum(lengths) - lengths
+        index = np.repeat(np.arange(segments.shape[0]), lengths)
+        times = (np.arange(lengths.sum()) - offsets[index] +
+                 starts[index])
+        valid = (times >= start) * (times < stop)
+        particles, times = particles[index][valid], times[valid] - start
+        if out.ndim == 2:
+            out[particles, times] = values[valid]
+        else:
+            out[particles, :, times] = values[valid]
+
+    def __repr__(self):
+        return 'SparseArray(%s, shape=%s, %d segments)' % (
+            self.group._v_pathname, self.shape, self.segments.nrows)
+
+
+class FixedPointArray(TrajectoryReader):
+    """Position array stored as box-relative int16 fixed-point values.
+
+    Each coordinate `c` in the interval [`offset[c]`..`offset[c]` + 65535
+    `scale[c]`] (i.e. the box) is stored as the int16 code:
+
+        code = round((x - offset) / scale) - 32768
+
+    The resolution for a box of size L is L / 65535 (0.12 nm for 8 um),
+    well below the displacement in one time step. The codes are stored in
+    an EArray (attribute 'encoding' = 'int16') with the same shape and
+    chunks of the float32 position array, and are decoded one chunk at a
+    time when reading. The object emulates the reading interface of the
+    EArrays (slicing, `read()`, `shape`, `dtype`, `chunkshape`, `nrows`)
+    returning float32 positions.
+    """
+    dtype = np.dtype('float32')
+
+    def __init__(self, earray):
+        self.earray = earray
+        self.attrs = earray.attrs
+        self._offset = np.reshape(self.attrs.offset, (-1, 1))
+        self._scale = np.reshape(self.attrs.scale, (-1, 1))
+
+    @property
+    def name(self):
+        return self.earray.name
+
+    @property
+    def nrows(self):
+        return self.earray.nrows
+
+    @property
+    def shape(self):
+        return self.earray.shape
+
+    @property
+    def chunkshape(self):
+        return self.earray.chunkshape
+
+    def set_attr(self, name, value):
+        self.earray.set_attr(name, value)
+
+    def encode(self, data):
+        """Return the int16 codes of the positions `data`."""
+        codes = np.rint((data - self._offset) / self._scale)
+        np.clip(codes, 0, 65535, out=codes)
+        codes -= 32768
+        return codes.astype('int16')
+
+    def decode(self, codes, out=None):
+        """Return the float32 positions from the int16 `codes`."""
+        if out is None:
+            out = np.empty(codes.shape, dtype=self.dtype)
+        out[:] = (codes + 32768.) * self._scale + self._offset
+        return out
+
+    def append(self, data):
+        self.earray.append(self.encode(data))
+
+    def truncate(self, nrows):
+        self.earray.truncate(nrows)
+
+    def read(self, start=None, stop=None, step=None, out=None):
+        """Read and decode the positions between `start` and `stop`."""
+        start, stop, step = slice(start, stop, step).indices(self.nrows)
+        stop = max(start, stop)
+        shape = self.shape[:-1] + (len(range(start, stop, step)),)
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        else:
+            out = out.reshape(shape)
+        # Decode one chunk at a time (with a whole number of steps)
+        t_chunk = self.chunkshape[-1]
+        t_chunk = max(step, t_chunk - t_chunk % step)
+        i = 0
+        for i_start in range(start, stop, t_chunk):
+            codes = self.earray.read(i_start, min(i_start + t_chunk, stop),
+                                     step)
+            self.decode(codes, out=out[..., i:i + codes.shape[-1]])
+            i += codes.shape[-1]
+        return out
+
+    def __repr__(self):
+        return 'FixedPointArray(%s, shape=%s)' % (self.earray._v_pathname,
+                                                  self.shape)
+
+
+class EmissionPyramid(object):
+    """Emission decimated by powers of 2 (max and mean), for fast reads.
+
+    For each level `k` in `levels`, the group contains the arrays `max_k`
+    and `mean_k` with the maximum and the mean of the emission in
+    consecutive windows of 2**k time steps (the last incomplete window is
+    not stored). The levels are built incrementally by :meth:`append` as
+    the emission chunks are stored, and are always in float32 (quantized
+    emission is decoded). :meth:`decimate` reads a decimated window of
+    the emission from the coarsest suitable level.
+    """
+    stats = {'max': np.max, 'mean': np.mean}
+
+    def __init__(self, group, source):
+        self.group = group
+        self.source = source
+        self.levels = sorted(int(k) for k in group._v_attrs.levels)
+        # Samples not yet reduced at each level (at most one per level)
+        self._carry = {}
+
+    def append(self, data):
+        """Add the emission chunk `data` (decoded if quantized) to the levels.
+        """
+        inputs = dict.fromkeys(self.stats, data)
+        for k in range(1, self.levels[-1] + 1):
+            for stat, func in self.stats.items():
+                x = inputs[stat]
+                carry = self._carry.get((stat, k))
+                if carry is not None:
+                    x = np.concatenate([carry, x], axis=-1)
+                n = x.shape[-1] // 2
+                y = func(x[..., :2 * n].reshape(x.shape[:-1] + (n, 2)),
+                         axis=-1).astype('float32', copy=False)
+                self._carry[(stat, k)] = x[..., 2 * n:].copy()
+                if k in self.levels:
+                    self.group._f_get_child('%s_%d' % (stat, k)).append(y)
+                inputs[stat] = y
+
+    def decimate(self, start, stop, decimate, stat='max'):
+        """Return the emission in [`start`..`stop`) reduced by `stat`
+        ('max' or 'mean') in windows of `decimate` time steps.
+
+        Uses the coarsest level with windows aligned to `start` and
+        `decimate`, so the result is the same as reducing the full
+        resolution emission, which is read when no level is suitable.
+        """
+        num_windows = (stop - start) // decimate
+        stop = start + num_windows * decimate
+        scale, array = emission_scale(self.source), self.source
+        for k in reversed(self.levels):
+            level = self.group._f_get_child('%s_%d' % (stat, k))
+            step = 2**k
+            if (start % step == 0 and decimate % step == 0 and
+                    stop // step <= level.nrows):
+                start, stop, decimate = (start // step, stop // step,
+                                         decimate // step)
+                scale, array = 1, level
+                break
+        data = array.read(start, stop)
+        data = data.reshape(data.shape[:-1] + (num_windows, decimate))
+        return self.stats[stat](data, axis=-1) * scale
+
+    def __repr__(self):
+        return 'EmissionPyramid(%s, levels=%s)' % (self.group._v_pathname,
+                                                   self.levels)
+
+
+def save_checkpoint(h5file, name, positions, rng_state, nrows, **attrs):
+    """Save a checkpoint of a simulation in the group '/checkpoints/<name>'.
+
+    The checkpoint contains the particles `positions` (float64), the
+    random state `rng_state`, the dict `nrows` with the length of the
+    arrays written so far and any other attribute in `attrs`. Two slots
+    are written alternately and the group attribute 'current' (pointing
+    to the last complete slot) is set last, so an interruption while
+    saving leaves the previous checkpoint valid.
+    """
+    if 'checkpoints' not in h5file.root:
+        h5file.create_group('/', 'checkpoints', 'Simulation checkpoints')
+    if name in h5file.root.checkpoints:
+        group = h5file.root.checkpoints._f_get_child(name)
+    else:
+        group = h5file.create_group('/checkpoints', name)
+    slot = 1 - group._v_attrs.current if 'current' in group._v_attrs else 0
+    array_name = 'positions_%d' % slot
+    if array_name in group:
+        group._f_get_child(array_name)[:] = positions
+    else:
+        h5file.create_array(group, array_name, obj=np.asarray(positions,
+                                                              'float64'))
+    group._v_attrs['state_%d' % slot] = dict(attrs, rng_state=rng_state,
+                                             nrows=nrows)
+    h5file.flush()
+    group._v_attrs.current = slot
+    h5file.flush()
+
+
+def load_checkpoint(h5file, name):
+    """Return the last checkpoint saved by :func:`save_checkpoint`.
+
+    The checkpoint is a dict with keys 'positions', 'rng_state', 'nrows'
+    and the other attributes saved. Return None when there is no
+    checkpoint called `name`.
+    """
+    if 'checkpoints' not in h5file.root or \
+            name not in h5file.root.checkpoints:
+        return None
+    group = h5file.root.checkpoints._f_get_child(name)
+    if 'current' not in group._v_attrs:
+        return None
+    slot = group._v_attrs.current
+    checkpoint = dict(group._v_attrs['state_%d' % slot])
+    checkpoint['positions'] = group._f_get_child('positions_%d' % slot).read()
+    return checkpoint
+
+
+def load_trajectory(node):
+    """Return `node` wrapped in a `SparseArray` or `FixedPointArray` when
+    it is stored in these formats."""
+    if isinstance(node, (tables.Group, Group)) and 'sparse' in node._v_attrs:
+        return SparseArray(node)
+    if 'encoding' in node.attrs:
+        return FixedPointArray(node)
+    return node
+
+
 class TrajectoryStore(BaseStore):
     def __init__(self, datafile, path='./', nparams=dict(), attr_params=dict(),
-                 mode='r'):
+                 mode='r', backend=None):
         """Return a new HDF5 file to store simulation results.
 
         The HDF5 file has two groups:
@@ -144,13 +582,58 @@ class TrajectoryStore(BaseStore):
         If `mode='w'`, `datafile` will be overwritten (if exists).
         """
         super().__init__(datafile, path=path, nparams=nparams,
-                         attr_params=attr_params, mode=mode)
-        if mode != 'r':
+                         attr_params=attr_params, mode=mode, backend=backend)
+        if mode != 'r' and 'trajectories' not in self.h5file.root:
             # Create the groups
             self.h5file.create_group('/', 'trajectories',
                                      'Simulated trajectories')
             self.h5file.create_group('/', 'psf', 'PSFs used in the simulation')
 
+    def add_sparse_trajectory(self, name, shape, overwrite=False, title='',
+                              chunksize=2**19, comp_filter=default_compression,
+                              atom=tables.Float32Atom(), params=dict(),
+                              fill_value=0):
+        """Add a sparse trajectory (see :class:`SparseArray`) in
+        '/trajectories'.
+
+        `shape` is the shape of the equivalent dense array, with time along
+        the last (extendable) axis of size 0.
+        """
+        group = self.h5file.root.trajectories
+        if name in group:
+            print("%s already exists ..." % name, end='')
+            if overwrite:
+                self.h5file.remove_node(group, name, recursive=True)
+                print(" deleted.")
+            else:
+                print(" old returned.")
+                return load_trajectory(group._f_get_child(name))
+
+        chunkshape = self.calc_chunkshape(chunksize, shape)
+        sparse_group = self.h5file.create_group(group, name, title)
+        self.h5file.create_earray(
+            sparse_group, 'segments', atom=tables.Int64Atom(),
+            shape=(0, 3), filters=comp_filter,
+            title='Segments (particle, start, length)')
+        self.h5file.create_earray(
+            sparse_group, 'values', atom=atom, shape=(0,) + shape[1:-1],
+            filters=comp_filter, title='Values of the stored samples')
+        self.h5file.create_earray(
+            sparse_group, 'chunks', atom=tables.Int64Atom(), shape=(0, 3),
+            title='Chunks (start, first segment, first value)')
+
+        attrs = sparse_group._v_attrs
+        attrs.sparse = True
+        attrs.base_shape = shape[:-1]
+        attrs.chunkshape = tuple(int(c) for c in chunkshape)
+        attrs.fill_value = fill_value
+        attrs.nrows = 0
+        for key, value in params.items():
+            attrs[key] = value
+        attrs.PyBroMo = __version__
+        attrs.creation_time = current_time()
+        return SparseArray(sparse_group)
+
     def add_trajectory(self, name, overwrite=False, shape=(0,), title='',
                        chunksize=2**19, comp_filter=default_compression,
                        atom=tables.Float64Atom(), params=dict(),
@@ -186,34 +669,89 @@ class TrajectoryStore(BaseStore):
         store_array.set_attr('creation_time', current_time())
         return store_array
 
+    def add_emission_pyramid(self, source, levels, overwrite=False,
+                             chunksize=2**19,
+                             comp_filter=default_compression):
+        """Add an :class:`EmissionPyramid` of the emission array `source`.
+
+        The pyramid is stored in the group '/trajectories/<name>_pyramid'
+        (where <name> is the name of `source`) with the decimation levels
+        `levels` (list of exponents of 2).
+        """
+        group = self.h5file.root.trajectories
+        name = source.name + '_pyramid'
+        if name in group:
+            if not overwrite:
+                return EmissionPyramid(group._f_get_child(name), source)
+            self.h5file.remove_node(group, name, recursive=True)
+        levels = sorted(set(int(k) for k in levels))
+        if not levels or levels[0] < 1:
+            raise ValueError('Pyramid levels must be integers >= 1.')
+        pyramid_group = self.h5file.create_group(
+            group, name, 'Decimated emission (max and mean)')
+        pyramid_group._v_attrs.levels = levels
+        base_shape = source.shape[:-1]
+        for k in levels:
+            chunkshape = self.calc_chunkshape(chunksize, base_shape + (0,))
+            chunkshape = chunkshape[:-1] + (max(1, int(chunkshape[-1])),)
+            for stat in EmissionPyramid.stats:
+                self.h5file.create_earray(
+                    pyramid_group, '%s_%d' % (stat, k),
+                    atom=tables.Float32Atom(), shape=base_shape + (0,),
+                    chunkshape=chunkshape, filters=comp_filter,
+                    title='Emission %s in windows of %d steps' % (stat,
+                                                                  2**k))
+        return EmissionPyramid(pyramid_group, source)
+
     def add_emission_tot(self, chunksize=2**19, comp_filter=default_compression,
                          overwrite=False, params=dict(),
-                         chunkslice='bytes'):
+                         chunkslice='bytes', quantize=None, full_scale=1.):
         """Add the `emission_tot` array in '/trajectories'.
+
+        If `quantize` is 'uint16' or 'uint8', the emission is stored as
+        fixed-point integers in units of `scale = full_scale / max_int`,
+        saved in the array attribute 'scale' (see :func:`quantize`).
         """
+        atom, params = _quantized_atom(quantize, full_scale, params)
         kwargs = dict(overwrite=overwrite, chunksize=chunksize, params=params,
-                      comp_filter=comp_filter, atom=tables.Float32Atom(),
+                      comp_filter=comp_filter, atom=atom,
                       title='Summed emission trace of all the particles')
         return self.add_trajectory('emission_tot', **kwargs)
 
     def add_emission(self, chunksize=2**19, comp_filter=default_compression,
-                     overwrite=False, params=dict(), chunkslice='bytes'):
+                     overwrite=False, params=dict(), chunkslice='bytes',
+                     sparse=False, quantize=None, full_scale=1.):
         """Add the `emission` array in '/trajectories'.
+
+        If `sparse` is True, add a :class:`SparseArray` instead.
+        For `quantize` and `full_scale` see :meth:`add_emission_tot`.
         """
         nparams = self.numeric_params
         num_particles = nparams['np']
 
+        atom, params = _quantized_atom(quantize, full_scale, params)
+        if sparse:
+            return self.add_sparse_trajectory(
+                'emission', shape=(num_particles, 0), overwrite=overwrite,
+                chunksize=chunksize, comp_filter=comp_filter, atom=atom,
+                title='Emission trace of each particle (sparse)',
+                params=params)
         return self.add_trajectory('emission', shape=(num_particles, 0),
                                    overwrite=overwrite, chunksize=chunksize,
-                                   comp_filter=comp_filter,
-                                   atom=tables.Float32Atom(),
+                                   comp_filter=comp_filter, atom=atom,
                                    title='Emission trace of each particle',
                                    params=params)
 
     def add_position(self, radial=False, chunksize=2**19, chunkslice='bytes',
                      comp_filter=default_compression, overwrite=False,
-                     params=dict()):
+                     params=dict(), sparse=False, encoding=None, bounds=None):
         """Add the `position` array in '/trajectories'.
+
+        If `sparse` is True, add a :class:`SparseArray` instead, where the
+        positions not stored are NaN. If `encoding` is 'int16', add a
+        :class:`FixedPointArray` with the positions relative to `bounds`
+        (array of shape (num_coords, 2) with the interval of each
+        coordinate, e.g. `Box.b`).
         """
         nparams = self.numeric_params
         num_particles = nparams['np']
@@ -222,6 +760,24 @@ class TrajectoryStore(BaseStore):
         if radial:
             name, ncoords, prefix = 'position_rz', 2, 'R-Z'
         title = '%s position trace of each particle' % prefix
+        if sparse:
+            return self.add_sparse_trajectory(
+                name, shape=(num_particles, ncoords, 0), overwrite=overwrite,
+                chunksize=chunksize, comp_filter=comp_filter,
+                title=title + ' (sparse)', params=params,
+                fill_value=np.nan)
+        if encoding is not None:
+            if encoding != 'int16':
+                raise ValueError("`encoding` must be None or 'int16'.")
+            bounds = np.asarray(bounds, dtype='float64')
+            params = dict(params, encoding=encoding, offset=bounds[:, 0],
+                          scale=(bounds[:, 1] - bounds[:, 0]) / 65535)
+            earray = self.add_trajectory(
+                name, shape=(num_particles, ncoords, 0), overwrite=overwrite,
+                chunksize=chunksize, comp_filter=comp_filter,
+                atom=tables.Int16Atom(), title=title + ' (int16)',
+                params=params)
+            return FixedPointArray(earray)
         return self.add_trajectory(name, shape=(num_particles, ncoords, 0),
                                    overwrite=overwrite, chunksize=chunksize,
                                    comp_filter=comp_filter,
@@ -232,7 +788,7 @@ class TrajectoryStore(BaseStore):
 
 class TimestampStore(BaseStore):
     def __init__(self, datafile, path='./', nparams=dict(), attr_params=dict(),
-                 mode='r'):
+                 mode='r', backend=None):
         """Return a new HDF5 file to store simulation results.
 
         The HDF5 file has two groups:
@@ -245,7 +801,7 @@ class TimestampStore(BaseStore):
         If `overwrite=True` (default) `datafile` is overwritten (if exists).
         """
         super().__init__(datafile, path=path, nparams=nparams,
-                         attr_params=attr_params, mode=mode)
+                         attr_params=attr_params, mode=mode, backend=backend)
         if mode != 'r':
             if 'timestamps' not in self.h5file.root:
                 # Create the groups
@@ -6,6 +6,8 @@ Running the tests requires `py.test`.
 
 import pytest
 import numpy as np
+import scipy.interpolate as SI
+import tables
 import json
 
 import pybromo as pbm
@@ -47,6 +49,24 @@ def create_diffusion_sim():
     return S.hash()[:6]
 
 
+def create_box():
+    return pbm.Box(x1=-4.e-6, x2=4.e-6, y1=-4.e-6, y2=4.e-6, z1=-6e-6, z2=6e-6)
+
+
+def create_particles(num_particles, D=12e-12, box=None):
+    if box is None:
+        box = create_box()
+    return pbm.Particles(num_particles=num_particles, D=D, box=box,
+                         rs=np.random.RandomState(_SEED))
+
+
+def create_sim(P, t_max, psf=None, **kwargs):
+    if psf is None:
+        psf = pbm.NumericPSF()
+    return pbm.ParticlesSimulation(t_step=0.5e-6, t_max=t_max, particles=P,
+                                   box=P.box, psf=psf, **kwargs)
+
+
 def test_Box():
     box = pbm.Box(0, 1, 0, 1, 0, 2)
     assert (box.b == np.array([[0, 1], [0, 1], [0, 2]])).all()
@@ -224,3 +244,1080 @@ def test_TimestampSimulation():
     rs = np.random.RandomState(_SEED)
     mix_sim.run(rs=rs, overwrite=False)
     mix_sim.save_photon_hdf5()
+
+
+def _sim_trajectories_loop(S, time_size, start_pos, rs, total_emission=False,
+                           save_pos=False, radial=False,
+                           wrap_func=pbm.diffusion.wrap_periodic):
+    """Reference implementation simulating one particle at a time."""
+    time_size = int(time_size)
+    if total_emission:
+        em = np.zeros(time_size, dtype=np.float32)
+    else:
+        em = np.zeros((S.num_particles, time_size), dtype=np.float32)
+    POS = []
+    for i, sigma_1d in enumerate(S.sigma_1d):
+        delta_pos = rs.normal(loc=0, scale=sigma_1d, size=3 * time_size)
+        delta_pos = delta_pos.reshape(3, time_size)
+        pos = np.cumsum(delta_pos, axis=-1, out=delta_pos)
+        pos += start_pos[i]
+        for coord in (0, 1, 2):
+            pos[coord] = wrap_func(pos[coord], *S.box.b[coord])
+        Ro = np.sqrt(pos[0]**2 + pos[1]**2)
+        Z = pos[2]
+        current_em = S.psf.eval_xz(Ro, Z)**2
+        if total_emission:
+            em += current_em.astype(np.float32)
+        else:
+            em[i] = current_em.astype(np.float32)
+        if save_pos:
+            pos_save = np.vstack((Ro, Z)) if radial else pos
+            POS.append(pos_save[np.newaxis, :, :])
+        start_pos[i] = pos[:, -1:]
+    return POS, em
+
+
+def test_sim_trajectories_blocks():
+    P = create_particles(20)
+    P.add(num_particles=15, D=6e-12)
+    S = create_sim(P, t_max=0.001)
+    time_size = 1000
+    for wrap_func in [pbm.diffusion.wrap_mirror, pbm.diffusion.wrap_periodic]:
+        for total_emission in [True, False]:
+            for radial in [True, False]:
+                start_pos_ref = P.positions
+                POS_ref, em_ref = _sim_trajectories_loop(
+                    S, time_size, start_pos_ref,
+                    rs=np.random.RandomState(_SEED), save_pos=True,
+                    total_emission=total_emission, radial=radial,
+                    wrap_func=wrap_func)
+                for block_size in [None, 1, 8]:
+                    start_pos = P.positions
+                    POS, em = S._sim_trajectories(
+                        time_size, start_pos, rs=np.random.RandomState(_SEED),
+                        total_emission=total_emission, save_pos=True,
+                        radial=radial, wrap_func=wrap_func,
+                        block_size=block_size)
+                    assert (em == em_ref).all()
+                    assert (start_pos == start_pos_ref).all()
+                    assert (np.vstack(POS) == np.vstack(POS_ref)).all()
+
+
+def test_sim_trajectories_random_streams():
+    P = create_particles(20)
+    P.add(num_particles=15, D=6e-12)
+    S = create_sim(P, t_max=0.001)
+    rs = pbm.diffusion.RandomStreams(_SEED)
+    for total_emission in [True, False]:
+        results = []
+        for num_threads, block_size in [(1, None), (1, 3), (2, None), (4, 5)]:
+            start_pos = P.positions
+            sim = [S._sim_trajectories(1000, start_pos, rs=rs, i_chunk=i,
+                                       total_emission=total_emission,
+                                       save_pos=True, block_size=block_size,
+                                       num_threads=num_threads)
+                   for i in range(2)]
+            results.append((start_pos, sim))
+        start_pos_ref, sim_ref = results[0]
+        for start_pos, sim in results[1:]:
+            assert (start_pos == start_pos_ref).all()
+            for (POS, em), (POS_ref, em_ref) in zip(sim, sim_ref):
+                assert (em == em_ref).all()
+                assert (np.vstack(POS) == np.vstack(POS_ref)).all()
+
+    # Different chunks and particles use different random numbers
+    x = rs.normal(1, (2, 3, 10), 0, 0)
+    assert (x[0] != x[1]).all()
+    assert (x != rs.normal(1, (2, 3, 10), 0, 1)).all()
+
+    with pytest.raises(ValueError):
+        S._sim_trajectories(1000, P.positions, np.random.RandomState(_SEED),
+                            num_threads=2)
+
+
+def test_sim_trajectories_time_parallel():
+    P = create_particles(3)
+    S = create_sim(P, t_max=0.01)
+    rs = pbm.diffusion.RandomStreams(_SEED)
+    time_sizes = [2000] * 6 + [500]
+    for wrap_func in [pbm.diffusion.wrap_mirror, pbm.diffusion.wrap_periodic]:
+        for total_emission in [True, False]:
+            kw = dict(total_emission=total_emission, save_pos=True,
+                      wrap_func=wrap_func)
+            start_pos_ref = P.positions
+            sim_ref = list(S._iter_sim_trajectories(time_sizes, start_pos_ref,
+                                                    rs, **kw))
+            for num_threads in (1, 3, 4):
+                start_pos = P.positions
+                sim = list(S._iter_sim_trajectories(
+                    time_sizes, start_pos, rs, time_parallel=True,
+                    num_threads=num_threads, **kw))
+                assert len(sim) == len(sim_ref)
+                assert (start_pos == start_pos_ref).all()
+                for (POS, em), (POS_ref, em_ref) in zip(sim, sim_ref):
+                    assert (em == em_ref).all()
+                    assert (np.vstack(POS) == np.vstack(POS_ref)).all()
+
+
+def test_rng_backends():
+    for backend in pbm.diffusion.RNG_BACKENDS:
+        rs = pbm.diffusion.new_rng(_SEED, backend=backend)
+        state = pbm.diffusion.get_rng_state(rs)
+        x = rs.normal(size=10)
+        rs2 = pbm.diffusion.rng_from_state(state)
+        assert type(rs2) is type(rs)
+        assert (rs2.normal(size=10) == x).all()
+        pbm.diffusion.set_rng_state(rs2, state)
+        assert (rs2.normal(size=10) == x).all()
+    rs = pbm.diffusion.new_rng(_SEED)
+    assert randomstate_equal(rs, np.random.RandomState(_SEED))
+    with pytest.raises(ValueError):
+        pbm.diffusion.new_rng(_SEED, backend='mt')
+
+    streams = pbm.diffusion.RandomStreams(_SEED, backend='philox')
+    streams2 = pbm.diffusion.rng_from_state(streams.get_state())
+    assert (streams.normal(1, (2, 3, 4), 0, 1) ==
+            streams2.normal(1, (2, 3, 4), 0, 1)).all()
+
+    # 'legacy' is MT19937 for new_rng, not supported by RandomStreams
+    with pytest.raises(ValueError):
+        pbm.diffusion.RandomStreams(_SEED, backend='legacy')
+    streams = pbm.diffusion.RandomStreams(_SEED)
+    assert streams.backend == 'randomstate-pcg64'
+    assert isinstance(streams.stream(0, 0), np.random.RandomState)
+    state = dict(streams.get_state(), backend='legacy')
+    streams2 = pbm.diffusion.rng_from_state(state)
+    assert (streams.normal(1, (2, 3, 4), 0, 1) ==
+            streams2.normal(1, (2, 3, 4), 0, 1)).all()
+
+
+def test_diffusion_sim_generator():
+    box = create_box()
+    P = pbm.Particles(num_particles=20, D=12e-12, box=box, seed=_SEED,
+                      rng_backend='pcg64')
+    assert isinstance(P.rs, np.random.Generator)
+    assert isinstance(P.init_random_state, dict)
+    P2 = pbm.Particles(num_particles=20, D=12e-12, box=box,
+                       rs=pbm.diffusion.rng_from_state(P.init_random_state))
+    assert P.to_list() == P2.to_list()
+
+    S = create_sim(P, t_max=0.01, ID=1)
+    rs = pbm.diffusion.new_rng(_SEED, backend='pcg64')
+    init_state = pbm.diffusion.get_rng_state(rs)
+    S.simulate_diffusion(total_emission=False, rs=rs, chunksize=2**13,
+                         verbose=False)
+    assert S.traj_group._v_attrs['init_random_state'] == init_state
+    assert (S.traj_group._v_attrs['last_random_state'] ==
+            pbm.diffusion.get_rng_state(rs))
+
+    kw = dict(max_rates=(200e3,), populations=(slice(0, 20),), bg_rate=1000)
+    S.simulate_timestamps_mix(seed=_SEED, rng_backend='philox', **kw)
+    last_state = S.ts_group._v_attrs['last_random_state']
+    assert last_state['bit_generator'] == 'Philox'
+    # The random stream is resumed from the last saved state
+    S.simulate_timestamps_mix(**kw)
+    assert (pbm.hash_(S._timestamps.attrs['init_random_state']) ==
+            pbm.hash_(last_state))
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_cumsum_rebased():
+    rs = np.random.RandomState(_SEED)
+    x = rs.normal(size=(2, 3, 10000))
+    x32 = x.astype('float32')
+    total = pbm.diffusion.cumsum_rebased(x32, rebase_steps=1000)
+    assert total.dtype == np.float64
+    assert np.allclose(total, x.sum(axis=-1, keepdims=True), atol=1e-4)
+    assert np.allclose(x32, np.cumsum(x, axis=-1), atol=1e-4)
+
+
+def test_sim_trajectories_float32():
+    P = create_particles(4)
+    S = create_sim(P, t_max=0.01)
+    time_sizes = [5000, 5000, 3000]
+    kw = dict(total_emission=False, save_pos=True)
+    start_pos_ref = P.positions
+    sim_ref = list(S._iter_sim_trajectories(
+        time_sizes, start_pos_ref, np.random.RandomState(_SEED), **kw))
+    start_pos = P.positions
+    sim = list(S._iter_sim_trajectories(
+        time_sizes, start_pos, np.random.RandomState(_SEED), dtype='float32',
+        **kw))
+    # Positions differ by much less than the PSF grid step (62.5 nm)
+    assert start_pos.dtype == np.float64
+    assert np.abs(start_pos - start_pos_ref).max() < 1e-10
+    for (POS, em), (POS_ref, em_ref) in zip(sim, sim_ref):
+        assert POS[0].dtype == np.float32
+        assert np.abs(np.vstack(POS) - np.vstack(POS_ref)).max() < 1e-10
+        assert np.allclose(em, em_ref, rtol=1e-3, atol=1e-6)
+
+
+def test_sim_trajectories_coarse_step():
+    P = create_particles(500)
+    S = create_sim(P, t_max=0.01)
+    with pytest.raises(ValueError):
+        S._sim_trajectories(100, P.positions, np.random.RandomState(_SEED),
+                            save_pos=True, coarse_step=10)
+
+    # With a support covering the whole box all the intervals are refined.
+    # Using a "PSF" equal to z, the emission is z**2 and its average
+    # over the particles must be sigma**2 * k after k steps.
+    class LinearPSF:
+        kind = 'linear'
+
+        def eval_xz(self, x, z):
+            return z
+
+    S_lin = create_sim(P, t_max=0.01, psf=LinearPSF())
+    time_size = 2000
+    expected = S.sigma_1d[0]**2 * np.arange(1, time_size + 1)
+    for coarse_step in (None, 100, 300):
+        start_pos = np.zeros((S.num_particles, 3, 1))
+        _, em = S_lin._sim_trajectories(time_size, start_pos,
+                                        np.random.RandomState(_SEED),
+                                        coarse_step=coarse_step,
+                                        psf_support=(1, 1))
+        assert em.shape == (S.num_particles, time_size)
+        assert np.abs(em.mean() / expected.mean() - 1) < 0.1
+        # The end-points are exact
+        assert np.allclose(start_pos[:, 2, 0]**2, em[:, -1])
+
+    # The emission is zero for particles far from the PSF
+    start_pos = np.zeros((S.num_particles, 3, 1))
+    start_pos[:, :2] = 3.9e-6
+    start_pos[:, 2] = 5.9e-6
+    for wrap_func in [pbm.diffusion.wrap_mirror, pbm.diffusion.wrap_periodic]:
+        _, em = S._sim_trajectories(1999, start_pos.copy(),
+                                    np.random.RandomState(_SEED),
+                                    coarse_step=100, wrap_func=wrap_func)
+        assert em.shape == (S.num_particles, 1999)
+        assert (em == 0).all()
+
+
+def test_support_overlap():
+    overlap = pbm.diffusion.support_overlap
+    lo = np.array([-3., 1., 5., 9., -9.])
+    hi = lo + 1
+    assert (overlap(lo, hi, 1, -4, 4) == [0, 1, 0, 1, 1]).all()
+    assert (overlap(lo, hi, 1, -4, 4, pbm.diffusion.wrap_mirror)
+            == [0, 1, 0, 1, 1]).all()
+    assert (overlap(lo + 4, hi + 4, 1, -4, 4) == [1, 0, 1, 0, 0]).all()
+
+
+def test_sim_trajectories_psf_cull():
+    P = create_particles(30)
+    S = create_sim(P, t_max=0.01)
+    psf_support = (1e-6, 2e-6)
+    kw = dict(total_emission=False, save_pos=True, psf_support=psf_support)
+    positions = P.positions
+    positions[:5] = 0
+    for wrap_func in [pbm.diffusion.wrap_mirror, pbm.diffusion.wrap_periodic]:
+        start_pos_ref = positions.copy()
+        POS_ref, em_ref = S._sim_trajectories(
+            5000, start_pos_ref, np.random.RandomState(_SEED),
+            wrap_func=wrap_func, **kw)
+        start_pos = positions.copy()
+        POS, em = S._sim_trajectories(
+            5000, start_pos, np.random.RandomState(_SEED),
+            wrap_func=wrap_func, psf_cull=True, **kw)
+        assert (start_pos == start_pos_ref).all()
+        assert (np.vstack(POS) == np.vstack(POS_ref)).all()
+        # Particles outside the support have zero emission, the others
+        # have the same emission as without culling.
+        pos = np.vstack(POS)
+        Ro = np.sqrt(pos[:, 0]**2 + pos[:, 1]**2)
+        outside = ((Ro > psf_support[0]).all(axis=-1) +
+                   (np.abs(pos[:, 2]) > psf_support[1]).all(axis=-1))
+        assert outside.any() and not outside.all()
+        assert (em[outside] == 0).all()
+        culled = (em == 0).all(axis=-1)
+        assert (em[~culled] == em_ref[~culled]).all()
+
+    # The total emission with the PSF grid as support is unchanged
+    # except for the PSF values clamped outside the grid
+    _, em_ref = S._sim_trajectories(5000, P.positions,
+                                    np.random.RandomState(_SEED),
+                                    total_emission=True)
+    _, em = S._sim_trajectories(5000, P.positions,
+                                np.random.RandomState(_SEED),
+                                total_emission=True, psf_cull=True)
+    assert np.allclose(em, em_ref, rtol=0, atol=1e-6)
+
+
+def test_psf_emission_lut():
+    psf = pbm.NumericPSF()
+    hash_ = psf.hash()
+    rs = np.random.RandomState(_SEED)
+    x = rs.uniform(-0.5e-6, 4.5e-6, size=10**5)
+    z = rs.uniform(-6.5e-6, 6.5e-6, size=10**5)
+    em = np.empty(x.size, dtype=np.float32)
+    res = psf.emission_xz(x, z, out=em)
+    assert res is em
+    assert psf.hash() == hash_
+    inside = (x >= 0) * (x <= psf.xi[-1] * 1e-6) * (np.abs(z) <= 6e-6)
+    assert np.abs(em - psf.eval_xz(x, z)**2)[inside].max() < 2e-3
+    assert (em[~inside] == 0).all()
+    # Exact on the grid points
+    xi, zi = np.meshgrid(psf.xi * 1e-6, psf.zi * 1e-6)
+    assert np.allclose(psf.emission_xz(xi, zi), psf.hdata**2, atol=1e-6)
+    # Temporary arrays in a workspace
+    workspace = pbm.workspace.Workspace()
+    em2 = psf.emission_xz(x, z, workspace=workspace)
+    assert (em2 == em).all()
+    nbytes = workspace.nbytes
+    psf.emission_xz(x, z, out=em2, workspace=workspace)
+    assert workspace.nbytes == nbytes
+
+    # PSF grid not starting at 0
+    psf = pbm.NumericPSF()
+    psf.xi = psf.xi + 0.5
+    psf._fun_um = SI.RectBivariateSpline(psf.xi, psf.zi, psf.hdata.T,
+                                         kx=1, ky=1)
+    xi, zi = np.meshgrid(psf.xi * 1e-6, psf.zi * 1e-6)
+    assert np.allclose(psf.emission_xz(xi, zi), psf.hdata**2, atol=1e-6)
+    inside = (x >= 0.5e-6) * (x <= psf.xi[-1] * 1e-6) * (np.abs(z) <= 6e-6)
+    em = psf.emission_xz(x, z)
+    assert np.abs(em - psf.eval_xz(x, z)**2)[inside].max() < 2e-3
+    assert (em[~inside] == 0).all()
+
+
+def test_sim_trajectories_psf_lut():
+    P = create_particles(20)
+    S = create_sim(P, t_max=0.01)
+    _, em_ref = S._sim_trajectories(5000, P.positions,
+                                    np.random.RandomState(_SEED))
+    _, em = S._sim_trajectories(5000, P.positions,
+                                np.random.RandomState(_SEED), psf_lut=True)
+    assert em.dtype == np.float32
+    assert np.abs(em - em_ref).max() < 2e-3
+
+
+def test_gaussian_psf(tmp_path):
+    psf = pbm.GaussianPSF(sx=0.3e-6, sy=0.3e-6, sz=0.9e-6)
+    x = np.array([0, 0.3e-6, 0, 0.3e-6])
+    z = np.array([0, 0, 0.9e-6, 0.9e-6])
+    assert np.allclose(psf.eval_xz(x, z),
+                       np.exp(-0.5 * np.array([0, 1, 1, 2])))
+    em = psf.emission_xz(x, z)
+    assert em.dtype == np.float32
+    assert np.allclose(em, psf.eval_xz(x, z)**2)
+    assert np.allclose(psf.eval(x, np.zeros(4), z), psf.eval_xz(x, z))
+    out = np.zeros(4, dtype=np.float32)
+    assert psf.emission_xyz(x, np.zeros(4), z, out=out) is out
+    assert np.allclose(out, em)
+
+    # Simulation and reload from disk
+    P = create_particles(10)
+    S = create_sim(P, t_max=0.001, psf=psf)
+    S.simulate_diffusion(total_emission=False, save_pos=True, verbose=False,
+                         path=str(tmp_path))
+    try:
+        pos = S.position[:].reshape(S.num_particles, 3, -1)
+        Ro = np.sqrt(pos[:, 0]**2 + pos[:, 1]**2)
+        assert np.allclose(S.emission[:], psf.emission_xz(Ro, pos[:, 2]))
+    finally:
+        S.store.close()
+    S2 = pbm.ParticlesSimulation.from_datafile(S.hash()[:6], path=tmp_path)
+    try:
+        assert isinstance(S2.psf, pbm.GaussianPSF)
+        assert S2.psf.hash() == psf.hash()
+    finally:
+        S2.store.close()
+        if hasattr(S2, 'ts_store'):
+            S2.ts_store.close()
+
+
+def test_sim_trajectories_workspace():
+    P = create_particles(12)
+    S = create_sim(P, t_max=0.01)
+    workspace = pbm.workspace.Workspace()
+    for backend in ['randomstate-pcg64', 'pcg64']:
+        rs = pbm.diffusion.RandomStreams(_SEED, backend=backend)
+        for total_emission in [True, False]:
+            for num_threads in [1, 3]:
+                kw = dict(total_emission=total_emission, block_size=4,
+                          num_threads=num_threads)
+                start_pos_ref = P.positions
+                start_pos = P.positions
+                for i_chunk, time_size in enumerate([3000, 3000, 1000]):
+                    _, em_ref = S._sim_trajectories(
+                        time_size, start_pos_ref, rs, i_chunk=i_chunk, **kw)
+                    _, em = S._sim_trajectories(
+                        time_size, start_pos, rs, i_chunk=i_chunk,
+                        workspace=workspace, **kw)
+                    assert (em == em_ref).all()
+                    assert (start_pos == start_pos_ref).all()
+                    if i_chunk == 0:
+                        nbytes = workspace.nbytes
+                    assert workspace.nbytes == nbytes
+
+    # Trajectories saved from several blocks are not overwritten
+    for radial in [False, True]:
+        rs = pbm.diffusion.RandomStreams(_SEED, backend='pcg64')
+        kw = dict(total_emission=False, block_size=4, save_pos=True,
+                  radial=radial)
+        POS_ref, em_ref = S._sim_trajectories(3000, P.positions, rs, **kw)
+        POS, em = S._sim_trajectories(3000, P.positions, rs,
+                                      workspace=workspace, **kw)
+        assert len(POS) == 3
+        assert (np.vstack(POS) == np.vstack(POS_ref)).all()
+        assert (em == em_ref).all()
+
+    counts_ref = pbm.diffusion.sim_timetrace_bg(
+        em_ref, 1e6, 1e4, S.t_step, rs=np.random.RandomState(_SEED))
+    counts = pbm.diffusion.sim_timetrace_bg(
+        em_ref, 1e6, 1e4, S.t_step, rs=np.random.RandomState(_SEED),
+        workspace=workspace)
+    assert (counts == counts_ref).all()
+
+
+def test_boundary_kernels():
+    rs = np.random.RandomState(_SEED)
+    a1, a2 = -4e-6, 4e-6
+    x = rs.uniform(-30e-6, 30e-6, size=(5, 1000))
+    inside = (x >= a1) * (x <= a2)
+    x_in = x[inside]
+    for kernel, ref_func in [(pbm.boundary.periodic,
+                              pbm.diffusion.wrap_periodic),
+                             (pbm.boundary.mirror, None)]:
+        a = x.copy()
+        res = kernel(a, a1, a2)
+        assert res is a
+        assert ((a >= a1) * (a <= a2)).all()
+        assert (a[inside] == x_in).all()
+        if ref_func is not None:
+            assert np.allclose(a, ref_func(x.copy(), a1, a2), rtol=0,
+                               atol=1e-18)
+    # Mirror with up to one reflection is the same as wrap_mirror
+    x = rs.uniform(-12e-6, 12e-6, size=1000)
+    assert np.allclose(pbm.boundary.mirror(x.copy(), a1, a2),
+                       pbm.diffusion.wrap_mirror(x.copy(), a1, a2))
+    # Multiple reflections
+    a = np.array([9e-6, 13e-6, -21e-6])
+    assert np.allclose(pbm.boundary.mirror(a, a1, a2), [-1e-6, -3e-6, -3e-6])
+    # PSF support test
+    overlap = pbm.diffusion.support_overlap
+    lo = np.array([-3., 1., 5., 9., -9., 15.])
+    hi = lo + 1
+    assert (overlap(lo, hi, 1, -4, 4, pbm.boundary.mirror)
+            == [0, 1, 0, 1, 1, 1]).all()
+
+
+def test_boundary_reservoir():
+    box = pbm.Box(x1=-2.e-6, x2=2.e-6, y1=-2.e-6, y2=2.e-6, z1=-3e-6, z2=3e-6)
+    P = create_particles(10, D=60e-12, box=box)
+    S = create_sim(P, t_max=0.01)
+    for wrap_func in [pbm.boundary.periodic, pbm.boundary.mirror]:
+        POS_ref, em_ref = S._sim_trajectories(
+            20000, P.positions, np.random.RandomState(_SEED),
+            save_pos=True, wrap_func=wrap_func)
+        assert ((np.vstack(POS_ref) >= box.b[:, :1]) *
+                (np.vstack(POS_ref) <= box.b[:, 1:])).all()
+
+    reservoir = pbm.boundary.Reservoir(seed=_SEED)
+    start_pos = P.positions
+    POS, em = S._sim_trajectories(20000, start_pos,
+                                  np.random.RandomState(_SEED),
+                                  save_pos=True, wrap_func=reservoir)
+    pos = np.vstack(POS)
+    assert ((pos >= box.b[:, :1]) * (pos <= box.b[:, 1:])).all()
+    assert (start_pos == pos[:, :, -1:]).all()
+    # The particles have been reinjected at least once
+    steps = np.abs(np.diff(pos, axis=-1)).max(axis=(1, 2))
+    assert (steps > 10 * S.sigma_1d[0]).any()
+    with pytest.raises(ValueError):
+        S._sim_trajectories(100, start_pos, np.random.RandomState(_SEED),
+                            wrap_func=reservoir, psf_cull=True)
+
+    # A Generator can be used for the reinjection points
+    reservoir = pbm.boundary.Reservoir(rs=np.random.default_rng(1))
+    point = reservoir.surface_point(box.b, depth=1e-8)
+    assert ((point >= box.b[:, 0] + 1e-8) *
+            (point <= box.b[:, 1] - 1e-8)).all()
+    assert np.isclose(np.abs(point[:, np.newaxis] - box.b).min(), 1e-8,
+                      rtol=1e-6, atol=0)
+
+    # The concentration stays uniform: same occupancy of the 4 quarters
+    # of the box along each axis
+    P = create_particles(1000, D=60e-12, box=box)
+    S = create_sim(P, t_max=0.01)
+    POS, em = S._sim_trajectories(2000, P.positions,
+                                  np.random.default_rng(_SEED),
+                                  save_pos=True, wrap_func=reservoir)
+    pos = np.vstack(POS)
+    assert ((pos >= box.b[:, :1]) * (pos <= box.b[:, 1:])).all()
+    rel_pos = (pos - box.b[:, :1]) / (box.b[:, 1:] - box.b[:, :1])
+    for coord in (0, 1, 2):
+        occupancy = np.histogram(rel_pos[:, coord], bins=4,
+                                 range=(0, 1))[0] / rel_pos[:, coord].size
+        assert np.allclose(occupancy, 0.25, rtol=0, atol=0.05)
+
+
+def test_sparse_storage(tmp_path):
+    P = create_particles(10)
+    for particle in list(P)[:3]:
+        particle.x0 = particle.y0 = particle.z0 = 0
+    psf = pbm.GaussianPSF(sx=0.3e-6, sy=0.3e-6, sz=0.9e-6)
+
+    def simulate(**kwargs):
+        S = create_sim(P, t_max=0.002, psf=psf)
+        S.simulate_diffusion(total_emission=False, save_pos=True,
+                             chunksize=2**13, verbose=False,
+                             path=str(tmp_path), **kwargs)
+        try:
+            kw = dict(max_rates=(400e3,), populations=(slice(0, 10),),
+                      bg_rate=1000, rs=np.random.RandomState(_SEED))
+            S.simulate_timestamps_mix(t_chunksize=2**10, **kw)
+            ts = [node.read() for node in S.ts_store.h5file.root.timestamps]
+            em, pos = S.emission[:], S.position[:]
+        finally:
+            S.store.close()
+            if hasattr(S, 'ts_store'):
+                S.ts_store.close()
+        return em, pos, ts
+
+    em_ref, pos_ref, ts_ref = simulate()
+    threshold = 1e-3
+    em, pos, ts = simulate(sparse=True, sparse_threshold=threshold)
+    mask = em_ref > threshold
+    assert 0 < mask.sum() < mask.size
+    assert (em == np.where(mask, em_ref, 0)).all()
+    assert (pos.transpose(0, 2, 1)[mask] ==
+            pos_ref.transpose(0, 2, 1)[mask]).all()
+    assert np.isnan(pos.transpose(0, 2, 1)[~mask]).all()
+
+    # Lossless sparse storage gives the same timestamps
+    em, pos, ts = simulate(sparse=True)
+    assert (em == em_ref).all()
+    assert all((t == t_ref).all() for t, t_ref in zip(ts, ts_ref))
+
+    S = pbm.ParticlesSimulation.from_datafile(
+        create_sim(P, t_max=0.002, psf=psf).hash()[:6], path=tmp_path)
+    try:
+        assert isinstance(S.emission, pbm.storage.SparseArray)
+        assert S.emission.shape == em_ref.shape
+        assert (S.emission[:, 100:3000:7] == em_ref[:, 100:3000:7]).all()
+        assert (S.emission[3, -5] == em_ref[3, -5]).all()
+        out = np.zeros((10, 1000), dtype=np.float32)
+        assert (S.emission.read(2000, 3000, out=out) ==
+                em_ref[:, 2000:3000]).all()
+        assert (out == em_ref[:, 2000:3000]).all()
+    finally:
+        S.store.close()
+        S.ts_store.close()
+
+
+def test_quantized_emission(tmp_path):
+    P = create_particles(10)
+    for particle in list(P)[:3]:
+        particle.x0 = particle.y0 = particle.z0 = 0
+    psf = pbm.GaussianPSF(sx=0.3e-6, sy=0.3e-6, sz=0.9e-6)
+
+    def simulate(**kwargs):
+        S = create_sim(P, t_max=0.002, psf=psf)
+        S.simulate_diffusion(total_emission=False, chunksize=2**13,
+                             verbose=False, path=str(tmp_path), **kwargs)
+        try:
+            kw = dict(max_rates=(2e6,), populations=(slice(0, 10),),
+                      bg_rate=1000, rs=np.random.RandomState(_SEED))
+            S.simulate_timestamps_mix(t_chunksize=2**10, **kw)
+            ts = [node.read() for node in S.ts_store.h5file.root.timestamps]
+            em, scale = S.emission[:], pbm.storage.emission_scale(S.emission)
+        finally:
+            S.store.close()
+            if hasattr(S, 'ts_store'):
+                S.ts_store.close()
+        return em, scale, ts
+
+    em_ref, scale, ts_ref = simulate()
+    assert scale == 1
+    for quantize, sparse in [('uint16', False), ('uint8', True)]:
+        em, scale, ts = simulate(quantize=quantize, sparse=sparse)
+        assert em.dtype == np.dtype(quantize)
+        assert scale == 1 / np.iinfo(quantize).max
+        assert np.abs(em * scale - em_ref).max() <= scale / 2 + 1e-7
+        # The number of photons changes only by the quantization error
+        assert abs(ts[0].size - ts_ref[0].size) < 0.05 * ts_ref[0].size
+
+
+def test_position_encoding(tmp_path):
+    P = create_particles(10)
+    for radial in [False, True]:
+        positions = []
+        for pos_encoding in [None, 'int16']:
+            S = create_sim(P, t_max=0.002)
+            S.simulate_diffusion(save_pos=True, radial=radial,
+                                 chunksize=2**13, pos_encoding=pos_encoding,
+                                 verbose=False, path=str(tmp_path))
+            try:
+                positions.append(S.position[:])
+            finally:
+                S.store.close()
+        pos_ref, pos = positions
+        assert pos.dtype == np.float32
+        assert np.abs(pos - pos_ref).max() < 12e-6 / 65535
+
+    S = pbm.ParticlesSimulation.from_datafile(S.hash()[:6], path=tmp_path)
+    try:
+        assert isinstance(S.position, pbm.storage.FixedPointArray)
+        assert S.position.shape == pos_ref.shape
+        assert (S.position[:, :, 100:3000:7] == pos[:, :, 100:3000:7]).all()
+        assert (S.position[3, 1, -5] == pos[3, 1, -5]).all()
+    finally:
+        S.store.close()
+
+
+def test_emission_pyramid(tmp_path):
+    P = create_particles(10)
+    for particle in list(P)[:3]:
+        particle.x0 = particle.y0 = particle.z0 = 0
+
+    def reduce(em, dec, stat):
+        n = em.shape[-1] // dec
+        em = em[..., :n * dec].reshape(em.shape[:-1] + (n, dec))
+        return getattr(np, stat)(em, axis=-1)
+
+    for total_emission, quantize in [(False, None), (True, 'uint16')]:
+        S = create_sim(P, t_max=0.002)
+        # Chunks of 819 (odd) time steps
+        S.simulate_diffusion(total_emission=total_emission, chunksize=2**13,
+                             quantize=quantize, quantize_max=4,
+                             pyramid_levels=[2, 4, 6], verbose=False,
+                             path=str(tmp_path))
+        try:
+            array = S.emission_tot if total_emission else S.emission
+            em = array[:] * pbm.storage.emission_scale(array)
+            pyramid = S.emission_tot_pyramid if total_emission else \
+                S.emission_pyramid
+            for stat in ['max', 'mean']:
+                for k in [2, 4, 6]:
+                    level = pyramid.group._f_get_child('%s_%d' % (stat, k))
+                    assert level.shape[-1] == em.shape[-1] // 2**k
+                    # Less than half a quantization step (3e-5)
+                    assert np.allclose(level[:], reduce(em, 2**k, stat),
+                                       rtol=0, atol=1e-5)
+                for start, stop, dec in [(0, 4000, 100), (128, 3968, 64),
+                                         (3, 3000, 10), (2048, 4000, 64)]:
+                    ref = reduce(em[..., start:stop], dec, stat)
+                    res = S.emission_decimated(start, stop, dec, stat=stat,
+                                               total=total_emission)
+                    assert res.shape == ref.shape
+                    assert np.allclose(res, ref, rtol=0, atol=1e-5)
+        finally:
+            S.store.close()
+
+    S = pbm.ParticlesSimulation.from_datafile(S.hash()[:6], path=tmp_path)
+    try:
+        assert S.emission_pyramid is None
+        assert S.emission_tot_pyramid.levels == [2, 4, 6]
+    finally:
+        S.store.close()
+
+
+def test_checkpoint_resume(tmp_path):
+    P = create_particles(10)
+    kwargs = dict(save_pos=True, total_emission=False, chunksize=2**13,
+                  seed=_SEED, verbose=False, path=str(tmp_path))
+
+    S = create_sim(P, t_max=0.002)
+    S.simulate_diffusion(**kwargs)
+    try:
+        emission, position = S.emission[:], S.position[:]
+    finally:
+        S.store.close()
+
+    # Interrupt the simulation while computing the 4th (of 5) chunk
+    S = create_sim(P, t_max=0.002)
+    sim_trajectories = S._sim_trajectories
+    calls = []
+
+    def crashing_sim_trajectories(*args, **kw):
+        calls.append(1)
+        if len(calls) == 4:
+            raise KeyboardInterrupt
+        return sim_trajectories(*args, **kw)
+
+    S._sim_trajectories = crashing_sim_trajectories
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            S.simulate_diffusion(checkpoint_every=2, **kwargs)
+        assert S.emission.nrows > 0
+    finally:
+        if hasattr(S, 'store'):
+            S.store.close()
+
+    S = create_sim(P, t_max=0.002)
+    S.simulate_diffusion(checkpoint_every=2, resume=True, **kwargs)
+    try:
+        assert np.array_equal(S.emission[:], emission)
+        assert np.array_equal(S.position[:], position)
+    finally:
+        S.store.close()
+
+
+def test_extend_simulation(tmp_path):
+    P = create_particles(8)
+    # Chunks of 1024 time steps, the extension starts at a chunk boundary
+    kwargs = dict(save_pos=True, chunksize=2**13, seed=_SEED, verbose=False,
+                  path=str(tmp_path))
+    S = create_sim(P, t_max=0.004096)
+    S.simulate_diffusion(**kwargs)
+    try:
+        emission, position = S.emission[:], S.position[:]
+    finally:
+        S.store.close()
+
+    S = create_sim(P, t_max=0.002048)
+    S.simulate_diffusion(**kwargs)
+    S.store.close()
+    S = pbm.ParticlesSimulation.from_datafile(S.hash()[:6], path=tmp_path)
+    try:
+        S.extend(0.002048, verbose=False)
+        assert S.n_samples == 8192
+        assert S.store.numeric_params['n_samples'] == 8192
+        assert S.store.numeric_params['t_max'] == S.t_max
+        assert np.array_equal(S.emission[:], emission)
+        assert np.array_equal(S.position[:], position)
+    finally:
+        S.store.close()
+
+    # The file names do not change when the rounded t_max changes
+    S = create_sim(P, t_max=0.01)
+    S.simulate_diffusion(total_emission=False, chunksize=2**15, seed=_SEED,
+                         verbose=False, path=str(tmp_path))
+    hash_ = S.hash()[:6]
+    try:
+        S.extend(0.01, verbose=False)
+        assert S.t_max == 0.02 and S.hash()[:6] == hash_
+        S.simulate_timestamps_mix(max_rates=(400e3,),
+                                  populations=(slice(0, 8),), bg_rate=1000,
+                                  rs=np.random.RandomState(_SEED))
+        assert S.ts_store.filepath.name.startswith('times_' + hash_)
+    finally:
+        S.store.close()
+        if hasattr(S, 'ts_store'):
+            S.ts_store.close()
+    S = pbm.ParticlesSimulation.from_datafile(hash_, path=tmp_path)
+    try:
+        assert S.t_max == 0.02 and S.n_samples == 40000
+        assert S.hash()[:6] == hash_
+        assert S.emission.shape == (8, 40000)
+        assert len(S.timestamp_names) == 1
+    finally:
+        S.store.close()
+        S.ts_store.close()
+
+
+def test_async_write(tmp_path):
+    P = create_particles(10)
+    results = []
+    for async_write in [False, True]:
+        S = create_sim(P, t_max=0.002)
+        S.simulate_diffusion(save_pos=True, total_emission=False,
+                             chunksize=2**13, seed=_SEED, verbose=False,
+                             async_write=async_write, flush_every=2,
+                             path=str(tmp_path))
+        try:
+            results.append((S.emission[:], S.position[:]))
+        finally:
+            S.store.close()
+    for data, data_async in zip(*results):
+        assert np.array_equal(data, data_async)
+
+    # Errors in the writer thread are raised in the caller
+    S = create_sim(P, t_max=0.002)
+    S.open_store_traj(chunksize=2**13, path=str(tmp_path))
+
+    def write(data):
+        S.emission.append(data)
+
+    try:
+        with pytest.raises(ValueError):
+            with pbm.writer.ChunkWriter(S.store.h5file,
+                                        background=True) as w:
+                w.submit(write, np.zeros((10, 100), dtype='float32'))
+                w.submit(write, np.zeros((3, 100), dtype='float32'))
+                w.wait()
+        assert S.emission.nrows == 100
+    finally:
+        S.store.close()
+
+
+def test_storage_backends(tmp_path):
+    P = create_particles(10)
+    for particle in list(P)[:3]:
+        particle.x0 = particle.y0 = particle.z0 = 0
+    kw = dict(max_rates=(400e3,), populations=(slice(0, 10),), bg_rate=1000)
+    results = {}
+    for backend in ['hdf5', 'npy', 'chunked']:
+        (tmp_path / backend).mkdir()
+        S = create_sim(P, t_max=0.002)
+        S.simulate_diffusion(save_pos=True, total_emission=False,
+                             chunksize=2**13, seed=_SEED, verbose=False,
+                             path=str(tmp_path / backend), backend=backend)
+        S.simulate_timestamps_mix(rs=np.random.RandomState(_SEED), **kw)
+        S.store.close()
+        S.ts_store.close()
+
+        S = pbm.ParticlesSimulation.from_datafile(S.hash()[:6],
+                                                  path=tmp_path / backend)
+        assert S.store.backend == S.ts_store.backend == backend
+        assert S.store.numeric_params['t_max'] == 0.002
+        assert S.box.volume == P.box.volume
+        timestamps, particles = S.get_timestamps_part(S.timestamp_names[0])
+        results[backend] = (S.emission[:], S.position[:, :, 10:20],
+                            S.emission.read(5, 3000, 7), timestamps[:],
+                            particles[:])
+        S.store.close()
+        S.ts_store.close()
+    for backend in ['npy', 'chunked']:
+        for data, ref in zip(results[backend], results['hdf5']):
+            assert np.array_equal(data, ref)
+
+    # Appends from several threads to the same array
+    from concurrent.futures import ThreadPoolExecutor
+    for backend in ['npy', 'chunked']:
+        h5file = pbm.backends.open_file(tmp_path / ('threads_' + backend),
+                                        mode='w', backend=backend)
+        array = h5file.create_earray('/', 'data', tables.Float32Atom(),
+                                     shape=(3, 0), chunkshape=(3, 64))
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda i: array.append(np.full((3, 50), i)),
+                              range(40)))
+        data = array.read()
+        assert data.shape == (3, 2000)
+        blocks = data[0].reshape(40, 50)
+        assert (blocks == blocks[:, :1]).all()
+        assert sorted(blocks[:, 0]) == list(range(40))
+        # Descriptions longer than the fixed .npy header are an error
+        if backend == 'npy':
+            with pytest.raises(ValueError):
+                h5file.create_earray('/', 'wide', tables.Float32Atom(),
+                                     shape=(0,) + (2,) * 40)
+            assert 'wide' not in h5file.root
+        h5file.close()
+
+
+def test_sim_timestamps_extraction():
+    P = create_particles(6)
+    S = create_sim(P, t_max=0.01)
+    # High rates to have bins with more than one count
+    emission = np.random.RandomState(1).rand(6, 5000).astype('float32')
+    max_rate, bg_rate, i_start, scale = 2e6, 1e5, 7000, 10
+    counts = pbm.diffusion.sim_timetrace_bg(
+        emission, max_rate, bg_rate, S.t_step, rs=np.random.RandomState(2))
+    assert counts.max() > 1
+
+    # Reference: timestamps of each particle and count level
+    ts_range = (np.arange(counts.shape[1]) + i_start) * scale
+    times_ref, particles_ref = [], []
+    for ip, counts_ip in enumerate(counts):
+        for v in range(1, counts.max() + 1):
+            t = ts_range[counts_ip >= v]
+            times_ref.append(t)
+            particles_ref.append(np.full(t.size, ip + 3, dtype='u1'))
+    times_ref = np.hstack(times_ref)
+    particles_ref = np.hstack(particles_ref)
+    index_sort = times_ref.argsort(kind='mergesort')
+
+    times, particles = S._sim_timestamps(
+        max_rate, bg_rate, emission, i_start, np.random.RandomState(2),
+        ip_start=3, scale=scale)
+    assert times.dtype == np.int64 and particles.dtype == np.uint8
+    assert np.array_equal(times, times_ref[index_sort])
+    assert np.array_equal(particles, particles_ref[index_sort])
+
+    # Runs of repeated values, also decreasing (modular for 'u1')
+    values = np.array([5, 200, 3, 3, 0, 255, 7])
+    repeats = np.array([1, 3, 2, 1, 4, 1, 2], dtype='u1')
+    for dtype in ['u1', 'int64']:
+        res = pbm.diffusion.repeat_counts(values, repeats, dtype)
+        assert res.dtype == np.dtype(dtype)
+        assert np.array_equal(res, np.repeat(values, repeats))
+    assert pbm.diffusion.repeat_counts(values[:0], repeats[:0], 'u1').size == 0
+
+
+def test_timestamps_thinning(tmp_path):
+    P = create_particles(6)
+    S = create_sim(P, t_max=0.01)
+    # A peak in the first half of the chunk and a low tail
+    time_size = 20000
+    emission = np.full((6, time_size), 0.05, dtype='float32')
+    emission[:, 2000:8000] = np.linspace(0.1, 1, 6, dtype='float32')[:, None]
+    max_rate, bg_rate, i_start, scale = 2e5, 4e4, 100, 10
+    expected = emission.sum(axis=1) * max_rate * S.t_step
+    expected_bg = bg_rate * S.t_step * time_size
+    half = (i_start + time_size // 2) * scale
+    for rs in (np.random.RandomState(1),
+               np.random.Generator(np.random.PCG64(1))):
+        samples = {}
+        for method in ('poisson', 'thinning'):
+            times, particles = [], []
+            for _ in range(20):
+                t, p = S._sim_timestamps(max_rate, bg_rate, emission, i_start,
+                                         rs, scale=scale, method=method)
+                assert (np.diff(t) >= 0).all()
+                assert (t % scale == 0).all()
+                assert t.min() >= i_start * scale
+                assert t.max() < (i_start + time_size) * scale
+                times.append(t)
+                particles.append(p)
+            samples[method] = np.hstack(times), np.hstack(particles)
+        for method, (times, particles) in samples.items():
+            counts = np.bincount(particles, minlength=7) / 20
+            sigma = np.sqrt(np.append(expected, expected_bg) / 20)
+            assert (np.abs(counts[:6] - expected) < 5 * sigma[:6]).all()
+            assert abs(counts[6] - expected_bg) < 5 * sigma[6]
+            # Fraction of photons in the first half of the chunk
+            fraction = (times < half).mean()
+            fraction_ref = ((emission[:, :time_size // 2].sum() * max_rate *
+                             S.t_step + expected_bg / 2) /
+                            (expected.sum() + expected_bg))
+            assert abs(fraction - fraction_ref) < 0.01
+    with pytest.raises(ValueError):
+        S._sim_timestamps(max_rate, bg_rate, emission, i_start, rs,
+                          method='bogus')
+
+    # The method is part of the name of the stored timestamps
+    S = create_sim(P, t_max=0.002)
+    S.simulate_diffusion(total_emission=False, chunksize=2**13,
+                         verbose=False, path=str(tmp_path))
+    kw = dict(max_rates=(400e3,), populations=(slice(0, 6),), bg_rate=1000)
+    try:
+        names = []
+        for method in ('poisson', 'thinning'):
+            S.simulate_timestamps_mix(rs=np.random.RandomState(_SEED),
+                                      method=method, skip_existing=True, **kw)
+            name = S._get_ts_name_mix(rs=np.random.RandomState(_SEED),
+                                      method=method, **kw)
+            assert S.get_timestamps_part(name)[0].attrs['method'] == method
+            names.append(name)
+        assert names[1] == names[0].replace('_rs_', '_thinning_rs_')
+        assert sorted(S.timestamp_names) == sorted(names)
+        assert S.timestamps_match_mix(
+            hash_=names[0][-6:], method='poisson', **kw) == names[:1]
+    finally:
+        S.store.close()
+        S.ts_store.close()
+
+
+def test_merge_timestamps():
+    rs = np.random.RandomState(3)
+    # Sorted streams with many equal timestamps, also between streams
+    times_list = [np.sort(rs.randint(50, size=n)) * 10 for n in (40, 0, 7, 30)]
+    particles_list = [np.full(t.size, i, dtype='u1')
+                      for i, t in enumerate(times_list)]
+    times, particles = pbm.diffusion.merge_timestamps(times_list,
+                                                      particles_list)
+    times_ref = np.hstack(times_list)
+    index_sort = times_ref.argsort(kind='mergesort')
+    assert np.array_equal(times, times_ref[index_sort])
+    assert np.array_equal(particles, np.hstack(particles_list)[index_sort])
+
+    P = create_particles(6)
+    S = create_sim(P, t_max=0.01)
+    emission = np.random.RandomState(1).rand(6, 5000).astype('float32')
+    populations = (slice(0, 2), slice(2, 6))
+    max_rates, bg_rates = (2e6, 1e6), (None, 1e5)
+    for method in ('poisson', 'thinning'):
+        # Reference: stable sort of the unsorted timestamps
+        times_list, particles_list = [], []
+        rs = np.random.RandomState(2)
+        for rate, pop, bg in zip(max_rates, populations, bg_rates):
+            t, p = S._sim_timestamps(rate, bg, emission[pop], 100, rs,
+                                     ip_start=pop.start, sort=False,
+                                     method=method)
+            times_list.append(t)
+            particles_list.append(p)
+        times_ref = np.hstack(times_list)
+        index_sort = times_ref.argsort(kind='mergesort')
+        times, particles = S._sim_timestamps_populations(
+            emission, max_rates, populations, bg_rates, 100,
+            np.random.RandomState(2), method=method)
+        assert np.array_equal(times, times_ref[index_sort])
+        assert np.array_equal(particles, np.hstack(particles_list)[index_sort])
+
+
+def test_split_channels(tmp_path):
+    P = create_particles(6)
+    S = create_sim(P, t_max=0.01)
+    emission = np.random.RandomState(1).rand(6, 20000).astype('float32')
+    populations = (slice(0, 2), slice(2, 6))
+    # Three channels: rates for each channel and population
+    max_rates = ((1e5, 2e5), (3e5, 0), (2e5, 1e5))
+    bg_rates = ((None, 4e4), (None, None), (None, 2e4))
+    expected = np.zeros((3, 7))
+    for i_ch in range(3):
+        for rate, pop in zip(max_rates[i_ch], populations):
+            expected[i_ch, pop] = emission[pop].sum(axis=1) * rate * S.t_step
+        expected[i_ch, 6] = (bg_rates[i_ch][1] or 0) * S.t_step * 20000
+    for rs in (np.random.RandomState(2),
+               np.random.Generator(np.random.PCG64(2))):
+        counts = np.zeros((3, 7))
+        for _ in range(10):
+            channels = S._sim_timestamps_channels(
+                emission, max_rates, populations, bg_rates, 0, rs)
+            for i_ch, (times, particles) in enumerate(channels):
+                assert (np.diff(times) >= 0).all()
+                counts[i_ch] += np.bincount(particles, minlength=7)
+        counts /= 10
+        sigma = np.sqrt(expected / 10)
+        assert (np.abs(counts - expected) <= 5 * sigma).all()
+        assert counts[1, 6] == 0 and counts[1, 2:6].sum() == 0
+
+    S = create_sim(P, t_max=0.004)
+    S.simulate_diffusion(total_emission=False, chunksize=2**13, seed=_SEED,
+                         path=str(tmp_path), verbose=False)
+    mix_sim = pbm.TimestapSimulation(S, em_rates=(2e6,), E_values=(0.75,),
+                                     num_particles=(6,), bg_rate_d=1e5,
+                                     bg_rate_a=1e5)
+    mix_sim.run_da(rs=np.random.RandomState(_SEED), split_channels=True)
+    ts_d, par_d = S.get_timestamps_part(mix_sim.name_timestamps_d)
+    ts_a, par_a = S.get_timestamps_part(mix_sim.name_timestamps_a)
+    assert (np.diff(ts_d[:]) >= 0).all() and (np.diff(ts_a[:]) >= 0).all()
+    assert ts_d.nrows > 0 and ts_a.nrows > 0
+    assert '_split_rs_' in ts_d.name and ts_d.attrs['split_channels']
+    # Timestamps drawn separately are stored in different arrays
+    mix_sim.run_da(rs=np.random.RandomState(_SEED))
+    assert mix_sim.name_timestamps_d != ts_d.name
+    assert not S.get_timestamps_part(
+        mix_sim.name_timestamps_d)[0].attrs['split_channels']
+    assert len(S.timestamp_names) == 4
+    S.store.close()
+    S.ts_store.close()
+
+
+def test_TimestampSimulation_single_pass(tmp_path):
+    P = create_particles(6)
+    S = create_sim(P, t_max=0.008)
+    S.simulate_diffusion(total_emission=False, chunksize=2**12, seed=_SEED,
+                         path=str(tmp_path), verbose=False)
+    mix_sim = pbm.TimestapSimulation(S, em_rates=(2e6,), E_values=(0.4,),
+                                     num_particles=(6,), bg_rate_d=1e5,
+                                     bg_rate_a=1e5)
+    timestamps = []
+    for single_pass in (False, True):
+        mix_sim.run(rs=np.random.RandomState(_SEED), single_pass=single_pass)
+        ts_d, par_d = S.get_timestamps_part(mix_sim.name_timestamps_d)
+        ts_a, par_a = S.get_timestamps_part(mix_sim.name_timestamps_a)
+        timestamps.append((mix_sim.hash_d, mix_sim.hash_a, ts_d[:], par_d[:],
+                           ts_a[:], par_a[:]))
+        assert ('single_pass' in ts_a.name) == single_pass
+        mix_sim.merge_da()
+        assert (np.diff(mix_sim.ts) >= 0).all()
+        assert mix_sim.a_ch.sum() == ts_a.nrows > 0
+
+    # Same donor timestamps, acceptor from an independent random state
+    hash_d, hash_a, ts_d, par_d, ts_a, par_a = timestamps[0]
+    hash_d1, hash_a1, ts_d1, par_d1, ts_a1, par_a1 = timestamps[1]
+    assert hash_d1 == hash_d and hash_a1 != hash_a
+    assert np.array_equal(ts_d1, ts_d) and np.array_equal(par_d1, par_d)
+    assert hash_a1 == pbm.diffusion.hash_(pbm.diffusion.get_rng_state(
+        pbm.diffusion.jumped_rng(np.random.RandomState(_SEED))))[:6]
+    # Both acceptor families are kept (D, A two-pass, A single pass)
+    assert len(S.timestamp_names) == 3
+    ts_a, _ = S.get_timestamps_part(mix_sim.name_timestamps_a)
+    assert ts_a.attrs['single_pass']
+    S.store.close()
+    S.ts_store.close()
@@ -13,7 +13,7 @@ from time import ctime
 from pathlib import Path
 import phconvert as phc
 
-from .diffusion import hash_
+from .diffusion import hash_, get_rng_state, set_rng_state, jumped_rng
 from ._version import get_versions
 __version__ = get_versions()['version']
 
@@ -117,7 +117,7 @@ class TimestapSimulation:
 
     Attributes created by .run():
 
-    - `hash_d`, `hash_a`
+    - `hash_d`, `hash_a`, `method`, `split_channels`, `single_pass`
 
     Attributes created by .merge_da():
 
@@ -204,22 +204,43 @@ class TimestapSimulation:
     def _calc_hash_da(self, rs):
         """Compute hash of D and A timestamps for single-step D+A case.
         """
-        self.hash_d = hash_(rs.get_state())[:6]
+        self.hash_d = hash_(get_rng_state(rs))[:6]
         self.hash_a = self.hash_d
 
     def run(self, rs, overwrite=True, skip_existing=False, path=None,
-            chunksize=None):
-        """Compute timestamps for current populations."""
+            chunksize=None, method='poisson', single_pass=False):
+        """Compute timestamps for current populations.
+
+        The photons are drawn using `method` ('poisson' or 'thinning'),
+        see :meth:`ParticlesSimulation.simulate_timestamps_mix`.
+
+        By default, the donor timestamps are computed first and the
+        acceptor timestamps start from the last random state of the donor.
+        If `single_pass` is True, the emission is read only once and the
+        acceptor timestamps use the random state `rs` jumped ahead (see
+        :func:`pybromo.diffusion.jumped_rng`), because the last random
+        state of the donor is known only at the end. The donor timestamps
+        are the same in both cases. The single-pass acceptor timestamps
+        are a separate family, with 'single_pass' in their name, so they
+        never match (or replace) the acceptor of a two-pass run.
+        """
         if path is None:
             path = str(self.S.store.filepath.parent)
         kwargs = dict(rs=rs, overwrite=overwrite, path=path,
-                      timeslice=self.timeslice, skip_existing=skip_existing)
+                      timeslice=self.timeslice, skip_existing=skip_existing,
+                      method=method)
         if chunksize is not None:
             kwargs['chunksize'] = chunksize
         header = ' - Mixture Simulation:'
+        self.method = method   # needed by merge_da()
+        self.split_channels = False
+        self.single_pass = single_pass
+        if single_pass:
+            self._run_single_pass(header, **kwargs)
+            return
 
         # Donor timestamps hash is from the input RandomState
-        self.hash_d = hash_(rs.get_state())[:6]   # needed by merge_da()
+        self.hash_d = hash_(get_rng_state(rs))[:6]   # needed by merge_da()
         print('%s Donor timestamps -    %s' % (header, ctime()), flush=True)
         self.S.simulate_timestamps_mix(
             populations = self.populations,
@@ -231,8 +252,8 @@ class TimestapSimulation:
         # of the donor timestamps. This allows deterministic generation of
         # donor + acceptor timestamps given the input random state.
         ts_d, _ = self.S.get_timestamps_part(self.name_timestamps_d)
-        rs.set_state(ts_d.attrs['last_random_state'])
-        self.hash_a = hash_(rs.get_state())[:6]   # needed by merge_da()
+        set_rng_state(rs, ts_d.attrs['last_random_state'])
+        self.hash_a = hash_(get_rng_state(rs))[:6]   # needed by merge_da()
         print('\n%s Acceptor timestamps - %s' % (header, ctime()), flush=True)
         self.S.simulate_timestamps_mix(
             populations = self.populations,
@@ -241,16 +262,47 @@ class TimestapSimulation:
             **kwargs)
         print('\n%s Completed. %s' % (header, ctime()), flush=True)
 
+    def _run_single_pass(self, header, rs, **kwargs):
+        """Compute D and A timestamps of :meth:`run` reading emission once.
+        """
+        # Donor hash is from the input RandomState, acceptor hash from the
+        # initial state of the acceptor RandomState
+        rs_a = jumped_rng(rs)
+        self.hash_d = hash_(get_rng_state(rs))[:6]   # needed by merge_da()
+        self.hash_a = hash_(get_rng_state(rs_a))[:6]
+        print('%s Donor + Acceptor timestamps (single pass) - %s' %
+              (header, ctime()), flush=True)
+        # Same chunks of simulate_timestamps_mix() for the same donor
+        self.S.simulate_timestamps_mix_da(
+            max_rates_d = self.em_rates_d,
+            max_rates_a = self.em_rates_a,
+            populations = self.populations,
+            bg_rate_d = self.bg_rate_d,
+            bg_rate_a = self.bg_rate_a,
+            rs=rs, rs_a=rs_a, t_chunksize=None,
+            **kwargs)
+        print('\n%s Completed. %s' % (header, ctime()), flush=True)
+
     def run_da(self, rs, overwrite=True, skip_existing=False, path=None,
-               chunksize=None):
-        """Compute timestamps for current populations."""
+               chunksize=None, method='poisson', split_channels=False):
+        """Compute timestamps for current populations.
+
+        The photons are drawn using `method` ('poisson' or 'thinning'),
+        see :meth:`ParticlesSimulation.simulate_timestamps_mix`.
+        If `split_channels` is True, the photons are drawn once and split
+        in D and A, see :meth:`ParticlesSimulation.simulate_timestamps_mix_da`.
+        """
         if path is None:
             path = str(self.S.store.filepath.parent)
         kwargs = dict(rs=rs, overwrite=overwrite, path=path,
-                      timeslice=self.timeslice, skip_existing=skip_existing)
+                      timeslice=self.timeslice, skip_existing=skip_existing,
+                      method=method, split_channels=split_channels)
         if chunksize is not None:
             kwargs['chunksize'] = chunksize
         header = ' - Mixture Simulation:'
+        self.method = method   # needed by merge_da()
+        self.split_channels = split_channels
+        self.single_pass = False
 
         # Donor timestamps hash is from the input RandomState
         self._calc_hash_da(rs)
@@ -268,15 +320,18 @@ class TimestapSimulation:
 
     @property
     def name_timestamps_d(self):
-        names_d = self.S.timestamps_match_mix(self.em_rates_d, self.populations,
-                                              self.bg_rate_d, self.hash_d)
+        names_d = self.S.timestamps_match_mix(
+            self.em_rates_d, self.populations, self.bg_rate_d, self.hash_d,
+            method=self.method, split_channels=self.split_channels)
         assert len(names_d) == 1
         return names_d[0]
 
     @property
     def name_timestamps_a(self):
-        names_a = self.S.timestamps_match_mix(self.em_rates_a, self.populations,
-                                              self.bg_rate_a, self.hash_a)
+        names_a = self.S.timestamps_match_mix(
+            self.em_rates_a, self.populations, self.bg_rate_a, self.hash_a,
+            method=self.method, split_channels=self.split_channels,
+            single_pass=self.single_pass)
         assert len(names_a) == 1
         return names_a[0]
 
@@ -289,7 +344,7 @@ class TimestapSimulation:
         ts_a, ts_par_a = self.S.get_timestamps_part(self.name_timestamps_a)
         ts, a_ch, part = merge_da(ts_d, ts_par_d, ts_a, ts_par_a)
         assert a_ch.sum() == ts_a.shape[0]
-        assert (-a_ch).sum() == ts_d.shape[0]
+        assert (~a_ch).sum() == ts_d.shape[0]
         assert a_ch.size == ts_a.shape[0] + ts_d.shape[0]
         self.ts, self.a_ch, self.part = ts, a_ch, part
         self.clk_p = ts_d.attrs['clk_p']
@@ -314,6 +369,8 @@ class TimestapSimulation:
             num_polarization_ch = 1,
             num_split_ch = 1,
             modulated_excitation = False,
+            excitation_cw = (True,),
+            excitation_alternated = (False,),
             lifetime = False)
 
         provenance = dict(filename=self.S.ts_store.filename,
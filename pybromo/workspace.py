@@ -0,0 +1,89 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module provides the :class:`Workspace` class: a set of preallocated
+buffers reused across the chunks of a simulation.
+"""
+
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class Workspace:
+    """Named buffers reused across chunks to avoid per-chunk allocations.
+
+    Each buffer is a flat byte array which grows to the largest size
+    requested so far. After the first (largest) chunk, requesting a buffer
+    allocates nothing, so the memory used by a simulation is predictable.
+    The arrays returned by :meth:`get` are views of the buffers and are
+    overwritten by the next request with the same name.
+
+    Buffers used concurrently by several threads are taken from separate
+    workspaces, obtained with :meth:`slot`.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self._free_slots = []
+        self._num_slots = 0
+        self._lock = threading.Lock()
+
+    def get(self, name, shape, dtype='float64', zero=False):
+        """Return a C-contiguous array of given `shape` and `dtype`.
+
+        The array is a view of the buffer `name`, which is enlarged if
+        needed. If `zero` is True, the array is set to 0.
+        """
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        nbytes = size * dtype.itemsize
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.size < nbytes:
+            buffer = np.empty(nbytes, dtype='u1')
+            self._buffers[name] = buffer
+        array = buffer[:nbytes].view(dtype).reshape(shape)
+        if zero:
+            array[...] = 0
+        return array
+
+    @contextmanager
+    def slot(self):
+        """Context manager returning a workspace not used by other threads.
+
+        The workspaces are created on demand and kept for later use, so
+        their number is the maximum number of concurrent users.
+        """
+        with self._lock:
+            if self._free_slots:
+                workspace = self._free_slots.pop()
+            else:
+                workspace = Workspace()
+                self._num_slots += 1
+        try:
+            yield workspace
+        finally:
+            with self._lock:
+                self._free_slots.append(workspace)
+
+    @property
+    def nbytes(self):
+        """Total size in bytes of the buffers (including the slots)."""
+        nbytes = sum(buffer.size for buffer in self._buffers.values())
+        return nbytes + sum(slot.nbytes for slot in self._free_slots)
+
+    def clear(self):
+        """Release all the buffers."""
+        with self._lock:
+            self._buffers = {}
+            self._free_slots = []
+            self._num_slots = 0
+
+    def __repr__(self):
+        return 'Workspace(%d buffers, %d slots, %.1f MB)' % (
+            len(self._buffers), self._num_slots, self.nbytes / 2**20)
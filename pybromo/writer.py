@@ -0,0 +1,113 @@
+#
+# PyBroMo - A single molecule diffusion simulator in confocal geometry.
+#
+# Copyright (C) 2013-2015 Antonino Ingargiola tritemio@gmail.com
+#
+
+"""
+This module provides the :class:`ChunkWriter` class, used to write the
+chunks of a simulation to disk, optionally in a background thread.
+"""
+
+import queue
+import threading
+
+
+class ChunkWriter:
+    """Write the chunks of a simulation to a pytables file.
+
+    Each chunk is written by a function passed to :meth:`submit`. When
+    `background` is True, the functions are executed (in order) by a writer
+    thread, so the next chunk can be computed while the current one is
+    compressed and written. At most `depth` chunks are pending: a call to
+    :meth:`submit` blocks until a previous chunk has been written. The
+    arrays passed to the writer must not be modified until written (e.g.
+    using `depth + 1` buffers in turn).
+
+    The writer thread must be the only one accessing the file, since
+    pytables is not thread-safe. Call :meth:`wait` before accessing the
+    file from other threads.
+
+    The file is flushed every `flush_every` chunks (if not None) and by
+    :meth:`wait`. An exception raised writing a chunk is raised again by
+    the next call to :meth:`submit`, :meth:`wait` or :meth:`close`. After an
+    error the following chunks are discarded.
+    """
+
+    def __init__(self, h5file, flush_every=1, background=False, depth=1):
+        self.h5file = h5file
+        self.flush_every = flush_every
+        self.background = background
+        self.num_written = 0
+        self.failed = False
+        self._error = None
+        if background:
+            self._slots = threading.Semaphore(depth)
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _write(self, func, args, kwargs):
+        func(*args, **kwargs)
+        self.num_written += 1
+        if self.flush_every is not None and \
+                self.num_written % self.flush_every == 0:
+            self.h5file.flush()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                break
+            try:
+                if not self.failed:
+                    self._write(*task)
+            except BaseException as e:
+                self._error = e
+                self.failed = True
+            finally:
+                self._slots.release()
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, func, *args, **kwargs):
+        """Write a chunk calling `func(*args, **kwargs)`."""
+        self._raise_error()
+        if self.failed:
+            raise RuntimeError('A previous chunk could not be written.')
+        if not self.background:
+            self._write(func, args, kwargs)
+            return
+        self._slots.acquire()
+        self._queue.put((func, args, kwargs))
+
+    def wait(self):
+        """Wait until all the chunks are written and flush the file."""
+        if self.background:
+            self._queue.join()
+        self._raise_error()
+        self.h5file.flush()
+
+    def close(self):
+        """Write the pending chunks and stop the writer thread."""
+        if self.background and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.background and self._thread.is_alive():
+            # Do not hide the original exception
+            self.failed = True
+            self._queue.put(None)
+            self._thread.join()